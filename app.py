@@ -15,17 +15,18 @@ env = cdk.Environment(
 )
 stage = os.environ.get("STAGE", "prod")
 
-engStack = EnginesStack(
+databaseStack = DatabaseStack(
     scope=app,
-    construct_id="EnginesStack",
-    description="A stack that creates lambda functions working with AI engines APIs",
+    construct_id="DatabaseStack",
+    description="A stack containing database",
     env=env,
 )
 
-databaseStack = DatabaseStack(
+engStack = EnginesStack(
     scope=app,
-    construct_id="DatabaseStack",
-    description="A stack containing database",
+    construct_id="EnginesStack",
+    description="A stack that creates lambda functions working with AI engines APIs",
+    conversations_table=databaseStack.conversations_table,
     env=env,
 )
 
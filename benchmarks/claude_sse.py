@@ -0,0 +1,119 @@
+"""Claude engine latency against a local claude.ai stand-in.
+
+The stand-in serves the organization, conversation, title, completion
+(text/event-stream) and conversation endpoints with fixed delays. The legacy
+flow replays the previous call sequence: create conversation, set title,
+completion, sleep 2 s, then GET the whole conversation. The streaming flow is
+the current `claude.ask`.
+
+    python -m benchmarks.claude_sse
+"""
+
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from curl_cffi import requests
+
+create_delay = 0.3
+title_delay = 0.8
+first_token_delay = 0.6
+token_delay = 0.03
+tokens = 40
+get_delay = 0.2
+answer_tokens = [f"word{i} " for i in range(tokens)]
+
+
+class ClaudeStandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/api/organizations":
+            return self.__json([{"uuid": "org"}])
+        time.sleep(get_delay)
+        self.__json({"chat_messages": [{"text": "".join(answer_tokens)}]})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.endswith("/title"):
+            time.sleep(title_delay)
+            return self.__json({"title": "Benchmark"})
+        if self.path.endswith("/completion"):
+            return self.__completion()
+        time.sleep(create_delay)
+        self.__json({})
+
+    def __completion(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(first_token_delay)
+        for token in answer_tokens:
+            self.__chunk({"type": "completion", "completion": token, "stop_reason": None})
+            time.sleep(token_delay)
+        self.__chunk({"type": "completion", "completion": "", "stop_reason": "stop_sequence"})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def __chunk(self, data: dict):
+        event = f"event: completion\r\ndata: {json.dumps(data)}\r\n\r\n".encode()
+        self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+        self.wfile.flush()
+
+    def __json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def legacy_ask(base_url: str, conversation_id: str) -> str:
+    url = f"{base_url}/api/organizations/org/chat_conversations"
+    requests.post(url, data=json.dumps({"uuid": conversation_id, "name": ""}))
+    requests.post(f"{url}/{conversation_id}/title", data="{}")
+    requests.post(f"{url}/{conversation_id}/completion", data="{}")
+    time.sleep(2)
+    response = requests.get(f"{url}/{conversation_id}")
+    return response.json()["chat_messages"][-1]["text"]
+
+
+def main() -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ClaudeStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    os.environ["CLAUDE_BASE_URL"] = base_url
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    with (
+        patch("engines.common_utils.read_ssm_param", return_value="stand-in"),
+        patch("engines.common_utils.read_json_from_s3", return_value=[]),
+    ):
+        from engines import claude
+
+    print(f"{'turn':<16}{'legacy s':>10}{'streaming s':>13}{'first token s':>15}")
+    context = SimpleNamespace(conversation_id=None)
+    for turn in ["new", "follow-up"]:
+        start = time.perf_counter()
+        legacy_ask(base_url, "legacy")
+        legacy = time.perf_counter() - start
+
+        first = []
+        stream = SimpleNamespace(append=lambda _: first or first.append(time.perf_counter()))
+        start = time.perf_counter()
+        answer = claude.ask(context=context, text="benchmark", stream=stream)
+        current = time.perf_counter() - start
+        assert answer.replace("\\", "") == "".join(answer_tokens)
+        print(f"{turn:<16}{legacy:>10.2f}{current:>13.2f}{first[0] - start:>15.2f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
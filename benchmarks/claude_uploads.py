@@ -0,0 +1,155 @@
+"""Memory of Claude attachment uploads and the upload cache.
+
+Every mode runs in a fresh process and reports its peak RSS (VmHWM) above the
+RSS after imports. The legacy mode builds the whole multipart body in memory
+like `MultipartEncoder(...).to_string()` did, the streaming mode is the current
+`claude.upload_attachment`. The stand-in discards the uploaded body in chunks.
+The cache mode references the same document twice in one conversation with
+the upload cache kept in memory.
+
+    python -m benchmarks.claude_uploads
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+file_size = 64 * 1024 * 1024
+chunk_size = 1024 * 1024
+
+
+class UploadStandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.__json([{"uuid": "org"}])
+
+    def do_POST(self):
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, chunk_size)))
+        self.server.uploads += 1
+        self.__json({"file_uuid": str(uuid.uuid4())})
+
+    def __json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MemoryTable:
+    """In-memory stand-in for the 'bot-state' table."""
+
+    def __init__(self):
+        self.items = {}
+
+    def get_item(self, Key):
+        item = self.items.get((Key["state_id"], Key["kind"]))
+        return {"Item": item} if item else {}
+
+    def put_item(self, Item):
+        self.items[(Item["state_id"], Item["kind"])] = Item
+
+
+def memory_kb(field: str) -> int:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return 0
+
+
+def import_claude(base_url: str):
+    os.environ["CLAUDE_BASE_URL"] = base_url
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    with (
+        patch("engines.common_utils.read_ssm_param", return_value="stand-in"),
+        patch("engines.common_utils.read_json_from_s3", return_value=[]),
+    ):
+        from engines import claude
+    return claude
+
+
+def legacy_upload(base_url: str, path: str) -> None:
+    from curl_cffi import requests
+
+    boundary = uuid.uuid4().hex
+    with open(path, "rb") as file:
+        body = (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+            f'filename="{os.path.basename(path)}"\r\n'
+            "Content-Type: application/pdf\r\n\r\n"
+        ).encode()
+        body += file.read()
+        body += f"\r\n--{boundary}--\r\n".encode()
+    requests.post(
+        f"{base_url}/api/org/upload",
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        data=body,
+        impersonate="chrome110",
+    )
+
+
+def run(mode: str, base_url: str, path: str, results) -> None:
+    claude = import_claude(base_url)
+    baseline = memory_kb("VmRSS")
+    if mode == "legacy":
+        legacy_upload(base_url, path)
+    elif mode == "streaming":
+        claude.upload_attachment(tmp_file=path, content_type="application/pdf")
+    else:
+        # the attachment is downloaded again for every message and removed after use
+        def download(s3_uri, bucket_name):
+            return shutil.copy(path, tempfile.mkdtemp())
+
+        state = MemoryTable()
+        with (
+            patch("engines.upload_cache.table", lambda name: state),
+            patch("engines.attachments.download_attachment", download),
+        ):
+            for _ in range(2):
+                uploads = claude.UploadCache(engine_id="claude", conversation_id="conversation")
+                claude.process_attachments(attachments="s3://att/document.png", uploads=uploads)
+                uploads.save(conversation_id="conversation")
+    results.put((mode, (memory_kb("VmHWM") - baseline) / 1024))
+
+
+def main() -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), UploadStandIn)
+    server.uploads = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        path = f"{directory}/document.png"
+        with open(path, "wb") as file:
+            for _ in range(file_size // chunk_size):
+                file.write(os.urandom(chunk_size))
+        print(f"file {file_size // (1024 * 1024)} MB")
+        print(f"{'mode':<12}{'peak MB above baseline':>24}{'uploads':>9}")
+        for mode in ["legacy", "streaming", "cache"]:
+            before = server.uploads
+            results = context.Queue()
+            process = context.Process(target=run, args=(mode, base_url, path, results))
+            process.start()
+            name, peak = results.get()
+            process.join()
+            print(f"{name:<12}{peak:>24.1f}{server.uploads - before:>9}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Item sizes and write units of stored conversations.
+
+Stores a corpus of exchanges the way `UserContext.save_conversation` did
+before (the whole exchange as one JSON string) and with the conversation
+codec (plain, zstd compressed or offloaded to s3). Every exchange is written
+to the table and to both ALL-projected indexes, so write units are counted
+three times. Offloaded bodies go through an in-memory s3 stand-in.
+
+    python -m benchmarks.conversation_storage
+"""
+
+import json
+import math
+import time
+from unittest.mock import patch
+
+from benchmarks.payload_codec import MemoryS3, sample
+from engines import conversation_codec
+from engines.conversation_codec import pack_conversation, unpack_conversation
+
+# (label, response size in characters, share of exchanges)
+corpus = [
+    ("short answer", 300, 0.30),
+    ("chat reply", 2_500, 0.35),
+    ("detailed reply", 9_000, 0.20),
+    ("long answer", 40_000, 0.10),
+    ("gemini max output", 250_000, 0.04),
+    ("pasted document", 600_000, 0.01),
+]
+exchanges = 1000
+# the table and the 'userid-index' and 'timestamp-index' indexes
+item_copies = 3
+item_limit = 400 * 1024
+
+
+def item_size(item: dict) -> int:
+    """DynamoDB item size: attribute names plus UTF-8 strings, binaries and numbers."""
+    size = 0
+    for name, value in item.items():
+        size += len(name.encode("utf-8"))
+        if isinstance(value, bytes):
+            size += len(value)
+        elif isinstance(value, int):
+            size += math.ceil(len(str(value)) / 2) + 1
+        else:
+            size += len(str(value).encode("utf-8"))
+    return size
+
+
+def write_units(size: int) -> int:
+    return math.ceil(size / 1024) * item_copies
+
+
+def keys(i: int) -> dict:
+    return {
+        "conversation_id": "0b0e5f3c-5d6e-4bb6-9d1e-1f4c2a9e7b10",
+        "request_id": f"{i:08d}-5d6e-4bb6-9d1e-1f4c2a9e7b10",
+        "user_id": "123456789_123456789",
+        "engine": "gemini",
+        "timestamp": 1760000000 + i,
+    }
+
+
+def main() -> None:
+    s3 = MemoryS3()
+    print(
+        f"{'exchange':<20}{'share':>6}{'legacy B':>10}{'WCU':>5}{'new B':>8}{'WCU':>5}"
+        f"{'stored as':>11}{'pack ms':>9}{'read ms':>9}"
+    )
+    totals = {"legacy": 0, "new": 0, "s3": 0, "too large": 0}
+    with patch.object(conversation_codec, "client", lambda service: s3), patch.object(
+        conversation_codec, "_bucket", "bench"
+    ):
+        for label, size, share in corpus:
+            count = round(exchanges * share)
+            conversation = {"request": sample(400), "response": sample(size)}
+            legacy = {**keys(0), "conversation": json.dumps(conversation)}
+            start = time.perf_counter()
+            attributes = pack_conversation(conversation, "bench", label)
+            pack_ms = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            unpack_conversation(attributes)
+            read_ms = (time.perf_counter() - start) * 1000
+            new = {**keys(0), "preview": conversation["request"][:60], **attributes}
+            legacy_size, new_size = item_size(legacy), item_size(new)
+            stored = next(iter(attributes))
+            if legacy_size > item_limit:
+                totals["too large"] += count
+            totals["legacy"] += write_units(legacy_size) * count
+            totals["new"] += write_units(new_size) * count
+            totals["s3"] += count if stored == "body_ref" else 0
+            print(
+                f"{label:<20}{share:>6.0%}{legacy_size:>10}{write_units(legacy_size):>5}"
+                f"{new_size:>8}{write_units(new_size):>5}{stored:>11}"
+                f"{pack_ms:>9.2f}{read_ms:>9.2f}"
+            )
+    print(
+        f"\n{exchanges} exchanges: {totals['legacy']} WCU before, {totals['new']} WCU now "
+        f"and {totals['s3']} s3 puts; {totals['too large']} exchanges exceeded the "
+        f"400 KB item limit before"
+    )
+
+
+if __name__ == "__main__":
+    main()
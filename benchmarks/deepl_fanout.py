@@ -0,0 +1,134 @@
+"""DeepL multi-language translation against a latency-injecting stand-in.
+
+The stand-in answers /v2/translate after `translate_delay` and throttles the
+first request for every `throttled` language with a 429, which the DeepL client
+retries after its backoff. The legacy flow replays the previous loop: one
+translation and one SNS message per language. The current flow is
+`deepl_tr.sqs_handler` with a counting SNS stand-in and an empty
+translation memory.
+
+    python -m benchmarks.deepl_fanout
+"""
+
+import importlib
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from deepl import Translator
+
+from engines.translation_memory import sentence_hash
+
+decode_message = importlib.import_module("lambda.utils").decode_message
+translate_delay = 0.4
+throttled = {"FR"}
+languages = "PL,DE,FR,ES,IT,EN-GB"
+text = "The quarterly report is attached. Please review the figures before Friday."
+
+
+class DeepLStandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    lock = threading.Lock()
+    requests = 0
+    throttled_once = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        lang = request["target_lang"]
+        with DeepLStandIn.lock:
+            DeepLStandIn.requests += 1
+            throttle = lang in throttled and lang not in DeepLStandIn.throttled_once
+            DeepLStandIn.throttled_once.add(lang)
+        time.sleep(translate_delay)
+        if throttle:
+            return self.__json(429, {"message": "Too many requests"})
+        translations = [
+            {"detected_source_language": "EN", "text": f"[{lang}] {t}", "billed_characters": len(t)}
+            for t in request["text"]
+        ]
+        self.__json(200, {"translations": translations})
+
+    def __json(self, status: int, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class CountingSNS:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, TopicArn: str, Message: str):
+        self.messages.append(json.loads(Message))
+
+
+class MemoryStandIn:
+    """In-process TranslationMemory shared by all instances."""
+
+    entries = {}
+
+    def lookup(self, sentences, targets, source=None):
+        keys = [(sentence_hash(s), t) for s in sentences for t in targets]
+        return {key: self.entries[key] for key in keys if key in self.entries}
+
+    def store(self, translations, source=None):
+        for sentence, target, translation in translations:
+            self.entries[(sentence_hash(sentence), target)] = translation
+
+
+def legacy_translate(translator: Translator, sns: CountingSNS) -> None:
+    for lang in languages.split(","):
+        try:
+            response = translator.translate_text(text, target_lang=lang.strip())
+            result = response.text
+        except Exception as e:
+            result = str(e)
+        sns.publish(TopicArn="results", Message=json.dumps({"engine": lang, "response": result}))
+
+
+def main() -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DeepLStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    translator = Translator("stand-in:fx", server_url=f"http://127.0.0.1:{server.server_port}")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    with patch("engines.common_utils.read_ssm_param", return_value="stand-in"):
+        from engines import deepl_tr
+
+    print(f"{len(languages.split(','))} languages, {translate_delay}s per call, 429 once for {throttled}")
+    print(f"{'flow':<10}{'seconds':>9}{'DeepL calls':>13}{'SNS messages':>14}")
+    for flow in ["legacy", "fan-out"]:
+        DeepLStandIn.requests = 0
+        DeepLStandIn.throttled_once = set()
+        sns = CountingSNS()
+        start = time.perf_counter()
+        if flow == "legacy":
+            legacy_translate(translator, sns)
+        else:
+            with (
+                patch.object(deepl_tr, "translator", translator),
+                patch.object(deepl_tr, "sns", sns),
+                patch.object(deepl_tr, "TranslationMemory", MemoryStandIn),
+                patch.object(deepl_tr, "put_metrics", lambda *args, **kwargs: None),
+            ):
+                payload = {"text": text, "languages": languages}
+                event = {"Records": [{"messageId": "1", "body": json.dumps(payload)}]}
+                deepl_tr.sqs_handler(event, SimpleNamespace(aws_request_id="benchmark"))
+        seconds = time.perf_counter() - start
+        print(f"{flow:<10}{seconds:>9.2f}{DeepLStandIn.requests:>13}{len(sns.messages):>14}")
+    print()
+    print(decode_message(sns.messages[0]["response"]))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
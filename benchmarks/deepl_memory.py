@@ -0,0 +1,85 @@
+"""Translation memory hit ratio and billed characters on repeated texts.
+
+The messages replay typical repeats: e-mails sharing a signature, a text sent
+again after an edit and an exact re-send. They are translated by
+`deepl_tr.sqs_handler` against the DeepL stand-in of `benchmarks.deepl_fanout`
+with the memory kept in process. Without the memory every message is billed
+in full for every language.
+
+    python -m benchmarks.deepl_memory
+"""
+
+import json
+import os
+import threading
+from http.server import ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from deepl import Translator
+
+from benchmarks import deepl_fanout
+from benchmarks.deepl_fanout import CountingSNS, DeepLStandIn, MemoryStandIn
+
+languages = "PL,DE"
+signature = """Best regards,
+Anna Kowalska
+Head of Procurement, Example Logistics Sp. z o.o.
+This message and any attachments are confidential. If you received it by mistake, please notify the sender and delete it."""
+first = """Hello Mark,
+Thank you for the offer. We would like to order 40 pallets for delivery in March. Could you confirm the price per pallet?"""
+second = """Hello Mark,
+The invoice for February is attached. Please check the delivery address, it changed last month."""
+first_edited = first.replace("40 pallets", "45 pallets")
+messages = [
+    ("first e-mail", f"{first}\n\n{signature}"),
+    ("other e-mail, same signature", f"{second}\n\n{signature}"),
+    ("first e-mail edited", f"{first_edited}\n\n{signature}"),
+    ("other e-mail re-sent", f"{second}\n\n{signature}"),
+]
+
+
+def main() -> None:
+    deepl_fanout.translate_delay = 0.05
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DeepLStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    translator = Translator("stand-in:fx", server_url=f"http://127.0.0.1:{server.server_port}")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    with patch("engines.common_utils.read_ssm_param", return_value="stand-in"):
+        from engines import deepl_tr
+
+    metrics = []
+    print(f"{'message':<30}{'hits':>9}{'billed':>8}{'without':>9}{'saved':>7}")
+    totals = [0, 0, 0, 0]
+    with (
+        patch.object(deepl_tr, "translator", translator),
+        patch.object(deepl_tr, "sns", CountingSNS()),
+        patch.object(deepl_tr, "TranslationMemory", MemoryStandIn),
+        patch.object(deepl_tr, "put_metrics", lambda values, **_: metrics.append(values)),
+    ):
+        for name, text in messages:
+            payload = {"text": text, "languages": languages}
+            event = {"Records": [{"messageId": "1", "body": json.dumps(payload)}]}
+            deepl_tr.sqs_handler(event, SimpleNamespace(aws_request_id="benchmark"))
+            values = {key: value for key, (value, _) in metrics[-1].items()}
+            without = len(text) * len(languages.split(","))
+            hits, lookups = values["TranslationMemoryHits"], values["TranslationMemoryLookups"]
+            totals = [
+                totals[0] + hits,
+                totals[1] + lookups,
+                totals[2] + values["BilledCharacters"],
+                totals[3] + without,
+            ]
+            print(
+                f"{name:<30}{hits:>4}/{lookups:<4}{values['BilledCharacters']:>8}"
+                f"{without:>9}{1 - values['BilledCharacters'] / without:>7.0%}"
+            )
+    print(
+        f"{'total':<30}{totals[0]:>4}/{totals[1]:<4}{totals[2]:>8}{totals[3]:>9}"
+        f"{1 - totals[2] / totals[3]:>7.0%}"
+    )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
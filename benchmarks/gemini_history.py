@@ -0,0 +1,88 @@
+"""Prompt tokens per turn for the Gemini engine against conversation length.
+
+Replays a conversation against a local Gemini stand-in and counts the prompt
+tokens each strategy sends per turn: stateless (the previous behaviour), the
+full transcript, the token-budgeted window and the budgeted window with
+explicit context caching. Cached tokens are billed at a quarter of the price.
+
+    python -m benchmarks.gemini_history
+"""
+
+import random
+from types import SimpleNamespace
+
+from engines import gemini_context
+from engines.conversation_history import estimate_tokens, select_turns, total_tokens
+
+turns_total = 120
+report_at = [1, 5, 10, 20, 40, 80, 120]
+cached_token_price = 0.25
+
+
+class LocalGemini:
+    """Counts tokens of contents sent to generate and stored in caches."""
+
+    def __init__(self) -> None:
+        self.caches = SimpleNamespace(create=self.create_cache, delete=self.delete_cache)
+        self.stored = {}
+
+    def create_cache(self, model, config):
+        name = f"cachedContents/{len(self.stored)}"
+        self.stored[name] = count(config.contents)
+        return SimpleNamespace(name=name)
+
+    def delete_cache(self, name):
+        self.stored.pop(name, None)
+
+    def prompt(self, contents, cached_content=None) -> tuple:
+        cached = self.stored.get(cached_content, 0) if cached_content else 0
+        return count(contents) + cached, cached
+
+
+def count(contents) -> int:
+    return sum(estimate_tokens(part.text) for content in contents for part in content.parts)
+
+
+def conversation(rnd: random.Random) -> list:
+    history = []
+    for i in range(turns_total):
+        request = " ".join(["question"] * rnd.randint(10, 80))
+        response = " ".join(["answer"] * rnd.randint(150, 900))
+        history.append({"request_id": str(i), "timestamp": i, "request": request, "response": response})
+    return history
+
+
+def main() -> None:
+    history = conversation(random.Random(7))
+    client = LocalGemini()
+    context = SimpleNamespace(optional={}, read_summary=lambda: None)
+    print(
+        f"{'turn':>5}{'stateless':>11}{'full':>9}{'budgeted':>10}"
+        f"{'cached: sent':>14}{'cached':>9}{'billed':>9}"
+    )
+    for turn in range(1, turns_total + 1):
+        past = history[: turn - 1]
+        text = history[turn - 1]["request"]
+        context.read_history = (
+            lambda limit, oldest=False, past=past: past[:limit] if oldest else past[-limit:]
+        )
+        stateless = estimate_tokens(text)
+        full = total_tokens(past) + stateless
+        window = select_turns(
+            past[:1] + past[-50:] if len(past) > 50 else past,
+            gemini_context.history_token_budget,
+            gemini_context.pinned_turns,
+        )
+        budgeted = total_tokens(window) + stateless
+        contents, cache = gemini_context.build_contents(client, "gemini-local", context, text)
+        prompt, cached = client.prompt(contents, cache)
+        billed = prompt - cached + cached * cached_token_price
+        if turn in report_at:
+            print(
+                f"{turn:>5}{stateless:>11}{full:>9}{budgeted:>10}"
+                f"{prompt - cached:>14}{cached:>9}{billed:>9.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
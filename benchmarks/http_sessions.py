@@ -0,0 +1,148 @@
+"""Module-level curl_cffi calls against pooled sessions on a local TLS stand-in.
+
+The stand-in is an HTTPS server with a throwaway self-signed certificate that
+counts accepted connections, i.e. TLS handshakes. A new connection also waits
+`handshake_delay`, the round trips TCP and TLS setup cost against a remote
+upstream that a loopback interface does not show. Every call of the legacy flow
+uses `requests.get/post` with impersonation, every call of the pooled flow
+borrows a session from `SessionPool`. Sequential calls show the handshake
+savings of a warm container, the threaded calls the SQS batch workers.
+
+    python -m benchmarks.http_sessions
+"""
+
+import datetime
+import socket
+import ssl
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from curl_cffi import requests
+
+from engines.http_sessions import SessionPool
+
+calls = 100
+workers = 4
+browser_version = "chrome120"
+handshake_delay = 0.05
+
+
+class StandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        with StandIn.lock:
+            StandIn.connections += 1
+        time.sleep(handshake_delay)
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.__reply(b'{"resolution": 1024}')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.__reply(b'{"request_id": "stand-in"}')
+
+    def __reply(self, body: bytes):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def self_signed_context(directory: str) -> ssl.SSLContext:
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.UTC)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    cert_file, key_file = f"{directory}/cert.pem", f"{directory}/key.pem"
+    with open(cert_file, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_file, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+    return context
+
+
+def legacy_call(url: str, index: int) -> None:
+    if index % 2:
+        requests.post(url, data="{}", impersonate=browser_version, verify=False)
+    else:
+        requests.get(url, impersonate=browser_version, verify=False)
+
+
+def pooled_call(pool: SessionPool, url: str, index: int) -> None:
+    if index % 2:
+        pool.post(url, data="{}")
+    else:
+        pool.get(url)
+
+
+def measure(call, parallel: bool) -> tuple:
+    before = StandIn.connections
+    start = time.perf_counter()
+    if parallel:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(call, range(calls)))
+    else:
+        for index in range(calls):
+            call(index)
+    return time.perf_counter() - start, StandIn.connections - before
+
+
+def main() -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    with tempfile.TemporaryDirectory() as directory:
+        context = self_signed_context(directory)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"https://127.0.0.1:{server.server_port}/api/images/sample"
+
+    print(f"{calls} calls, {workers} threads for the threaded runs")
+    print(f"{'flow':<22}{'seconds':>9}{'ms/call':>9}{'handshakes':>12}")
+    for parallel in [False, True]:
+        pool = SessionPool(name="stand-in", impersonate=browser_version, verify=False)
+        suffix = "threaded" if parallel else "sequential"
+        for flow, call in [
+            ("legacy", lambda i: legacy_call(url, i)),
+            ("pooled", lambda i: pooled_call(pool, url, i)),
+        ]:
+            seconds, handshakes = measure(call, parallel)
+            name = f"{flow} {suffix}"
+            print(f"{name:<22}{seconds:>9.2f}{seconds * 1000 / calls:>9.1f}{handshakes:>12}")
+        pool.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
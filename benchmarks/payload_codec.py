@@ -0,0 +1,119 @@
+"""Result payload codec benchmark.
+
+Compares the legacy zlib+base64 encoding with the size-adaptive codec over a
+corpus of response sizes seen on the result topic: one-line answers, typical
+chat replies, long Gemini answers and pasted or translated documents.
+Oversized payloads go through an in-memory s3 stand-in, so the timings
+show codec cost without network latency.
+
+    python -m benchmarks.payload_codec
+"""
+
+import base64
+import importlib
+import io
+import random
+import string
+import time
+import zlib
+from unittest.mock import MagicMock, patch
+
+from botocore.response import StreamingBody
+
+from engines.common_utils import encode_message
+
+utils = importlib.import_module("lambda.utils")
+
+# (label, size in characters, share of unique characters)
+corpus = [
+    ("pong / short answer", 120, 0.0),
+    ("translation", 600, 0.0),
+    ("chat reply", 2_500, 0.0),
+    ("detailed reply", 9_000, 0.0),
+    ("long answer", 40_000, 0.0),
+    ("gemini max output", 250_000, 0.0),
+    ("pasted document", 900_000, 0.0),
+    ("tables and ids", 900_000, 0.5),
+]
+repeat = 20
+sns_limit = 256 * 1024
+
+words = (
+    "the model answer *bold* `code` list item function return value data "
+    "request response engine user message conversation Telegram Lambda "
+    "пример ответа текст перевод język odpowiedź tekst"
+).split()
+
+
+class MemoryS3:
+    def __init__(self) -> None:
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key):
+        body = self.objects[(Bucket, Key)]
+        return {"Body": StreamingBody(io.BytesIO(body), len(body))}
+
+
+def sample(size: int, noise: float = 0.0) -> str:
+    rnd = random.Random(size)
+    # a pool of generated sentences keeps some repetition like real answers do
+    sentences = [" ".join(rnd.choices(words, k=rnd.randint(4, 16))) for _ in range(2000)]
+    lines = []
+    length = 0
+    while length < size:
+        line = rnd.choice(sentences)
+        if rnd.random() < 0.1:
+            line = f"{rnd.randint(1, 99)}\\. {line}"
+        if noise:
+            ids = rnd.choices(string.ascii_letters + string.digits, k=int(len(line) * noise))
+            line = f"| {''.join(ids)} | {line[: len(line) - len(ids)]} |"
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)[:size]
+
+
+def legacy_encode(text: str) -> str:
+    return base64.b64encode(zlib.compress(text.encode("utf-8"))).decode("ascii")
+
+
+def measure(encode, text: str) -> tuple:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encoded = encode(text)
+    encode_ms = (time.perf_counter() - start) * 1000 / repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        utils.decode_message(encoded)
+    decode_ms = (time.perf_counter() - start) * 1000 / repeat
+    return encoded, encode_ms, decode_ms
+
+
+def main() -> None:
+    s3 = MemoryS3()
+    s3_client = MagicMock(put_object=s3.put_object, get_object=s3.get_object)
+    print(
+        f"{'payload':<22}{'bytes':>9}{'legacy':>9}{'sns':>5}{'adaptive':>10}"
+        f"{'codec':>7}{'enc ms legacy/new':>20}{'dec ms legacy/new':>20}"
+    )
+    with patch.dict("engines.aws_clients._clients", {"s3": s3_client}):
+        for label, size, noise in corpus:
+            text = sample(size, noise)
+            raw = len(text.encode("utf-8"))
+            legacy, legacy_enc, legacy_dec = measure(legacy_encode, text)
+            adaptive, enc_ms, dec_ms = measure(
+                lambda t: encode_message(t, bucket_name="bench"), text
+            )
+            fits = "ok" if len(legacy) < sns_limit else "FAIL"
+            codec = adaptive.split(":", 1)[0]
+            print(
+                f"{label:<22}{raw:>9}{len(legacy):>9}{fits:>5}{len(adaptive):>10}"
+                f"{codec:>7}{legacy_enc:>11.2f}/{enc_ms:<8.2f}"
+                f"{legacy_dec:>11.2f}/{dec_ms:<8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
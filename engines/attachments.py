@@ -0,0 +1,87 @@
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, NamedTuple, Optional
+from urllib.parse import urlparse
+
+from .aws_clients import client
+from .mime_types import mime_types
+
+# per request, the SQS batch workers run their requests in parallel too
+max_attachment_workers = 4
+
+
+class Attachment(NamedTuple):
+    ref: str
+    value: Any = None
+    error: Optional[Exception] = None
+
+
+def attachment_refs(payload: dict) -> list:
+    """S3 references of the files attached to a request, in the order sent."""
+    refs = payload.get("files") or []
+    if payload.get("file") and payload["file"] not in refs:
+        refs = [payload["file"]] + refs
+    return refs
+
+
+def get_content_type(file_path: str) -> str:
+    extension = os.path.splitext(file_path)[-1].lower()
+    return mime_types.get(extension, "application/octet-stream")
+
+
+def download_attachment(s3_uri: str, bucket_name: str) -> str:
+    """Downloads an attachment from the 'att/' prefix into a temp directory of its own.
+
+    The file keeps its name, concurrent downloads of the same name do not collide.
+    """
+    key = urlparse(s3_uri).path.lstrip("/")
+    file_name = key.split("/")[-1]
+    tmp_file = os.path.join(tempfile.mkdtemp(), file_name)
+    logging.info(f"Downloading file '{key}' from s3 bucket {bucket_name}")
+    try:
+        client("s3").download_file(Bucket=bucket_name, Key=key, Filename=tmp_file)
+    except Exception:
+        remove_attachment(tmp_file)
+        raise
+    return tmp_file
+
+
+def remove_attachment(tmp_file: str) -> None:
+    shutil.rmtree(os.path.dirname(tmp_file), ignore_errors=True)
+
+
+def process_attachments(
+    refs: list,
+    bucket_name: str,
+    handler: Callable[[str, str], Any],
+    max_workers: int = max_attachment_workers,
+) -> list:
+    """Downloads attachments and passes them to `handler(tmp_file, content_type)`.
+
+    Files are processed concurrently, the temp files are removed once handled.
+    Returns an Attachment per reference in the original order, with either the
+    value returned by the handler or the error of that file only.
+    """
+    if not refs:
+        return []
+
+    def process(ref: str) -> Any:
+        tmp_file = download_attachment(ref, bucket_name)
+        try:
+            return handler(tmp_file, get_content_type(ref))
+        finally:
+            remove_attachment(tmp_file)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(refs))) as pool:
+        futures = [pool.submit(process, ref) for ref in refs]
+    attachments = []
+    for ref, future in zip(refs, futures):
+        try:
+            attachments.append(Attachment(ref=ref, value=future.result()))
+        except Exception as e:
+            logging.error(f"Cannot process attachment {ref}", exc_info=e)
+            attachments.append(Attachment(ref=ref, error=e))
+    return attachments
@@ -0,0 +1,123 @@
+import threading
+import time
+from typing import Any
+
+import boto3.session
+from botocore.config import Config
+
+from .metrics import put_metrics
+
+# AWS clients shared by all requests of a container, for engines and the bot.
+# Clients are thread safe once created; creating them and resource objects is not.
+connect_timeout = 2
+read_timeout = 30
+# services moving files or waiting on long polls
+read_timeouts = {"s3": 60, "logs": 60}
+max_pool_connections = 20
+max_attempts = 4
+
+_session = None
+_clients: dict = {}
+_dynamodb = None
+_lock = threading.Lock()
+# service -> [calls, errors, total ms, max ms]
+_stats: dict = {}
+_stats_lock = threading.Lock()
+
+
+def client(service: str) -> Any:
+    """The container-wide client of `service`, created on the first use."""
+    existing = _clients.get(service)
+    if existing is not None:
+        return existing
+    with _lock:
+        if service not in _clients:
+            _clients[service] = __instrument(
+                service, __get_session().client(service, config=__config(service))
+            )
+        return _clients[service]
+
+
+def table(name: str) -> Any:
+    """A table of the container-wide DynamoDB resource, calls go through its pooled client."""
+    global _dynamodb
+    with _lock:
+        if _dynamodb is None:
+            _dynamodb = __get_session().resource("dynamodb", config=__config("dynamodb"))
+            __instrument("dynamodb", _dynamodb.meta.client)
+        return _dynamodb.Table(name)
+
+
+def call_stats() -> dict:
+    """Calls, errors and latency per service since the last `put_call_metrics`."""
+    with _stats_lock:
+        return {
+            service: {"calls": calls, "errors": errors, "total_ms": total, "max_ms": longest}
+            for service, (calls, errors, total, longest) in _stats.items()
+        }
+
+
+def put_call_metrics() -> None:
+    """Writes the per-service call metrics collected so far and starts counting anew."""
+    with _stats_lock:
+        stats = dict(_stats)
+        _stats.clear()
+    for service, (calls, errors, total, longest) in stats.items():
+        put_metrics(
+            {
+                "AwsCalls": (calls, "Count"),
+                "AwsCallErrors": (errors, "Count"),
+                "AwsCallLatency": (int(total / calls), "Milliseconds"),
+                "AwsCallMaxLatency": (int(longest), "Milliseconds"),
+            },
+            service=service,
+        )
+
+
+def __get_session() -> Any:
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+
+def __config(service: str) -> Config:
+    return Config(
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeouts.get(service, read_timeout),
+        max_pool_connections=max_pool_connections,
+        tcp_keepalive=True,
+        retries={"mode": "adaptive", "total_max_attempts": max_attempts},
+    )
+
+
+def __instrument(service: str, aws_client: Any) -> Any:
+    def before_call(context: dict, **kwargs) -> None:
+        context["started"] = time.perf_counter()
+
+    def after_call(context: dict, parsed: Any = None, **kwargs) -> None:
+        # error responses are parsed first and raised as ClientError after this event
+        __record(service, context, error=bool((parsed or {}).get("Error")))
+
+    def after_call_error(context: dict, **kwargs) -> None:
+        __record(service, context, error=True)
+
+    events = aws_client.meta.events
+    # ahead of handlers answering the call themselves, like stubs in tests
+    events.register_first("before-call.*.*", before_call)
+    events.register("after-call.*.*", after_call)
+    events.register("after-call-error.*.*", after_call_error)
+    return aws_client
+
+
+def __record(service: str, context: dict, error: bool) -> None:
+    started = context.get("started")
+    if started is None:
+        return
+    elapsed = (time.perf_counter() - started) * 1000
+    with _stats_lock:
+        stats = _stats.setdefault(service, [0, 0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += int(error)
+        stats[2] += elapsed
+        stats[3] = max(stats[3], elapsed)
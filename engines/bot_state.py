@@ -0,0 +1,84 @@
+import logging
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+from .aws_clients import table
+
+# caches, claims, leases and other short-lived state, kept apart from the
+# tracked jobs of 'request-jobs'
+table_name = "bot-state"
+lease_duration = 30
+lease_poll_interval = 0.5
+
+
+def state_key(kind: str, state_id: str) -> dict:
+    """The key of a 'bot-state' row, the sort key tells what the row is.
+
+    kind         state_id
+    album        Telegram media group ID
+    image        engine and hash of the prompt and model parameters
+    lease        name of the leased resource
+    race         Telegram update ID
+    response     hash of the prompt, engine, model and style
+    stream       chat ID, message ID and engine
+    translation  sentence hash, engine, source and target language
+    upload       engine, conversation ID and file hash
+
+    Every row expires through the 'exp' TTL attribute.
+    """
+    return {"state_id": state_id, "kind": kind}
+
+
+class Lease:
+    """A lease held by at most one container at a time.
+
+    An expired lease is taken over, so a crashed holder blocks the others for
+    `duration` seconds at most. The TTL attribute removes abandoned rows.
+    """
+
+    def __init__(self, name: str, duration: int = lease_duration):
+        self.name = name
+        self.key = state_key("lease", name)
+        self.duration = duration
+        self.owner = str(uuid.uuid4())
+        self.state_table = table(table_name)
+
+    def acquire(self) -> bool:
+        now = int(time.time())
+        try:
+            self.state_table.put_item(
+                Item={**self.key, "owner": self.owner, "exp": now + self.duration},
+                ConditionExpression="attribute_not_exists(state_id) OR #exp < :now",
+                ExpressionAttributeNames={"#exp": "exp"},
+                ExpressionAttributeValues={":now": now},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                logging.info(f"Lease '{self.name}' is held by another container")
+                return False
+            raise
+        return True
+
+    def release(self) -> None:
+        try:
+            self.state_table.delete_item(
+                Key=self.key,
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={"#owner": "owner"},
+                ExpressionAttributeValues={":owner": self.owner},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            logging.info(f"Lease '{self.name}' was taken over after expiry")
+
+    def wait(self) -> None:
+        """Waits until the lease is released or expires."""
+        deadline = time.time() + self.duration
+        while time.time() < deadline:
+            item = self.state_table.get_item(Key=self.key, ConsistentRead=True).get("Item")
+            if not item or item["exp"] < time.time():
+                return
+            time.sleep(lease_poll_interval)
@@ -1,30 +1,39 @@
 import json
 import logging
 import os
-import time
 import uuid
-from typing import Any
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Optional
 
-import boto3
-import boto3.session
-from curl_cffi import requests
-from requests_toolbelt import MultipartEncoder
+from curl_cffi import CurlMime
 
+from .aws_clients import client
 from .common_utils import (
     encode_message,
     escape_markdown_v2,
-    get_s3_file,
     read_json_from_s3,
     read_ssm_param,
 )
-from .mime_types import mime_types
+from .attachments import attachment_refs
+from .attachments import process_attachments as process_files
+from .claude_credentials import ClaudeCredentials, Credentials, unauthorized_statuses
+from .http_sessions import SessionPool
+from .race import Race, RaceLost, race_for
+from .sqs_batch import process_records
+from .streaming import ResultStream
+from .upload_cache import UploadCache, file_digest
 from .user_context import UserContext
 
 logging.basicConfig()
 logging.getLogger().setLevel("INFO")
 engine_type = "claude"
-request_timeout = 600
-base_url = "https://claude.ai"
+browser_version = "chrome110"
+# a single call finishes well within the 5 minute timeout of the Lambda
+request_timeout = 240
+title_timeout = 10
+cookies_file = "claude-cookies.json"
+base_url = os.environ.get("CLAUDE_BASE_URL", "https://claude.ai")
+conversations_path = "/api/organizations/{organization_id}/chat_conversations"
 headers = {
     "Origin": f"{base_url}",
     "Referer": f"{base_url}/chats",
@@ -53,179 +62,211 @@ def process_command(input: str, context: UserContext) -> None:
     logging.error(f"Unknown command {command}")
 
 
-def get_content_type(file_path) -> str:
-    extension = os.path.splitext(file_path)[-1].lower()
-    return mime_types.get(extension, "application/octet-stream")
-
-
 def upload_attachment(tmp_file: str, content_type: str) -> Any:
-    file_name = os.path.basename(tmp_file)
-    m = MultipartEncoder(
-        fields={
-            "file": (file_name, open(tmp_file, "rb"), content_type),
-            "orgUuid": (None, organization_id),
-        }
-    )
-    url = f"{base_url}/api/{organization_id}/upload"
-    req_headers = dict(headers)
-    req_headers["Content-Type"] = m.content_type
-    response = requests.post(
-        url,
-        headers=req_headers,
-        impersonate="chrome110",
-        data=m.to_string(),
-        timeout=request_timeout,
-    )
-    logging.info(f"Uploaded file {tmp_file}, response '{response.status_code}'")
-    # os.remove(tmp_file)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        logging.error(f"POST upload returned {response.status_code} {response.reason}")
-        logging.info(response.content.decode("utf-8"))
-        logging.info(headers)
-        return None
+    return __post_file("/api/{organization_id}/upload", tmp_file, content_type)
 
 
 def convert_attachment(tmp_file: str, content_type: str) -> Any:
-    file_name = os.path.basename(tmp_file)
-    m = MultipartEncoder(
-        fields={
-            "file": (file_name, open(tmp_file, "rb"), content_type),
-            "orgUuid": (None, organization_id),
-        }
-    )
-    url = f"{base_url}/api/convert_document"
-    req_headers = dict(headers)
-    req_headers["Content-Type"] = m.content_type
-    response = requests.post(
-        url,
-        headers=req_headers,
-        impersonate="chrome110",
-        data=m.to_string(),
-        timeout=request_timeout,
+    return __post_file("/api/convert_document", tmp_file, content_type)
+
+
+def __post_file(path: str, tmp_file: str, content_type: str) -> Any:
+    """Posts the file as multipart form data, curl reads it from disk in chunks."""
+    multipart = CurlMime()
+    multipart.addpart(
+        "file",
+        content_type=content_type,
+        filename=os.path.basename(tmp_file),
+        local_path=tmp_file,
     )
+    multipart.addpart("orgUuid", data=credentials.get().organization_id.encode())
+    try:
+        response = __request(
+            "POST",
+            path,
+            # curl appends the boundary to the type
+            headers={"Content-Type": "multipart/form-data"},
+            multipart=multipart,
+            timeout=request_timeout,
+        )
+    finally:
+        multipart.close()
     logging.info(f"Uploaded file {tmp_file}, response '{response.status_code}'")
-    # os.remove(tmp_file)
     if response.status_code == 200:
         return response.json()
     else:
         logging.error(f"POST upload returned {response.status_code} {response.reason}")
         logging.info(response.content.decode("utf-8"))
-        logging.info(headers)
         return None
 
 
-def ask(context: UserContext, text: str, attachments=None, files=None):
+def ask(
+    context: UserContext,
+    text: str,
+    attachments=None,
+    files=None,
+    stream: Optional[ResultStream] = None,
+    race: Optional[Race] = None,
+):
     if "/ping" in text:
         return "pong"
 
-    conversation_uuid = context.conversation_id or __generate_uuid()
-    __set_conversation(conversation_id=conversation_uuid)
+    conversation_uuid = context.conversation_id
+    if conversation_uuid is None:
+        conversation_uuid = __generate_uuid()
+        __set_conversation(conversation_id=conversation_uuid)
+        # the title is generated while the answer is streamed, the answer does not wait for it
+        title_pool.submit(
+            __set_title, prompt=text, conversation_id=conversation_uuid
+        ).add_done_callback(__log_title_error)
     context.conversation_id = conversation_uuid
-    __set_title(prompt=text, conversation_id=conversation_uuid)
     payload = {
         "prompt": text,
         "timezone": "Europe/Warsaw",
         "attachments": attachments or [],
         "files": files or [],
     }
-    post_response = requests.post(
-        f"{base_url}/api/organizations/{organization_id}/chat_conversations/{conversation_uuid}/completion",
-        headers=headers,
-        data=json.dumps(payload),
-        impersonate="chrome110",
-        timeout=request_timeout,
-    )
-    if not post_response.ok:
-        logging.error(
-            f"POST request returned {post_response.status_code} {post_response.reason}"
+    # curl_cffi streams on a cloned curl handle, so unlike the other calls the
+    # completion opens its own connection
+    with sessions.session() as session:
+        response = __request(
+            "POST",
+            f"{conversations_path}/{conversation_uuid}/completion",
+            session=session,
+            headers={"Referer": f"{base_url}/chat/{conversation_uuid}"},
+            data=json.dumps(payload),
+            timeout=request_timeout,
+            stream=True,
         )
-        logging.info(post_response.content.decode("utf-8"))
-        logging.info(payload)
-
-    time.sleep(2)
-    response = requests.get(
-        f"{base_url}/api/organizations/{organization_id}/chat_conversations/{conversation_uuid}",
-        headers=headers,
-        impersonate="chrome110",
-        timeout=request_timeout,
-    )
-    if not response.ok:
-        logging.error(
-            f"GET request for conversation {conversation_uuid} returned {response.status_code} {response.reason}"
-        )
-        return response.text
-    decoded_data = response.content.decode("utf-8")
-    # logging.info(decoded_data)
-    data = json.loads(decoded_data)
-    last = data["chat_messages"][-1]
-    return escape_markdown_v2(last["text"])
-
-
-def process_attachments(attachments: str) -> tuple:
+        try:
+            if not response.ok:
+                logging.error(
+                    f"POST request returned {response.status_code} {response.reason}"
+                )
+                logging.info(response.content.decode("utf-8"))
+                logging.info(payload)
+                raise Exception(
+                    f"Completion for conversation {conversation_uuid} failed with {response.status_code}"
+                )
+            answer = __read_completion(response, stream, race)
+        finally:
+            response.close()
+    return escape_markdown_v2(answer)
+
+
+def __read_completion(
+    response: Any, stream: Optional[ResultStream], race: Optional[Race] = None
+) -> str:
+    """Collects the answer from the text/event-stream of a completion request."""
+    answer = []
+    for line in response.iter_lines():
+        if race:
+            # closing the response stops the generation
+            race.check()
+        if not line or not line.startswith(b"data:"):
+            continue
+        data = json.loads(line[len(b"data:"):])
+        event_type = data.get("type")
+        if event_type == "completion":
+            delta = data.get("completion", "")
+        elif event_type == "content_block_delta":
+            delta = data.get("delta", {}).get("text", "")
+        elif event_type == "error":
+            raise Exception(f"Completion stream error: {data.get('error', data)}")
+        elif event_type == "message_stop":
+            break
+        else:
+            continue
+        if delta:
+            answer.append(delta)
+            if stream:
+                stream.append(delta)
+        if data.get("stop_reason"):
+            break
+    return "".join(answer)
+
+
+def process_attachments(attachments: str | list, uploads: Optional[UploadCache] = None) -> tuple:
+    """Prepares the attached files for a completion request.
+
+    Returns the converted documents, the uploaded file IDs and the names of
+    the files that could not be processed and are left out.
+    """
+    refs = [attachments] if isinstance(attachments, str) else attachments
+    refs = [ref for ref in refs or [] if ref]
+    if not refs:
+        return ([], [], [])
+    logging.info(f"Processing attachments {refs}")
+    uploads = uploads or UploadCache(engine_id=engine_type, conversation_id=None)
     attachment_response = []
     other_files = []
-    if attachments:
-        logging.info("Uploading attachments")
-        logging.info(attachments)
-        tmp_file_name = get_s3_file(attachments, bucket_name)
-        if tmp_file_name is None:
-            logging.info(f"Cannot get attached file {attachments} from s3 bucket {bucket_name}")
-            raise Exception(f"Error when getting {attachments}")
-        logging.info(f"Uploads saved to {tmp_file_name}")
-        content_type = get_content_type(tmp_file_name)
-        if "image/" in content_type:
+    failed = []
+    for attachment in process_files(
+        refs=refs,
+        bucket_name=bucket_name,
+        handler=lambda tmp_file, content_type: __process_file(tmp_file, content_type, uploads),
+    ):
+        if attachment.value is None:
+            failed.append(attachment.ref.split("/")[-1])
+            continue
+        kind, value = attachment.value
+        if kind == "file":
+            other_files.append(value)
+        else:
+            attachment_response.append(value)
+    return (attachment_response, other_files, failed)
+
+
+def __process_file(tmp_file_name: str, content_type: str, uploads: UploadCache) -> Optional[tuple]:
+    if "text/" in content_type:
+        file_size = os.path.getsize(tmp_file_name)
+        logging.info(f"Reading text content of mimetype {content_type} of size {file_size}")
+        with open(tmp_file_name, "r", encoding="utf-8") as file:
+            file_content = file.read()
+        return (
+            "attachment",
+            {
+                "file_name": os.path.basename(tmp_file_name),
+                "file_type": "text/plain",
+                "file_size": file_size,
+                "extracted_content": file_content,
+            },
+        )
+    digest = file_digest(tmp_file_name)
+    cached = uploads.get(digest)
+    if "image/" in content_type:
+        file_uuid = cached
+        if file_uuid is None:
             logging.info(f"Uploading attachment of mimetype {content_type}")
             upload_response = upload_attachment(
                 tmp_file=tmp_file_name, content_type=content_type
             )
-            if upload_response:
-                logging.info(f"Upload response: {upload_response}")
-                other_files.append(upload_response["file_uuid"])
-            else:
-                logging.error("File uploads failed")
-        elif "text/" in content_type:
-            file_size = os.path.getsize(tmp_file_name)
-            logging.info(
-                f"Reading text content of mimetype {content_type} of size {file_size}"
-            )
-            with open(tmp_file_name, "r", encoding="utf-8") as file:
-                file_content = file.read()
-            attachment_response.append(
-                {
-                    "file_name": tmp_file_name,
-                    "file_type": "text/plain",
-                    "file_size": file_size,
-                    "extracted_content": file_content,
-                }
-            )
-        else:
-            logging.info(f"Converting attachment of mimetype {content_type}")
-            uploaded = convert_attachment(
-                tmp_file=tmp_file_name, content_type=content_type
-            )
-            if uploaded:
-                attachment_response.append(uploaded)
-            else:
-                logging.error("Converting attachment failed")
-    return (attachment_response, other_files)
+            if not upload_response:
+                raise Exception(f"Uploading {os.path.basename(tmp_file_name)} failed")
+            logging.info(f"Upload response: {upload_response}")
+            file_uuid = upload_response["file_uuid"]
+            uploads.put(digest, file_uuid)
+        return ("file", file_uuid)
+    uploaded = cached
+    if uploaded is None:
+        logging.info(f"Converting attachment of mimetype {content_type}")
+        uploaded = convert_attachment(tmp_file=tmp_file_name, content_type=content_type)
+        if not uploaded:
+            raise Exception(f"Converting {os.path.basename(tmp_file_name)} failed")
+        uploads.put(digest, uploaded)
+    return ("attachment", uploaded)
 
 
 def __set_conversation(conversation_id: str) -> None:
     logging.info(f"conversation_id: {conversation_id}")
-    url = f"{base_url}/api/organizations/{organization_id}/chat_conversations"
     payload = json.dumps({"uuid": conversation_id, "name": ""})
-    response = requests.post(
-        url, headers=headers, data=payload, impersonate="chrome110"
-    )
+    response = __request("POST", conversations_path, data=payload, timeout=request_timeout)
     if not response.ok:
         logging.info(f"http status {response.status_code}")
         e = f"Cannot create a chat. Request returned {response.status_code}"
         logging.error(e)
         raise Exception(e)
     logging.info(f"Claude conversation has been reset. New ID {conversation_id}")
-    headers["Referer"] = f"{base_url}/chat/{conversation_id}"
 
 
 def __generate_uuid() -> str:
@@ -236,14 +277,42 @@ def __generate_uuid() -> str:
     return formatted_uuid
 
 
-def __get_organization():
+def __request(method: str, path: str, session: Any = None, **kwargs) -> Any:
+    """Sends a request with the cached credentials, reloading them once if rejected.
+
+    `{organization_id}` in the path is replaced with the current organization.
+    """
+    auth = credentials.get()
+    response = __send(method, path, auth, session, **kwargs)
+    if response.status_code in unauthorized_statuses:
+        logging.warning(f"{method} {path} returned {response.status_code}, reloading credentials")
+        response.close()
+        auth = credentials.refresh(stale=auth)
+        response = __send(method, path, auth, session, **kwargs)
+    return response
+
+
+def __send(method: str, path: str, auth: Credentials, session: Any, **kwargs) -> Any:
+    url = base_url + path.format(organization_id=auth.organization_id)
+    return (session or sessions).request(method, url, cookies=auth.cookies, **kwargs)
+
+
+def __load_cookies() -> dict:
+    cookies = read_json_from_s3(bucket_name, cookies_file)
+    if cookies is None:
+        logging.error(f"Cannot read {cookies_file} from s3 bucket {bucket_name}")
+        return {}
+    logging.info(f"Read {len(cookies)} cookies from s3")
+    return {cookie["name"]: cookie["value"] for cookie in cookies}
+
+
+def __get_organization(cookies: dict) -> str:
     url = f"{base_url}/api/organizations"
-    response = requests.get(url, headers=headers, impersonate="chrome110")
+    response = sessions.get(url, cookies=cookies, timeout=title_timeout)
     if not response.ok:
-        logging.error(
-            f"Cannot get organizationID.{response.status_code} {response.reason} {response.text}"
-        )
-        logging.info(headers)
+        e = f"Cannot get organizationID. {response.status_code} {response.reason} {response.text}"
+        logging.error(e)
+        raise Exception(e)
     res = json.loads(response.text)
     uuid = res[0]["uuid"]
     logging.info(f"Got organisationID '{uuid}'")
@@ -251,15 +320,16 @@ def __get_organization():
 
 
 def __set_title(prompt: str, conversation_id: str) -> str:
+    """Names the conversation in the claude.ai UI, not required for answering."""
     payload = {
         "message_content": prompt,
         "recent_titles": [],
     }
-    response = requests.post(
-        url=f"{base_url}/api/organizations/{organization_id}/chat_conversations/{conversation_id}/title",
-        headers=headers,
+    response = __request(
+        "POST",
+        f"{conversations_path}/{conversation_id}/title",
         data=json.dumps(payload),
-        impersonate="chrome110",
+        timeout=title_timeout,
     )
     if not response.ok:
         logging.error(response.text)
@@ -269,18 +339,20 @@ def __set_title(prompt: str, conversation_id: str) -> str:
     return title
 
 
+def __log_title_error(future: Future) -> None:
+    if future.exception() is not None:
+        logging.error("Cannot set the conversation title", exc_info=future.exception())
+
+
 bucket_name = read_ssm_param(param_name="BOT_S3_BUCKET")
-cookies = read_json_from_s3(bucket_name, "claude-cookies.json")
-if cookies is not None:
-    logging.info(f"Read {len(cookies)} cookies from s3")
-    cookies_str = ""
-    for cookie_data in cookies:
-        cookies_str += f"{cookie_data['name']}={cookie_data['value']};"
-    headers["Cookie"] = cookies_str
-organization_id = __get_organization()
+sessions = SessionPool(name=engine_type, impersonate=browser_version, headers=headers)
+# titles outlive the request that asked for them, a frozen container finishes them when thawed
+title_pool = ThreadPoolExecutor(max_workers=2)
+# loaded on the first request and reloaded when claude.ai rejects the cookies
+credentials = ClaudeCredentials(load_cookies=__load_cookies, get_organization=__get_organization)
 
 result_topic = read_ssm_param(param_name="RESULT_SNS_TOPIC_ARN")
-sns = boto3.session.Session().client("sns")
+sns = client("sns")
 
 
 def process_payload(payload: Any, request_id: str) -> None:
@@ -294,19 +366,56 @@ def process_payload(payload: Any, request_id: str) -> None:
     if "command" in payload["type"]:
         process_command(input=payload["text"], context=user_context)
         return
-    attachments_tuple = process_attachments(attachments=payload.get("file", None))
-    response = ask(
-        context=user_context,
-        text=payload["text"],
-        attachments=attachments_tuple[0],
-        files=attachments_tuple[1],
-    )
+    uploads = UploadCache(engine_id=engine_type, conversation_id=user_context.conversation_id)
+    attachments_tuple = process_attachments(attachments=attachment_refs(payload), uploads=uploads)
+    race = race_for(payload, engine_type)
+    stream = None
+    # racing answers are delivered whole, the losers must not leave partial messages
+    if payload.get("config", {}).get("stream", False) and race is None:
+        stream = ResultStream(
+            sns=sns,
+            topic_arn=result_topic,
+            payload=payload,
+            engine=engine_type,
+            formatter=escape_markdown_v2,
+        )
+        stream.start()
+    try:
+        response = ask(
+            context=user_context,
+            text=payload["text"],
+            attachments=attachments_tuple[0],
+            files=attachments_tuple[1],
+            stream=stream,
+            race=race,
+        )
+    except RaceLost as e:
+        logging.info(str(e))
+        return
+    except Exception as e:
+        if stream is None:
+            raise
+        # the finished stream cannot be edited by a retry, the user is asked to ask again
+        logging.error(f"Streamed answer to {payload['message_id']} failed", exc_info=e)
+        stream.fail()
+        return
+    if race and not race.claim():
+        return
+    if attachments_tuple[2]:
+        # the answer is given without them, the user should know why
+        files = ", ".join(attachments_tuple[2])
+        response = escape_markdown_v2(f"Cannot read the attached {files}\n\n") + response
+    if stream:
+        stream.close(response)
+    else:
+        payload["response"] = encode_message(response)
+        payload["engine"] = engine_type
+        sns.publish(TopicArn=result_topic, Message=json.dumps(payload))
+    # persisted after the answer is sent, the user does not wait for the writes
     user_context.save_conversation(
         conversation={"request": payload["text"], "response": response},
     )
-    payload["response"] = encode_message(response)
-    payload["engine"] = engine_type
-    sns.publish(TopicArn=result_topic, Message=json.dumps(payload))
+    uploads.save(conversation_id=user_context.conversation_id)
 
 
 def sns_handler(event, context):
@@ -316,3 +425,14 @@ def sns_handler(event, context):
     for record in event["Records"]:
         payload = json.loads(record["Sns"]["Message"])
         process_payload(payload, request_id)
+
+
+def sqs_handler(event, context):
+    """AWS SQS event handler, every message is a request of its own"""
+    logging.info(f"Request ID: {context.aws_request_id}")
+    return process_records(
+        records=event["Records"],
+        handler=process_payload,
+        context=context,
+        time_margin=request_timeout + title_timeout,
+    )
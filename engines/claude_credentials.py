@@ -0,0 +1,61 @@
+import logging
+import threading
+import time
+from typing import Callable, NamedTuple, Optional
+
+# cookies rotated in s3 are picked up within this time even without a rejected request
+credentials_ttl = 15 * 60
+unauthorized_statuses = (401, 403)
+
+
+class Credentials(NamedTuple):
+    cookies: dict
+    organization_id: str
+    expires_at: float
+
+
+class ClaudeCredentials:
+    """The claude.ai session cookies and organization ID, cached between requests.
+
+    Credentials are loaded on first use and reloaded when expired or rejected, so
+    a warm container survives a cookie rotation. Concurrent requests rejected with
+    the same credentials trigger a single reload.
+    """
+
+    def __init__(
+        self,
+        load_cookies: Callable[[], dict],
+        get_organization: Callable[[dict], str],
+        ttl: float = credentials_ttl,
+    ) -> None:
+        self.load_cookies = load_cookies
+        self.get_organization = get_organization
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.current: Optional[Credentials] = None
+
+    def get(self) -> Credentials:
+        current = self.current
+        if current is not None and current.expires_at > time.monotonic():
+            return current
+        return self.refresh(stale=current)
+
+    def refresh(self, stale: Optional[Credentials]) -> Credentials:
+        """Reloads the credentials unless another request already replaced `stale`."""
+        with self.lock:
+            current = self.current
+            if (
+                current is not None
+                and current is not stale
+                and current.expires_at > time.monotonic()
+            ):
+                return current
+            cookies = self.load_cookies()
+            organization_id = self.get_organization(cookies)
+            self.current = Credentials(
+                cookies=cookies,
+                organization_id=organization_id,
+                expires_at=time.monotonic() + self.ttl,
+            )
+            logging.info(f"Loaded {len(cookies)} cookies of organization '{organization_id}'")
+            return self.current
@@ -2,31 +2,42 @@ import base64
 import json
 import logging
 import re
+import uuid
 import zlib
 from pathlib import Path
 from typing import Any, Optional
 from urllib.parse import urlparse
 
-import boto3
+import zstandard
+
+from .aws_clients import client
 
 logging.basicConfig()
 logging.getLogger().setLevel("INFO")
 esc_pattern = re.compile(f"(?<!\\|)([{re.escape(r'.-+#|{}!=()<>')}])(?!\\|)")
 
+# Result payloads are tagged with the codec used: "n" plain text, "z" zlib,
+# "zs" zstd, "s3" a reference to the compressed body in the bot bucket.
+# Untagged payloads are the legacy zlib+base64 format.
+plain_size_limit = 1024
+zstd_size_threshold = 16 * 1024
+# SNS rejects messages above 256 KB, the rest of the envelope needs some room
+s3_size_threshold = 200 * 1024
+zstd_level = 9
+results_prefix = "results"
+_results_bucket = None
+
 
 def read_ssm_param(param_name: str) -> str:
-    ssm_client = boto3.client(service_name="ssm")
-    return ssm_client.get_parameter(Name=param_name)["Parameter"]["Value"]
+    return client("ssm").get_parameter(Name=param_name)["Parameter"]["Value"]
 
 
 def write_ssm_param(param_name: str, value: str) -> None:
-    ssm_client = boto3.client(service_name="ssm")
-    ssm_client.put_parameter(Name=param_name, Value=value, Type="String", Overwrite=True)
+    client("ssm").put_parameter(Name=param_name, Value=value, Type="String", Overwrite=True)
 
 
 def read_json_from_s3(bucket_name: str, file_name: str) -> Optional[Any]:
-    s3 = boto3.client("s3")
-    response = s3.get_object(Bucket=bucket_name, Key=file_name)
+    response = client("s3").get_object(Bucket=bucket_name, Key=file_name)
     body = response.get("Body", None)
     if not body:
         return None
@@ -42,13 +53,32 @@ def json_cookies_to_header_string(cookies_json: Any):
 
 
 def save_to_s3(bucket_name: str, file_name: str, value: Any) -> None:
-    s3 = boto3.client("s3")
-    s3.put_object(Bucket=bucket_name, Key=file_name, Body=json.dumps(value))
-
-
-def encode_message(text: str) -> str:
-    zipped = zlib.compress(text.encode("utf-8"))
-    return base64.b64encode(zipped).decode("ascii")
+    client("s3").put_object(Bucket=bucket_name, Key=file_name, Body=json.dumps(value))
+
+
+def encode_message(text: str, bucket_name: Optional[str] = None) -> str:
+    data = text.encode("utf-8")
+    if len(data) < plain_size_limit:
+        return f"n:{text}"
+    if len(data) < zstd_size_threshold:
+        codec, packed = "z", zlib.compress(data)
+    else:
+        codec, packed = "zs", zstandard.ZstdCompressor(level=zstd_level).compress(data)
+    encoded = base64.b64encode(packed).decode("ascii")
+    if len(encoded) < s3_size_threshold:
+        return f"{codec}:{encoded}"
+    bucket_name = bucket_name or __get_results_bucket()
+    key = f"{results_prefix}/{uuid.uuid4()}.{codec}"
+    logging.info(f"Offloading {len(packed)} bytes of result to s3 {bucket_name}/{key}")
+    client("s3").put_object(Bucket=bucket_name, Key=key, Body=packed)
+    return f"s3:{codec}:{bucket_name}/{key}"
+
+
+def __get_results_bucket() -> str:
+    global _results_bucket
+    if _results_bucket is None:
+        _results_bucket = read_ssm_param(param_name="BOT_S3_BUCKET")
+    return _results_bucket
 
 
 def escape_markdown_v2(text: str) -> str:
@@ -58,13 +88,13 @@ def escape_markdown_v2(text: str) -> str:
 def get_s3_file(s3_uri: str | None, bucket_name: str) -> Optional[str]:
     if not s3_uri:
         return None
-    file_name = urlparse(s3_uri).path.split("/")[-1]
-    logging.info(f"Downloading file 'att/{file_name}' from s3 bucket {bucket_name}")
+    key = urlparse(s3_uri).path.lstrip("/")
+    file_name = key.split("/")[-1]
+    logging.info(f"Downloading file '{key}' from s3 bucket {bucket_name}")
     tmp_file = f"/tmp/{file_name}"
-    session = boto3.Session()
-    session.client("s3").download_file(
+    client("s3").download_file(
         Bucket=bucket_name,
-        Key=f"att/{file_name}",
+        Key=key,
         Filename=tmp_file,
     )
     if not (img := Path(tmp_file)).exists():
@@ -0,0 +1,62 @@
+import json
+import logging
+from typing import Any
+
+import zstandard
+
+from .aws_clients import client
+from .common_utils import read_ssm_param
+
+logging.basicConfig()
+logging.getLogger().setLevel("INFO")
+
+# Exchanges in 'user-conversations' are stored as one of:
+#   "conversation" - plain JSON, for short exchanges and items written before
+#   "body"         - zstd compressed JSON, binary
+#   "body_ref"     - "bucket/key" of the compressed JSON in s3
+# compressing an exchange smaller than a write unit saves nothing
+compress_threshold = 1024
+# the item is billed per KB on the table and on both ALL-projected indexes and
+# is limited to 400 KB, larger bodies go to s3; 64 KB still fits the persist queue
+offload_threshold = 64 * 1024
+zstd_level = 9
+conversations_prefix = "conversations"
+# the attributes to project when the exchange itself is needed
+body_attributes = "conversation, body, body_ref"
+
+_bucket = None
+
+
+def pack_conversation(conversation: Any, conversation_id: str, request_id: str) -> dict:
+    """Returns the item attributes storing the exchange, offloading it to s3 if large."""
+    data = json.dumps(conversation).encode("utf-8")
+    if len(data) < compress_threshold:
+        return {"conversation": data.decode("utf-8")}
+    packed = zstandard.ZstdCompressor(level=zstd_level).compress(data)
+    if len(packed) < offload_threshold:
+        return {"body": packed}
+    bucket = __get_bucket()
+    key = f"{conversations_prefix}/{conversation_id}/{request_id}.zs"
+    logging.info(f"Offloading {len(packed)} bytes of conversation to s3 {bucket}/{key}")
+    client("s3").put_object(Bucket=bucket, Key=key, Body=packed)
+    return {"body_ref": f"{bucket}/{key}"}
+
+
+def unpack_conversation(item: dict) -> Any:
+    """Reads the exchange of an item, from s3 only when it was offloaded."""
+    if "conversation" in item:
+        return json.loads(item["conversation"])
+    if "body_ref" in item:
+        bucket, _, key = item["body_ref"].partition("/")
+        packed = client("s3").get_object(Bucket=bucket, Key=key)["Body"].read()
+    else:
+        # boto3 returns binary attributes wrapped in Binary
+        packed = getattr(item["body"], "value", item["body"])
+    return json.loads(zstandard.ZstdDecompressor().decompress(packed))
+
+
+def __get_bucket() -> str:
+    global _bucket
+    if _bucket is None:
+        _bucket = read_ssm_param(param_name="BOT_S3_BUCKET")
+    return _bucket
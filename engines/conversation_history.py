@@ -0,0 +1,57 @@
+from typing import Iterable, Optional
+
+# rough estimate for mixed natural language and code, good enough for budgeting
+chars_per_token = 4
+# sort key of the rolling summary item stored next to the conversation turns
+summary_request_id = "summary"
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text or "") // chars_per_token + 1
+
+
+def turn_tokens(turn: dict) -> int:
+    return estimate_tokens(turn["request"]) + estimate_tokens(turn["response"])
+
+
+def total_tokens(turns: Iterable[dict]) -> int:
+    return sum(turn_tokens(turn) for turn in turns)
+
+
+def select_turns(turns: list, budget: int, pinned: int = 1) -> list:
+    """Selects conversation turns fitting into the token budget.
+
+    The first `pinned` turns are kept since they usually set up the task, the
+    rest of the budget goes to the most recent turns. Turns are expected and
+    returned in chronological order.
+    """
+    head = turns[:pinned]
+    used = total_tokens(head)
+    if used > budget:
+        head, used = [], 0
+    tail = []
+    for turn in reversed(turns[len(head):]):
+        cost = turn_tokens(turn)
+        if used + cost > budget:
+            break
+        tail.append(turn)
+        used += cost
+    return head + tail[::-1]
+
+
+def with_summary(summary: Optional[dict], history: list) -> list:
+    """Replaces turns folded into the rolling summary with the summary itself.
+
+    The summary is returned as the first turn, so it is the one kept pinned.
+    """
+    if not summary:
+        return history
+    recent = [turn for turn in history if turn["timestamp"] >= summary["summarized_until"]]
+    summary_turn = {
+        # a new summary must not match a context cache created for the previous one
+        "request_id": f"{summary_request_id}_{summary['summarized_until']}",
+        "timestamp": summary["summarized_until"],
+        "request": f"Summary of our conversation so far:\n{summary['summary']}",
+        "response": "Understood, I will take it into account.",
+    }
+    return [summary_turn] + recent
@@ -1,45 +1,395 @@
 import json
 import logging
-from typing import Any
+import os
+import random
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
 
-import boto3
-from deepl import Translator
+from curl_cffi import CurlMime
+from deepl import (
+    DeepLException,
+    DocumentHandle,
+    QuotaExceededException,
+    TooManyRequestsException,
+    Translator,
+)
+from deepl.util import auth_key_is_free_account
 
-from .common_utils import encode_message, escape_markdown_v2, read_ssm_param
+from .attachments import download_attachment, get_content_type, remove_attachment
+from .aws_clients import client
+from .common_utils import (
+    encode_message,
+    escape_markdown_v2,
+    read_ssm_param,
+    results_prefix,
+)
+from .http_sessions import SessionPool
+from .metrics import put_metrics
+from .sqs_batch import process_records
+from .translation_memory import TranslationMemory, sentence_hash, split_sentences
 
 logging.basicConfig()
 logging.getLogger().setLevel("INFO")
 
+engine_type = "DeepL"
+# the target of envelopes without languages, as in the chatbot
+default_language = "PL"
+max_language_workers = 4
+# the client retries 429 on its own, these attempts also cover 456
+translate_attempts = 3
+retry_base_delay = 1.0
+# DeepL accepts up to 50 texts and a 128 KiB body per translation request
+max_request_texts = 50
+max_request_size = 120 * 1024
+# the whole text is the context of its sentences up to that size, longer texts go without
+max_context_size = 32 * 1024
+document_queue_name = "DeepL-Document-Queue"
+document_upload_timeout = 120
+# status checks back off from the first delay, SQS delays messages up to 15 minutes
+document_check_delay = 5
+document_max_delay = 300
+document_max_checks = 20
 
 auth_key = read_ssm_param(param_name="DEEPL_AUTHKEY")
+server_url = os.environ.get("DEEPL_SERVER_URL") or (
+    "https://api-free.deepl.com"
+    if auth_key_is_free_account(auth_key)
+    else "https://api.deepl.com"
+)
 
-translator = Translator(auth_key)
+translator = Translator(auth_key, server_url=server_url)
+# documents are uploaded and downloaded by curl, the client of deepl keeps whole files in memory
+sessions = SessionPool(name="deepl", impersonate=None, timeout=document_upload_timeout)
 result_topic = read_ssm_param(param_name="RESULT_SNS_TOPIC_ARN")
-sns = boto3.session.Session().client("sns")
+bucket_name = read_ssm_param(param_name="BOT_S3_BUCKET")
+sns = client("sns")
+sqs = client("sqs")
+s3 = client("s3")
+_document_queue = None
 
 
 def __parse_languages(lang: str) -> list:
-    langs = lang.upper().split(",")
-    return langs
+    langs = [lang.strip() for lang in lang.upper().split(",")]
+    return [lang for lang in langs if lang]
 
-def __process_payload(payload: Any, request_id: str) -> None:
-    # logging.info(payload)
-    languages = __parse_languages(payload["languages"])
-    for lang in languages:
+
+def __retry(call: Callable[[], Any], lang: str) -> Any:
+    for attempt in range(translate_attempts):
         try:
-            response = translator.translate_text(
-                payload["text"].replace("/tr", ""), target_lang=lang.strip()
-            )
-            result = escape_markdown_v2(response.text)
+            return call()
+        except (TooManyRequestsException, QuotaExceededException) as e:
+            if attempt == translate_attempts - 1:
+                raise
+            delay = retry_base_delay * 2**attempt * random.uniform(0.5, 1.5)
+            logging.info(f"DeepL throttled {lang}: {e}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def __translate(texts: list, lang: str, context: Optional[str]) -> list:
+    return __retry(
+        lambda: translator.translate_text(texts, target_lang=lang, context=context), lang
+    )
+
+
+def __encoded_size(text: str) -> int:
+    # the client sends JSON with non-ASCII characters escaped
+    return len(json.dumps(text))
+
+
+def __chunks(texts: list, budget: int) -> list:
+    """Splits the texts into requests within the limits of DeepL."""
+    chunks = [[]]
+    size = 0
+    for text in texts:
+        text_size = __encoded_size(text)
+        if chunks[-1] and (len(chunks[-1]) == max_request_texts or size + text_size > budget):
+            chunks.append([])
+            size = 0
+        chunks[-1].append(text)
+        size += text_size
+    return chunks
+
+
+def __translate_language(parts: list, sentences: list, lang: str, known: dict) -> tuple:
+    """Translates the sentences missing in the memory and reassembles the text.
+
+    Returns the translation, the new memory entries and the billed characters.
+    """
+    translated = {}
+    misses = []
+    for sentence in sentences:
+        digest = sentence_hash(sentence)
+        if (digest, lang) in known:
+            translated[digest] = known[(digest, lang)]
+        else:
+            misses.append(sentence)
+    entries = []
+    billed = 0
+    if misses:
+        # the whole text is context for the sentences, DeepL does not bill it
+        context = " ".join(sentences) if len(sentences) > 1 else None
+        if context and __encoded_size(context) > max_context_size:
+            context = None
+        budget = max_request_size - (__encoded_size(context) if context else 0)
+        results = []
+        for chunk in __chunks(misses, budget):
+            results.extend(__translate(chunk, lang, context))
+        for sentence, result in zip(misses, results):
+            translated[sentence_hash(sentence)] = result.text
+            entries.append((sentence, lang, result.text))
+            billed += result.billed_characters or len(sentence)
+    text = []
+    for i, part in enumerate(parts):
+        sentence = part.strip()
+        if i % 2 or not sentence:
+            text.append(part)
+            continue
+        lead = part[: len(part) - len(part.lstrip())]
+        trail = part[len(part.rstrip()) :]
+        text.append(lead + translated[sentence_hash(sentence)] + trail)
+    return ("".join(text), entries, billed)
+
+
+def translate(text: str, languages: list) -> list:
+    """Translates the text into all languages concurrently.
+
+    Sentences found in the translation memory are not sent to DeepL. Returns
+    (language, translation, error) tuples in the requested order.
+    """
+    parts = split_sentences(text)
+    sentences = list(dict.fromkeys(p.strip() for p in parts[0::2] if p.strip()))
+    memory = TranslationMemory()
+    try:
+        known = memory.lookup(sentences, languages)
+    except Exception as e:
+        logging.error("Cannot read translation memory", exc_info=e)
+        known = {}
+    with ThreadPoolExecutor(max_workers=min(max_language_workers, len(languages))) as pool:
+        futures = [
+            pool.submit(__translate_language, parts, sentences, lang, known)
+            for lang in languages
+        ]
+    results = []
+    entries = []
+    billed = 0
+    for lang, future in zip(languages, futures):
+        try:
+            translation, new_entries, billed_characters = future.result()
+            results.append((lang, translation, None))
+            entries.extend(new_entries)
+            billed += billed_characters
         except Exception as e:
-            logging.error(e)
-            result = escape_markdown_v2(str(e))
+            logging.error(f"Translation to {lang} failed", exc_info=e)
+            results.append((lang, None, e))
+    if entries:
+        memory.store(entries)
+    __put_memory_metrics(sentences, languages, known, billed)
+    return results
+
+
+def __put_memory_metrics(sentences: list, languages: list, known: dict, billed: int) -> None:
+    lookups = len(sentences) * len(languages)
+    saved = sum(
+        len(sentence)
+        for sentence in sentences
+        for lang in languages
+        if (sentence_hash(sentence), lang) in known
+    )
+    logging.info(
+        f"Translation memory hits {len(known)} of {lookups}, billed {billed} characters, saved {saved}"
+    )
+    put_metrics(
+        {
+            "TranslationMemoryLookups": (lookups, "Count"),
+            "TranslationMemoryHits": (len(known), "Count"),
+            "BilledCharacters": (billed, "Count"),
+            "BilledCharactersSaved": (saved, "Count"),
+        },
+        engine="deepl",
+    )
+
+
+def render(results: list) -> str:
+    """One reply with a section per language, failures are reported in place."""
+    sections = []
+    for lang, translation, error in results:
+        if error is None:
+            body = escape_markdown_v2(translation)
+        else:
+            body = escape_markdown_v2(f"Translation failed: {error}")
+        sections.append(f"*{escape_markdown_v2(lang)}*\n{body}")
+    return "\n\n".join(sections)
+
+
+def __raise_for_status(response: Any, message: str) -> None:
+    if response.status_code == 429:
+        raise TooManyRequestsException(message)
+    if response.status_code == 456:
+        raise QuotaExceededException(message)
+    if response.status_code != 200:
+        raise DeepLException(f"DeepL returned {response.status_code}: {message}")
+
+
+def __upload_document(tmp_file: str, lang: str) -> dict:
+    """Streams the file from disk to the document endpoint of DeepL."""
+
+    def upload() -> Any:
+        multipart = CurlMime()
+        multipart.addpart(
+            "file",
+            content_type=get_content_type(tmp_file),
+            filename=os.path.basename(tmp_file),
+            local_path=tmp_file,
+        )
+        multipart.addpart("target_lang", data=lang.encode())
+        try:
+            response = sessions.post(
+                f"{server_url}/v2/document",
+                headers=__auth_headers(),
+                multipart=multipart,
+            )
+        finally:
+            multipart.close()
+        __raise_for_status(response, response.text)
+        return response.json()
+
+    handle = __retry(upload, lang)
+    logging.info(f"Uploaded document {handle['document_id']} for {lang}")
+    return {
+        "id": handle["document_id"],
+        "key": handle["document_key"],
+        "lang": lang,
+        "file_name": os.path.basename(tmp_file),
+    }
+
+
+def __auth_headers() -> dict:
+    return {"Authorization": f"DeepL-Auth-Key {auth_key}"}
 
-        payload["engine"] = lang.replace("-", "\-")
-        payload["response"] = encode_message(result)
+
+def __translate_document(payload: dict, languages: list) -> None:
+    """Uploads the attached document once per language and schedules the status checks.
+
+    Languages that cannot be uploaded are reported in one reply, the others are
+    delivered by `document_handler` as soon as each of them is translated.
+    """
+    tmp_file = download_attachment(payload["file"], bucket_name)
+    try:
+        with ThreadPoolExecutor(max_workers=min(max_language_workers, len(languages))) as pool:
+            futures = [pool.submit(__upload_document, tmp_file, lang) for lang in languages]
+        failed = []
+        for lang, future in zip(languages, futures):
+            try:
+                document = future.result()
+            except Exception as e:
+                logging.error(f"Document upload for {lang} failed", exc_info=e)
+                failed.append((lang, None, e))
+                continue
+            check = {**payload, "document": document, "attempt": 0}
+            __schedule_check(check, document_check_delay)
+    finally:
+        remove_attachment(tmp_file)
+    if failed:
+        payload["engine"] = engine_type
+        payload["response"] = encode_message(render(failed))
         sns.publish(TopicArn=result_topic, Message=json.dumps(payload))
 
 
+def __schedule_check(payload: dict, delay: int) -> None:
+    global _document_queue
+    if _document_queue is None:
+        _document_queue = sqs.get_queue_url(QueueName=document_queue_name)["QueueUrl"]
+    sqs.send_message(
+        QueueUrl=_document_queue, MessageBody=json.dumps(payload), DelaySeconds=delay
+    )
+
+
+def __check_delay(attempt: int, seconds_remaining: Optional[int]) -> int:
+    """The estimate of DeepL when there is one, otherwise an exponential backoff."""
+    delay = seconds_remaining or document_check_delay * 2**attempt
+    return int(min(max(delay, document_check_delay), document_max_delay))
+
+
+def __check_document(payload: dict) -> None:
+    document = payload["document"]
+    handle = DocumentHandle(document["id"], document["key"])
+    status = translator.translate_document_get_status(handle)
+    logging.info(f"Document {document['id']} for {document['lang']} is {status.status.value}")
+    if status.done:
+        __deliver_document(payload, handle, status.billed_characters or 0)
+    elif not status.ok:
+        __publish_document_error(payload, status.error_message or "translation failed")
+    elif payload["attempt"] + 1 >= document_max_checks:
+        __publish_document_error(payload, "translation did not finish in time")
+    else:
+        payload["attempt"] += 1
+        __schedule_check(payload, __check_delay(payload["attempt"], status.seconds_remaining))
+
+
+def __deliver_document(payload: dict, handle: DocumentHandle, billed: int) -> None:
+    """Streams the translation to the results prefix and hands it to the results handler."""
+    document = payload["document"]
+    stem, extension = os.path.splitext(document["file_name"])
+    file_name = f"{stem}_{document['lang'].lower()}{extension}"
+    key = f"{results_prefix}/{uuid.uuid4()}/{file_name}"
+    tmp_file = os.path.join(tempfile.mkdtemp(), file_name)
+    try:
+        __download_document(handle, tmp_file)
+        s3.upload_file(tmp_file, bucket_name, key)
+    finally:
+        remove_attachment(tmp_file)
+    put_metrics({"BilledCharacters": (billed, "Count")}, engine="deepl")
+    del payload["attempt"]
+    payload["engine"] = engine_type
+    payload["document"] = {"bucket": bucket_name, "key": key, "file_name": file_name}
+    payload["response"] = encode_message(f"*{escape_markdown_v2(document['lang'])}*")
+    sns.publish(TopicArn=result_topic, Message=json.dumps(payload))
+
+
+def __download_document(handle: DocumentHandle, tmp_file: str) -> None:
+    """Writes the translation to disk in chunks, the client of deepl would read it in memory."""
+    with sessions.session() as session:
+        response = session.post(
+            f"{server_url}/v2/document/{handle.document_id}/result",
+            headers=__auth_headers(),
+            json={"document_key": handle.document_key},
+            stream=True,
+        )
+        try:
+            __raise_for_status(response, "cannot download the document")
+            with open(tmp_file, "wb") as file:
+                for chunk in response.iter_content():
+                    file.write(chunk)
+        finally:
+            response.close()
+
+
+def __publish_document_error(payload: dict, error: str) -> None:
+    logging.error(f"Document {payload['document']['id']} not translated: {error}")
+    payload["engine"] = engine_type
+    payload["response"] = encode_message(
+        render([(payload["document"]["lang"], None, error)])
+    )
+    del payload["document"], payload["attempt"]
+    sns.publish(TopicArn=result_topic, Message=json.dumps(payload))
+
+
+def __process_payload(payload: Any, request_id: str) -> None:
+    languages = __parse_languages(payload.get("languages") or default_language)
+    if not languages:
+        return
+    if payload.get("file"):
+        __translate_document(payload, languages)
+        return
+    results = translate(payload["text"].replace("/tr", ""), languages)
+    payload["engine"] = engine_type
+    payload["response"] = encode_message(render(results))
+    sns.publish(TopicArn=result_topic, Message=json.dumps(payload))
+
+
 def sns_handler(event, context):
     """AWS SNS event handler"""
     request_id = context.aws_request_id
@@ -47,3 +397,23 @@ def sns_handler(event, context):
     for record in event["Records"]:
         payload = json.loads(record["Sns"]["Message"])
         __process_payload(payload, request_id)
+
+
+def sqs_handler(event, context):
+    """AWS SQS event handler, every message is a request of its own"""
+    logging.info(f"Request ID: {context.aws_request_id}")
+    return process_records(
+        records=event["Records"],
+        handler=__process_payload,
+        context=context,
+    )
+
+
+def document_handler(event, context):
+    """AWS SQS event handler of the document status checks"""
+    logging.info(f"Request ID: {context.aws_request_id}")
+    return process_records(
+        records=event["Records"],
+        handler=lambda payload, _: __check_document(payload),
+        context=context,
+    )
@@ -2,13 +2,19 @@ import json
 import logging
 import re
 import uuid
-from typing import Any
+from typing import Any, Optional
 
-import boto3
 from google import genai
 from google.genai import types
 
+from .aws_clients import client
 from .common_utils import encode_message, read_ssm_param
+from .gemini_context import build_contents
+from .metrics import put_metrics
+from .race import Race, RaceLost, race_for
+from .response_cache import ResponseCache
+from .sqs_batch import process_records
+from .streaming import ResultStream
 from .user_context import UserContext
 
 logging.basicConfig()
@@ -16,10 +22,12 @@ logging.getLogger().setLevel("INFO")
 
 engine_type = "gemini"
 model = "gemini-2.5-pro"
+# a single call finishes well within the 5 minute timeout of the Lambda
+request_timeout = 240
 
 bucket_name = read_ssm_param(param_name="BOT_S3_BUCKET")
 result_topic = read_ssm_param(param_name="RESULT_SNS_TOPIC_ARN")
-sns = boto3.session.Session().client("sns")
+sns = client("sns")
 _client = None
 _generation_config = None
 
@@ -38,21 +46,34 @@ def ask(
     text: str,
     file_path: str,
     context: UserContext,
+    stream: Optional[ResultStream] = None,
+    cache: Optional[ResponseCache] = None,
+    race: Optional[Race] = None,
 ) -> str:
     if "/ping" in text:
         return "pong"
 
-    if context.conversation_id is None:
+    first_turn = context.conversation_id is None
+    if first_turn:
         context.conversation_id = str(uuid.uuid4())
     logging.info(f"conversation_id; '{context.conversation_id}'")
-    contents = [
-        types.Content(
-            role="user",
-            parts=[
-                types.Part.from_text(text=text),
-            ],
-        ),
-    ]
+    # the history is kept here, so a cached first answer continues like a generated one
+    if cache and first_turn and not file_path:
+        return cache.answer(
+            text, lambda: __generate(text=text, context=context, stream=stream, race=race)
+        )
+    return __generate(text=text, context=context, stream=stream, race=race)
+
+
+def __generate(
+    text: str, context: UserContext, stream: Optional[ResultStream], race: Optional[Race]
+) -> str:
+    contents, cached_content = build_contents(
+        client=_client, model=model, context=context, text=text
+    )
+    config = _generation_config
+    if cached_content:
+        config = _generation_config.model_copy(update={"cached_content": cached_content})
 
     # if file_path:
     #     logging.info(f"Downloading image '{file_path}'")
@@ -69,14 +90,28 @@ def ask(
     response = _client.models.generate_content_stream(
         model=model,
         contents=contents,
-        config=_generation_config,
+        config=config,
     )
-    answer = ""
+    answer = []
+    usage = None
     for chunk in response:
+        if race:
+            race.check()
+        usage = chunk.usage_metadata or usage
         if not chunk.parts or chunk.parts[0].text is None:
             continue
-        answer += chunk.parts[0].text
-    return __as_markdown(answer)
+        answer.append(chunk.parts[0].text)
+        if stream:
+            stream.append(chunk.parts[0].text)
+    if usage:
+        put_metrics(
+            {
+                "PromptTokens": (usage.prompt_token_count or 0, "Count"),
+                "CachedTokens": (usage.cached_content_token_count or 0, "Count"),
+            },
+            engine=engine_type,
+        )
+    return "".join(answer)
 
 
 def create() -> None:
@@ -107,7 +142,9 @@ def create() -> None:
     )
     global _client
     api_key = read_ssm_param(param_name="GEMINI_API_KEY")
-    _client = genai.Client(api_key=api_key)
+    _client = genai.Client(
+        api_key=api_key, http_options=types.HttpOptions(timeout=request_timeout * 1000)
+    )
 
 
 def __as_markdown(input: str) -> str:
@@ -132,18 +169,56 @@ def __process_payload(payload: Any, request_id: str) -> None:
     if not (_client):
         create()
 
-    response = ask(
-        text=payload["text"],
-        file_path=payload.get("file", None),
-        context=user_context,
-    )
+    race = race_for(payload, engine_type)
+    stream = None
+    # racing answers are delivered whole, the losers must not leave partial messages
+    if payload.get("config", {}).get("stream", False) and race is None:
+        stream = ResultStream(
+            sns=sns,
+            topic_arn=result_topic,
+            payload=payload,
+            engine=engine_type,
+            formatter=__as_markdown,
+        )
+        stream.start()
+
+    cache = None
+    if payload.get("config", {}).get("cache", False):
+        cache = ResponseCache(engine=engine_type, model=model, style=payload["config"].get("style"))
+
+    try:
+        response = ask(
+            text=payload["text"],
+            file_path=payload.get("file", None),
+            context=user_context,
+            stream=stream,
+            cache=cache,
+            race=race,
+        )
+    except RaceLost as e:
+        logging.info(str(e))
+        return
+    except Exception as e:
+        if stream is None:
+            raise
+        # the finished stream cannot be edited by a retry, the user is asked to ask again
+        logging.error(f"Streamed answer to {payload['message_id']} failed", exc_info=e)
+        stream.fail()
+        return
+    if race and not race.claim():
+        return
+    answer = __as_markdown(response)
+    if stream:
+        stream.close(answer)
+    else:
+        payload["response"] = encode_message(answer)
+        payload["engine"] = engine_type
+        sns.publish(TopicArn=result_topic, Message=json.dumps(payload))
+    # persisted after the answer is sent, the user does not wait for the writes;
+    # history keeps the raw answer, it is sent back to the model on next turns
     user_context.save_conversation(
         conversation={"request": payload["text"], "response": response},
     )
-    payload["response"] = encode_message(response)
-    payload["engine"] = engine_type
-    # logging.info(payload)
-    sns.publish(TopicArn=result_topic, Message=json.dumps(payload))
 
 
 def sns_handler(event, context):
@@ -153,3 +228,16 @@ def sns_handler(event, context):
     for record in event["Records"]:
         payload = json.loads(record["Sns"]["Message"])
         __process_payload(payload, request_id)
+
+
+def sqs_handler(event, context):
+    """AWS SQS event handler, every message is a request of its own"""
+    logging.info(f"Request ID: {context.aws_request_id}")
+    if not (_client):
+        create()
+    return process_records(
+        records=event["Records"],
+        handler=__process_payload,
+        context=context,
+        time_margin=request_timeout,
+    )
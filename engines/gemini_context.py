@@ -0,0 +1,106 @@
+import logging
+import time
+from typing import Any, Optional
+
+from google.genai import types
+
+from .conversation_history import select_turns, total_tokens, with_summary
+from .user_context import UserContext
+
+logging.basicConfig()
+logging.getLogger().setLevel("INFO")
+
+history_token_budget = 32_000
+history_turns_limit = 50
+pinned_turns = 1
+# explicit caching is only accepted above the model's minimum cached prompt size
+cache_min_tokens = 4096
+cache_ttl_seconds = 3600
+cache_key = "gemini_cache"
+
+
+def build_contents(
+    client: Any, model: str, context: UserContext, text: str
+) -> tuple[list, Optional[str]]:
+    """Builds multi-turn contents for the prompt and returns them with the cache to use.
+
+    A large stable prefix of the conversation is moved into an explicit context
+    cache, so follow-up turns send only the turns added since it was created.
+    """
+    history = context.read_history(limit=history_turns_limit)
+    if len(history) >= history_turns_limit:
+        pinned = context.read_history(limit=pinned_turns, oldest=True)
+        history = [turn for turn in pinned if turn not in history] + history
+    history = with_summary(context.read_summary(), history)
+    cache = context.optional.get(cache_key)
+    cached = __cached_turns_count(history, cache, model)
+    if cached is not None:
+        tail = history[cached:]
+        if total_tokens(tail) < cache_min_tokens:
+            turns = select_turns(tail, history_token_budget, pinned=0)
+            return __as_contents(turns, text), cache["name"]
+        # the uncached tail has grown large enough to be cached as well
+        __delete_cache(client, cache["name"])
+        context.optional.pop(cache_key, None)
+
+    turns = select_turns(history, history_token_budget, pinned=pinned_turns)
+    if total_tokens(turns) >= cache_min_tokens:
+        cache = __create_cache(client, model, turns)
+        if cache:
+            context.optional[cache_key] = cache
+            return __as_contents([], text), cache["name"]
+    return __as_contents(turns, text), None
+
+
+def __cached_turns_count(history: list, cache: Optional[dict], model: str) -> Optional[int]:
+    if not cache or cache.get("model") != model:
+        return None
+    # leave a margin so the cache does not expire while the answer is generated
+    if cache["expire"] < time.time() + 60:
+        return None
+    for i, turn in enumerate(history):
+        if turn["request_id"] == cache["last_request_id"]:
+            return i + 1
+    return None
+
+
+def __create_cache(client: Any, model: str, turns: list) -> Optional[dict]:
+    try:
+        cache = client.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                contents=__as_contents(turns),
+                ttl=f"{cache_ttl_seconds}s",
+            ),
+        )
+    except Exception as e:
+        logging.error(f"Cannot create context cache for {len(turns)} turns", exc_info=e)
+        return None
+    logging.info(f"Created context cache {cache.name} of {len(turns)} turns")
+    return {
+        "name": cache.name,
+        "model": model,
+        "last_request_id": turns[-1]["request_id"],
+        "expire": int(time.time()) + cache_ttl_seconds,
+    }
+
+
+def __delete_cache(client: Any, name: str) -> None:
+    try:
+        client.caches.delete(name=name)
+    except Exception as e:
+        logging.info(f"Cannot delete context cache {name}: {e}")
+
+
+def __as_contents(turns: list, text: Optional[str] = None) -> list:
+    contents = []
+    for turn in turns:
+        contents.append(
+            types.Content(role="user", parts=[types.Part.from_text(text=turn["request"])])
+        )
+        contents.append(
+            types.Content(role="model", parts=[types.Part.from_text(text=turn["response"])])
+        )
+    if text is not None:
+        contents.append(types.Content(role="user", parts=[types.Part.from_text(text=text)]))
+    return contents
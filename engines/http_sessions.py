@@ -0,0 +1,90 @@
+import logging
+import queue
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from curl_cffi import requests
+from curl_cffi.const import CurlHttpVersion
+
+default_timeout = 60
+# idle sessions kept per upstream, enough for the SQS batch workers
+max_idle_sessions = 8
+
+
+class SessionPool:
+    """Impersonated curl_cffi sessions to one upstream.
+
+    The pool lives at module level, so the sessions with their open connections,
+    TLS state and negotiated HTTP/2 survive warm invocations. A curl session is not
+    thread safe, so every request borrows a session for its duration.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        impersonate: Optional[str],
+        headers: Optional[dict] = None,
+        cookies: Optional[dict] = None,
+        timeout: float = default_timeout,
+        max_idle: int = max_idle_sessions,
+        **session_kwargs,
+    ) -> None:
+        self.name = name
+        self.impersonate = impersonate
+        self.headers = dict(headers or {})
+        self.cookies = dict(cookies or {})
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.session_kwargs = session_kwargs
+        # the most recently used session first, its connection is the most likely alive
+        self.idle = queue.LifoQueue()
+        self.created = 0
+
+    @contextmanager
+    def session(self) -> Iterator[requests.Session]:
+        """Borrows a session, a streamed response must be read inside the block."""
+        try:
+            session = self.idle.get_nowait()
+        except queue.Empty:
+            session = self.__create()
+        try:
+            yield session
+        finally:
+            if self.idle.qsize() < self.max_idle:
+                self.idle.put(session)
+            else:
+                session.close()
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        with self.session() as session:
+            return session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def __create(self) -> requests.Session:
+        self.created += 1
+        logging.info(f"Opening {self.name} session #{self.created}")
+        return requests.Session(
+            impersonate=self.impersonate,  # type: ignore
+            headers=self.headers,
+            cookies=self.cookies,
+            timeout=self.timeout,
+            http_version=CurlHttpVersion.V2TLS,
+            # the session is bound to its own curl handle, not to the borrowing thread
+            use_thread_local_curl=False,
+            # cookies are sent explicitly, the ones set by responses must not leak
+            # into the requests of other users
+            discard_cookies=True,
+            **self.session_kwargs,
+        )
@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+from typing import Callable, NamedTuple, Optional
+
+import jwt
+
+# tokens are renewed in the background this long before they expire
+refresh_ahead = 5 * 60
+# rounds of waiting for the refresh of another container before giving up
+refresh_rounds = 3
+
+
+class IdeogramAuth(NamedTuple):
+    access_token: str
+    refresh_token: str
+    user_id: Optional[str]
+    cookies: dict
+    # epoch seconds, the earlier of the access token and the session cookie
+    expires_at: float
+
+
+def token_expiry(token: Optional[str]) -> float:
+    """The 'exp' claim of a JWT, 0 when there is no valid token."""
+    if not token:
+        return 0
+    try:
+        claims = jwt.decode(jwt=token, options={"verify_signature": False})
+        return float(claims["exp"])
+    except (jwt.InvalidTokenError, KeyError) as e:
+        logging.error(f"Invalid token: {e}")
+        return 0
+
+
+class IdeogramAuthProvider:
+    """The Ideogram tokens and session cookies, cached between requests.
+
+    The warm path reads nothing from s3. Tokens close to expiry are renewed in a
+    background thread while the current ones are still served. Renewals are
+    serialized by a lease across containers, the other containers wait for it
+    and load the renewed tokens instead of refreshing them once more.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[], IdeogramAuth],
+        renew: Callable[[IdeogramAuth], IdeogramAuth],
+        lease,
+        refresh_ahead: float = refresh_ahead,
+    ) -> None:
+        self.load = load
+        self.renew = renew
+        self.lease = lease
+        self.refresh_ahead = refresh_ahead
+        self.lock = threading.Lock()
+        # a renewal holds `lock`, requests served meanwhile must not wait for it
+        self.background_lock = threading.Lock()
+        self.current: Optional[IdeogramAuth] = None
+        self.background: Optional[threading.Thread] = None
+
+    def get(self) -> IdeogramAuth:
+        current = self.current
+        now = time.time()
+        if current is None or current.expires_at <= now:
+            return self.refresh(stale=current)
+        if current.expires_at - self.refresh_ahead <= now:
+            self.__refresh_in_background(current)
+        return current
+
+    def refresh(self, stale: Optional[IdeogramAuth], rejected: bool = False) -> IdeogramAuth:
+        """Replaces `stale` unless another request already did.
+
+        `rejected` tokens are renewed even when they have not expired yet.
+        """
+        with self.lock:
+            current = self.current
+            if current is not None and current is not stale and self.__fresh(current):
+                return current
+            self.current = self.__renew(stale if rejected else None)
+            return self.current
+
+    def __fresh(self, auth: IdeogramAuth, rejected: Optional[IdeogramAuth] = None) -> bool:
+        if rejected is not None and auth.access_token == rejected.access_token:
+            return False
+        return auth.expires_at - self.refresh_ahead > time.time()
+
+    def __renew(self, rejected: Optional[IdeogramAuth]) -> IdeogramAuth:
+        for _ in range(refresh_rounds):
+            auth = self.load()
+            if self.__fresh(auth, rejected):
+                logging.info("Loaded Ideogram tokens")
+                return auth
+            if not self.lease.acquire():
+                self.lease.wait()
+                continue
+            try:
+                # the lease holder before us may have just saved new tokens
+                auth = self.load()
+                if self.__fresh(auth, rejected):
+                    return auth
+                logging.info("Renewing Ideogram tokens")
+                return self.renew(auth)
+            finally:
+                self.lease.release()
+        raise Exception("Ideogram tokens were not renewed by the lease holder in time")
+
+    def __refresh_in_background(self, current: IdeogramAuth) -> None:
+        with self.background_lock:
+            if self.current is not current or (
+                self.background is not None and self.background.is_alive()
+            ):
+                return
+            self.background = threading.Thread(
+                target=self.__background_refresh, args=(current,), daemon=True
+            )
+            self.background.start()
+
+    def __background_refresh(self, current: IdeogramAuth) -> None:
+        try:
+            self.refresh(stale=current)
+        except Exception as e:
+            # the current tokens are served until they expire
+            logging.error("Background refresh of Ideogram tokens failed", exc_info=e)
@@ -1,14 +1,24 @@
 import json
 import logging
-from typing import Optional
-
-import boto3
-from curl_cffi import requests
+import time
+from typing import Any, Optional
 
+from .aws_clients import client
 from .common_utils import (
     encode_message,
     read_ssm_param,
 )
+from .ideogram_img import (
+    auth,
+    auth_headers,
+    ideogram_result_queue,
+    sessions,
+    unauthorized_statuses,
+)
+from .image_cache import ImageCache
+from .metrics import put_metrics
+from .request_jobs import RequestJobs
+from .sqs_batch import process_records
 from .user_context import UserContext
 
 logging.basicConfig()
@@ -17,35 +27,36 @@ logging.getLogger().setLevel("INFO")
 engine_type = "ideogram"
 threshold_img_quality = 1024
 base_url = "https://ideogram.ai"
-browser_version = "chrome120"
 retrieve_metadata_url = f"{base_url}/api/images/retrieve_metadata_request_id/"
 get_images_url = f"{base_url}/api/images/direct/"
+# checks back off exponentially, a generation takes 10-30 seconds
+poll_base_delay = 2
+poll_max_delay = 20
+max_poll_attempts = 12
+poll_timeout = 5 * 60
 
 result_topic = read_ssm_param(param_name="RESULT_SNS_TOPIC_ARN")
-sns = boto3.session.Session().client("sns")
-sqs = boto3.session.Session().client("sqs")
+sns = client("sns")
+sqs = client("sqs")
 
 
-def retrieve_images(payload: dict) -> Optional[str]:
-    logging.info(payload)
-    result_id = payload["result_id"]
+def retrieve_images(result_id: str) -> Optional[str]:
+    """The image URLs, None while the generation is still running."""
     if not result_id:
         raise Exception("Cannot get result_id")
 
-    response = requests.get(
-        url=retrieve_metadata_url + result_id,
-        headers=payload["headers"],
-        impersonate=browser_version,
-    )
+    current = auth.get()
+    response = sessions.get(retrieve_metadata_url + result_id, headers=auth_headers(current))
+    if response.status_code in unauthorized_statuses:
+        current = auth.refresh(stale=current, rejected=True)
+        response = sessions.get(retrieve_metadata_url + result_id, headers=auth_headers(current))
     if not response.ok:
         logging.info(response)
         raise Exception(f"Cannot retrieve images for result_id {result_id}")
 
     resp_obj = response.json()
     if "resolution" not in resp_obj or resp_obj["resolution"] < threshold_img_quality:
-        logging.info(f"Republishing results {result_id} to achieve delay...")
-        queue_url = payload["queue_url"]
-        sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(payload))
+        logging.info(f"Images {result_id} are not ready yet")
         return None
 
     list = []
@@ -57,34 +68,115 @@ def retrieve_images(payload: dict) -> Optional[str]:
     return message
 
 
+def poll_delay(attempt: int) -> int:
+    return int(min(poll_base_delay * 2**attempt, poll_max_delay))
+
+
+def __schedule_poll(job: RequestJobs, record: dict, failed: bool = False) -> None:
+    """Checks the job again later, gives up and tells the user once out of attempts.
+
+    A `failed` check counts as an attempt too, so a job whose images cannot be
+    retrieved ends as 'failed' instead of staying 'pending'.
+    """
+    attempt = job.next_attempt()
+    elapsed = time.time() - float(record["timestamp"])
+    if attempt >= max_poll_attempts or elapsed >= poll_timeout:
+        state = "failed" if failed else "timeout"
+        logging.error(f"Images {job.request_id} {state} after {attempt} checks in {elapsed:.0f}s")
+        if job.transition(("pending",), state):
+            __put_poll_metrics(attempt, elapsed, state)
+            message = "Images were not generated in time"
+            if failed:
+                message = "Error: images cannot be retrieved"
+            __publish(record["context"], job.request_id, message)
+        return
+    sqs.send_message(
+        QueueUrl=ideogram_result_queue,
+        MessageBody=json.dumps({"request_id": job.request_id}),
+        DelaySeconds=poll_delay(attempt),
+    )
+
+
+def __put_poll_metrics(attempts: int, elapsed: float, outcome: str) -> None:
+    put_metrics(
+        {
+            "ImagePollAttempts": (attempts, "Count"),
+            "ImageLatency": (int(elapsed * 1000), "Milliseconds"),
+        },
+        engine=engine_type,
+        outcome=outcome,
+    )
+
+
+def __publish(context: dict, result_id: str, message: str) -> dict:
+    payload = {
+        **context,
+        "result_id": result_id,
+        "engine": engine_type,
+        "response": encode_message(message),
+    }
+    sns.publish(TopicArn=result_topic, Message=json.dumps(payload))
+    return payload
+
+
+def __process_job(message: Any) -> None:
+    job = RequestJobs(request_id=message["request_id"], engine_id=engine_type)
+    record = job.read_job()
+    if record is None or record.get("state") != "pending":
+        logging.info(f"Skipping image job {job.request_id}, it is not pending")
+        return
+    try:
+        images = retrieve_images(result_id=job.request_id)
+    except Exception as e:
+        # retried with the same backoff as a generation still running
+        logging.error(f"Cannot check images {job.request_id}", exc_info=e)
+        __schedule_poll(job, record, failed=True)
+        return
+    if not images:
+        __schedule_poll(job, record)
+        return
+    # a redelivered message must not send the images twice
+    if not job.transition(("pending",), "done"):
+        return
+    elapsed = time.time() - float(record["timestamp"])
+    __put_poll_metrics(int(record.get("attempt", 0)) + 1, elapsed, "ready")
+
+    context = record["context"]
+    if context.get("image_cache_key"):
+        # the results handler adds the file IDs to this row after the delivery
+        ImageCache(engine=engine_type).put(context["image_cache_key"], images.splitlines())
+    try:
+        payload = __publish(context, job.request_id, images)
+    except Exception:
+        # back to pending, so the retried message delivers the images
+        job.transition(("done",), "pending")
+        raise
+    user_id = context["user_id"]
+    user_context = UserContext(
+        user_id=f"{user_id}_{context['chat_id']}",
+        request_id=job.request_id,
+        engine_id=engine_type,
+        username=context["username"],
+    )
+    user_context.conversation_id = job.request_id
+    try:
+        user_context.save_conversation(
+            conversation=payload,
+        )
+    except Exception as e:
+        logging.error(
+            f"Saving conversation error. User_id: {user_id}_{context['chat_id']}, item: {payload}",
+            exc_info=e,
+        )
+
+
 def sqs_handler(event, context):
     """AWS SQS event handler"""
     request_id = context.aws_request_id
     logging.info(f"Request ID: {request_id}")
-    for record in event["Records"]:
-        payload = json.loads(record["body"])
-        message = retrieve_images(payload=payload)
-        if not message:
-            return
-
-        payload["response"] = encode_message(message)
-        payload["engine"] = engine_type
-        user_id = payload["user_id"]
-        result_id = payload["result_id"]
-        user_context = UserContext(
-            user_id=f"{user_id}_{payload['chat_id']}",
-            request_id=result_id,
-            engine_id=engine_type,
-            username=payload["username"],
-        )
-        user_context.conversation_id = result_id
-        try:
-            user_context.save_conversation(
-                conversation=payload,
-            )
-        except Exception as e:
-            logging.error(
-                f"Saving conversation error. User_id: {user_id}_{payload['chat_id']}, item: {payload}",
-                exc_info=e,
-            )
-        sns.publish(TopicArn=result_topic, Message=json.dumps(payload))
+    # every record is checked on its own, the ideogram API has no batch lookup
+    return process_records(
+        records=event["Records"],
+        handler=lambda message, _: __process_job(message),
+        context=context,
+    )
@@ -0,0 +1,81 @@
+import datetime
+import hashlib
+import json
+import logging
+from typing import Optional
+
+from .aws_clients import table
+from .bot_state import state_key, table_name
+
+cache_ttl_days = 7
+# "/imagine --fresh a cat" skips the cache and generates new variations
+fresh_flag = "--fresh"
+
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.lower().split())
+
+
+def parse_prompt(text: str) -> tuple:
+    """Splits the opt-out flag from the prompt, returns (prompt, fresh)."""
+    words = text.split()
+    fresh = fresh_flag in words
+    return (" ".join(w for w in words if w != fresh_flag), fresh)
+
+
+def image_cache_key(prompt: str, params: dict) -> str:
+    """The cache row of a prompt generated with the given model parameters."""
+    value = json.dumps([normalize_prompt(prompt), params], sort_keys=True)
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    """Generated images shared by all chats, keyed by prompt and model parameters.
+
+    A row holds the image URLs of the first generation. The results handler adds
+    the Telegram file IDs of the first delivery, later hits are sent by file ID.
+    Rows live in the 'bot-state' table and expire after `cache_ttl_days`.
+    """
+
+    def __init__(self, engine: str) -> None:
+        self.engine = engine
+        self.table = table(table_name)
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            resp = self.table.get_item(
+                Key=self.__key(key),
+                ProjectionExpression="urls, file_ids",
+            )
+        except Exception as e:
+            logging.error(f"Cannot read image cache {key}", exc_info=e)
+            return None
+        return resp.get("Item")
+
+    def put(self, key: str, urls: list) -> None:
+        exp_time = datetime.datetime.utcnow() + datetime.timedelta(days=cache_ttl_days)
+        try:
+            self.table.put_item(
+                Item={
+                    **self.__key(key),
+                    "urls": urls,
+                    "exp": int(exp_time.timestamp()),
+                }
+            )
+        except Exception as e:
+            logging.error(f"Cannot save image cache {key}", exc_info=e)
+
+    def save_file_ids(self, key: str, file_ids: list) -> None:
+        """Lets later requests of the same prompt send the images by file ID."""
+        try:
+            self.table.update_item(
+                Key=self.__key(key),
+                UpdateExpression="SET file_ids = :ids",
+                ConditionExpression="attribute_exists(state_id)",
+                ExpressionAttributeValues={":ids": file_ids},
+            )
+        except Exception as e:
+            logging.error(f"Cannot save file IDs of cached images {key}", exc_info=e)
+
+    def __key(self, key: str) -> dict:
+        return state_key("image", f"{self.engine}_{key}")
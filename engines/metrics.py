@@ -0,0 +1,48 @@
+import json
+import time
+from typing import Optional
+
+namespace = "ChatBot"
+
+
+def put_metric(
+    name: str,
+    value: float,
+    unit: str = "Milliseconds",
+    **dimensions: str,
+) -> None:
+    """Writes a metric in CloudWatch Embedded Metric Format to the Lambda log."""
+    put_metrics({name: (value, unit)}, **dimensions)
+
+
+def put_metrics(metrics: dict, **dimensions: str) -> None:
+    """Writes several metrics sharing the same dimensions in one EMF record.
+
+    `metrics` maps a metric name to a `(value, unit)` tuple.
+    """
+    if not metrics:
+        return
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": namespace,
+                    "Dimensions": [list(dimensions.keys())],
+                    "Metrics": [
+                        {"Name": name, "Unit": unit}
+                        for name, (_, unit) in metrics.items()
+                    ],
+                }
+            ],
+        },
+        **dimensions,
+    }
+    for name, (value, _) in metrics.items():
+        record[name] = value
+    # EMF records must be printed as bare JSON lines, the logging prefix breaks parsing
+    print(json.dumps(record), flush=True)
+
+
+def elapsed_ms(start: float, end: Optional[float] = None) -> int:
+    return int(((end or time.perf_counter()) - start) * 1000)
@@ -2,11 +2,13 @@ import json
 import logging
 from typing import Any
 
-import boto3
 import requests
 
-from .common_utils import escape_markdown_v2, read_ssm_param
+from .aws_clients import client
+from .common_utils import encode_message, escape_markdown_v2, read_ssm_param
+from .race import race_for
 from .request_jobs import RequestJobs
+from .sqs_batch import process_records
 from .user_context import UserContext
 
 logging.basicConfig()
@@ -56,7 +58,6 @@ def ask(
             "response": escape_markdown_v2(response["message"]),
             "engine": engine_type,
         }
-        sns = boto3.Session().client("sns")
         sns.publish(TopicArn=result_topic, Message=json.dumps(err_message))
         return "error"
 
@@ -67,6 +68,7 @@ def ask(
 
 token = read_ssm_param(param_name="MONSTERAPI_TOKEN")
 result_topic = read_ssm_param(param_name="RESULT_SNS_TOPIC_ARN")
+sns = client("sns")
 
 def __process_payload(payload: Any, request_id: str) -> None:
     user_id = payload["user_id"]
@@ -78,8 +80,7 @@ def __process_payload(payload: Any, request_id: str) -> None:
     )
     question = payload["text"]
     if "/ping" in question:
-        payload["response"] = "pong"
-        sns = boto3.Session().client("sns")
+        payload["response"] = encode_message("pong")
         sns.publish(TopicArn=result_topic, Message=json.dumps(payload))
         return
 
@@ -87,6 +88,12 @@ def __process_payload(payload: Any, request_id: str) -> None:
         process_command(input=question, context=user_context)
         return
 
+    race = race_for(payload, engine_type)
+    # the job would only be paid for, another engine has already answered
+    if race and race.lost():
+        logging.info(f"Update {payload['update_id']} has been answered by another engine")
+        return
+
     process_id = ask(text=question, context=user_context)
     req_resp = RequestJobs(request_id=process_id, engine_id=engine_type)
     req_resp.save(
@@ -97,19 +104,23 @@ def __process_payload(payload: Any, request_id: str) -> None:
             "update_id": payload["update_id"],
             "username": payload["username"],
             "text": question,
+            "race": race is not None,
+            "timestamp": payload.get("timestamp"),
         },
+        state="pending",
     )
     user_context.conversation_id = process_id
     user_context.parent_id = process_id
     user_context.save_context()
 
 def sqs_handler(event, context):
-    """AWS SQS event handler"""
-    request_id = context.aws_request_id
-    logging.info(f"Request ID: {request_id}")
-    for record in event["Records"]:
-        payload = json.loads(record["body"])
-        __process_payload(payload, request_id)
+    """AWS SQS event handler, every message is a request of its own"""
+    logging.info(f"Request ID: {context.aws_request_id}")
+    return process_records(
+        records=event["Records"],
+        handler=__process_payload,
+        context=context,
+    )
 
 def sns_handler(event, context):
     """AWS SNS event handler"""
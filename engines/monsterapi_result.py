@@ -1,11 +1,16 @@
 import json
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
-import boto3
+import requests
 
+from .aws_clients import client, put_call_metrics
 from .common_utils import encode_message, escape_markdown_v2, read_ssm_param
-from .request_jobs import RequestJobs
+from .metrics import put_metrics
+from .race import Race
+from .request_jobs import RequestJobs, find_jobs
 from .user_context import UserContext
 
 logging.basicConfig()
@@ -13,9 +18,19 @@ logging.getLogger().setLevel("INFO")
 
 engine_type = "llama"
 fetch_url = "https://api.monsterapi.ai/v1/status/"
+# jobs without a final callback after this long are polled by the sweeper
+callback_slo = 3 * 60
+# polled jobs still not finished after this long are given up
+max_job_age = 60 * 60
+max_sweep_jobs = 100
+max_sweep_workers = 4
+request_timeout = 10
+
+# pending: submitted, in_progress: reported as running, the rest are final
+open_states = ("pending", "in_progress")
 
 result_topic = read_ssm_param(param_name="RESULT_SNS_TOPIC_ARN")
-sns = boto3.session.Session().client("sns")
+sns = client("sns")
 token = read_ssm_param(param_name="MONSTERAPI_TOKEN")
 
 headers = {
@@ -24,32 +39,59 @@ headers = {
 }
 
 
-def callback_handler(event, context) -> None:
-    """AWS Lambda event handler"""
-    if(event is None or event.get("body") is None):
-        return
-    body = json.loads(event["body"])
-    process_id = body["process_id"]
-    status = body["status"]
+def __settle(process_id: str, status: str, result: Optional[dict], source: str) -> bool:
+    """Moves the job to the state reported by MonsterAPI and delivers a final result once.
+
+    Returns True when this call delivered the result.
+    """
     #   [IN_QUEUE, IN_PROGRESS, COMPLETED, FAILED]
+    job = RequestJobs(request_id=process_id, engine_id=engine_type)
     if status == "IN_PROGRESS" or status == "IN_QUEUE":
-        return
-    elif status == "COMPLETED":
+        job.transition(("pending",), "in_progress")
+        return False
+    record = job.read_job()
+    if record is None or record.get("state") not in open_states:
+        logging.info(f"Ignoring {source} {status} of process {process_id}, not an open job")
+        put_metrics({"IgnoredCallbacks": (1, "Count")}, engine=engine_type, source=source)
+        return False
+    state = "completed" if status == "COMPLETED" else "failed"
+    # concurrent callbacks and sweeps race here, only one of them delivers
+    if not job.transition(open_states, state):
+        put_metrics({"IgnoredCallbacks": (1, "Count")}, engine=engine_type, source=source)
+        return False
+    if state == "completed":
         logging.info(f"Process ID: {process_id}")
-        item = body["result"]
-        # logging.info(item)
+        text = (result or {}).get("text", "")
     else:
-        error = body["result"]["errorMessage"]
-        item = {"text": f"Error: {error}"}
-        logging.error(
-            f"Request failed with error {error}, process_id: {process_id}, Response: {body}"
-        )
+        error = (result or {}).get("errorMessage", status)
+        text = f"Error: {error}"
+        logging.error(f"Request failed with error {error}, process_id: {process_id}")
+    try:
+        __deliver(process_id, record["context"], text, failed=state == "failed")
+    except Exception:
+        job.transition((state,), record["state"])
+        raise
+    latency = time.time() - float(record["timestamp"])
+    put_metrics(
+        {"CallbackLatency": (int(latency * 1000), "Milliseconds")},
+        engine=engine_type,
+        source=source,
+        state=state,
+    )
+    return True
 
-    req_resp = RequestJobs(request_id=process_id, engine_id=engine_type)
-    config = req_resp.read() or {
-        "text": f"Request {process_id} for '{engine_type}' is not available"
-    }
-    # logging.info(config)
+
+def __deliver(process_id: str, config: dict, text: str, failed: bool = False) -> None:
+    if config.get("race"):
+        race = Race(
+            update_id=config["update_id"], engine=engine_type, timestamp=config.get("timestamp")
+        )
+        if failed:
+            # errors do not win a race, they are only sent while nobody has answered
+            if race.lost():
+                return
+        elif not race.claim():
+            return
     user_id = config.get("user_id", None)
     payload = {
         "type": "text",
@@ -61,8 +103,8 @@ def callback_handler(event, context) -> None:
         "message_id": config.get("message_id", None),
         "chat_id": config.get("chat_id", None),
     }
-    text = escape_markdown_v2(item["text"])
-    payload["response"] = encode_message(text)
+    payload["response"] = encode_message(escape_markdown_v2(text))
+    sns.publish(TopicArn=result_topic, Message=json.dumps(payload))
     if user_id:
         try:
             user_context = UserContext(
@@ -74,12 +116,68 @@ def callback_handler(event, context) -> None:
             user_context.conversation_id = process_id
             user_context.parent_id = process_id
             user_context.save_conversation(
-                conversation={"request": config["text"], "response": item["text"]}
+                conversation={"request": config["text"], "response": text}
             )
         except Exception as e:
             logging.error(
                 f"Error on saving conversation_id: {process_id}, request_id:{process_id}, payload: {payload}",
                 exc_info=e,
             )
-    # logging.info(payload)
-    sns.publish(TopicArn=result_topic, Message=json.dumps(payload))
+
+
+def callback_handler(event, context) -> None:
+    """AWS Lambda event handler"""
+    if(event is None or event.get("body") is None):
+        return
+    body = json.loads(event["body"])
+    __settle(body["process_id"], body["status"], body.get("result"), source="callback")
+    put_call_metrics()
+
+
+def __sweep_job(job: dict) -> str:
+    process_id = job["request_id"]
+    response = requests.get(fetch_url + process_id, headers=headers, timeout=request_timeout)
+    response.raise_for_status()
+    body = response.json()
+    if __settle(process_id, body["status"], body.get("result"), source="sweeper"):
+        return "recovered"
+    if time.time() - float(job["timestamp"]) < max_job_age:
+        return "waiting"
+    request_job = RequestJobs(request_id=process_id, engine_id=engine_type)
+    if request_job.transition(open_states, "lost"):
+        __deliver(
+            process_id, job["context"], "Error: the answer did not arrive in time", failed=True
+        )
+        return "lost"
+    return "waiting"
+
+
+def sweep_handler(event, context) -> None:
+    """Scheduled handler, polls the status of jobs whose callback did not arrive"""
+    created_before = int(time.time()) - callback_slo
+    jobs = []
+    for state in open_states:
+        jobs.extend(find_jobs(state, engine_type, created_before, limit=max_sweep_jobs))
+    jobs = jobs[:max_sweep_jobs]
+    if not jobs:
+        return
+    logging.info(f"Polling {len(jobs)} jobs without a final callback")
+    outcomes = {"recovered": 0, "waiting": 0, "lost": 0, "error": 0}
+    with ThreadPoolExecutor(max_workers=max_sweep_workers) as pool:
+        futures = [(job, pool.submit(__sweep_job, job)) for job in jobs]
+    for job, future in futures:
+        try:
+            outcomes[future.result()] += 1
+        except Exception as e:
+            logging.error(f"Cannot poll process {job['request_id']}", exc_info=e)
+            outcomes["error"] += 1
+    logging.info(f"Sweep outcomes {outcomes}")
+    put_metrics(
+        {
+            "RecoveredJobs": (outcomes["recovered"], "Count"),
+            "LostJobs": (outcomes["lost"], "Count"),
+            "SweptJobs": (len(jobs), "Count"),
+        },
+        engine=engine_type,
+    )
+    put_call_metrics()
@@ -0,0 +1,89 @@
+import logging
+import time
+from typing import Optional
+
+from botocore.exceptions import ClientError
+
+from .aws_clients import table
+from .bot_state import state_key, table_name
+from .metrics import put_metrics
+
+claim_ttl = 24 * 60 * 60
+# generating engines read the claim at most that often
+check_interval = 2.0
+
+
+class RaceLost(Exception):
+    """Another engine has already answered the request."""
+
+
+def race_for(payload: dict, engine: str) -> Optional["Race"]:
+    """The race of the request, None unless the user races several engines."""
+    config = payload.get("config") or {}
+    if not config.get("race") or len(config.get("engines", [])) < 2:
+        return None
+    if payload.get("update_id") is None:
+        return None
+    return Race(update_id=payload["update_id"], engine=engine, timestamp=payload.get("timestamp"))
+
+
+class Race:
+    """Engines answering the same request in race mode, only the first answer is delivered.
+
+    Before publishing, every engine claims the request with a conditional write of
+    the 'bot-state' row of the update ID, the engines losing the claim drop
+    their answer. Streaming engines read the claim while generating and stop as
+    soon as another engine has won. The RaceWins average of an engine is its win
+    rate, RaceLatency is counted from the user's message.
+    """
+
+    def __init__(self, update_id: int, engine: str, timestamp: Optional[float] = None) -> None:
+        self.name = f"race {update_id}"
+        self.key = state_key("race", str(update_id))
+        self.engine = engine
+        self.timestamp = float(timestamp) if timestamp else time.time()
+        self.last_check = time.perf_counter()
+        self.table = table(table_name)
+
+    def claim(self) -> bool:
+        """Claims the request for the engine, False when another engine was first."""
+        try:
+            self.table.put_item(
+                Item={**self.key, "winner": self.engine, "exp": int(time.time()) + claim_ttl},
+                ConditionExpression="attribute_not_exists(state_id)",
+            )
+            won = True
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                # a second answer is better than none
+                logging.error(f"Cannot claim race {self.name}", exc_info=e)
+                return True
+            won = False
+        logging.info(f"Engine {self.engine} {'won' if won else 'lost'} {self.name}")
+        put_metrics(
+            {
+                "RaceWins": (int(won), "Count"),
+                "RaceLatency": (int((time.time() - self.timestamp) * 1000), "Milliseconds"),
+            },
+            engine=self.engine,
+        )
+        return won
+
+    def lost(self) -> bool:
+        """True when another engine has claimed the request."""
+        try:
+            item = self.table.get_item(Key=self.key, ConsistentRead=True).get("Item")
+        except Exception as e:
+            logging.error(f"Cannot read race {self.name}", exc_info=e)
+            return False
+        return bool(item) and item["winner"] != self.engine
+
+    def check(self) -> None:
+        """Raises RaceLost once another engine has won, called while generating."""
+        now = time.perf_counter()
+        if now - self.last_check < check_interval:
+            return
+        self.last_check = now
+        if self.lost():
+            put_metrics({"RaceWins": (0, "Count"), "RaceAborts": (1, "Count")}, engine=self.engine)
+            raise RaceLost(f"{self.name} has been answered by another engine")
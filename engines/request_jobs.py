@@ -1,9 +1,13 @@
 import datetime
 import json
 import logging
+import time
 from typing import Any, Optional
 
-import boto3
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+
+from .aws_clients import table
 
 
 class RequestJobs:
@@ -14,8 +18,7 @@ class RequestJobs:
     ):
         self.engine_id = engine_id
         self.request_id = request_id
-        dynamodb = boto3.resource("dynamodb")
-        self.requests_table = dynamodb.Table("request-jobs")
+        self.requests_table = table("request-jobs")
 
     def read(self) -> Optional[dict]:
         logging.info(f"Read request context '{self.request_id}'")
@@ -32,33 +35,88 @@ class RequestJobs:
             )
         return None
 
-    def save(self, context: Optional[Any] = None) -> None:
+    def save(self, context: Optional[Any] = None, state: Optional[str] = None) -> None:
+        """Saves the request context, a job `state` makes it a tracked job."""
         logging.info(
             f"Save request context for {self.request_id}, engine {self.engine_id}"
         )
         tme = datetime.datetime.utcnow()
         exp_time = tme + datetime.timedelta(days=10)
-        self.requests_table.put_item(
-            Item={
-                "request_id": self.request_id,
-                "engine": self.engine_id,
-                "context": json.dumps(context or {}),
-                "timestamp": int(tme.timestamp()),
-                "exp": int(exp_time.timestamp()),
-            }
+        item = {
+            "request_id": self.request_id,
+            "engine": self.engine_id,
+            "context": json.dumps(context or {}),
+            "timestamp": int(tme.timestamp()),
+            "exp": int(exp_time.timestamp()),
+        }
+        if state is not None:
+            item["state"] = state
+            item["attempt"] = 0
+            item["updated_at"] = item["timestamp"]
+        self.requests_table.put_item(Item=item)
+
+    def read_job(self) -> Optional[dict]:
+        """The whole job record with the context decoded, None when there is none."""
+        resp = self.requests_table.get_item(
+            Key={"request_id": self.request_id, "engine": self.engine_id},
+            ConsistentRead=True,
         )
+        item = resp.get("Item")
+        if not item:
+            return None
+        return {**item, "context": json.loads(item["context"])}
 
-    def delete(self) -> None:
-        logging.info(
-            f"Delete request context {self.request_id}, engine {self.engine_id}"
+    def next_attempt(self) -> int:
+        """Counts one more attempt of the job, returns the new count."""
+        resp = self.requests_table.update_item(
+            Key={"request_id": self.request_id, "engine": self.engine_id},
+            UpdateExpression="SET updated_at = :now ADD attempt :one",
+            ExpressionAttributeValues={":now": int(time.time()), ":one": 1},
+            ReturnValues="UPDATED_NEW",
         )
-        self.requests_table.delete_item(
-            Key={
-                "request_id": {
-                    "S": self.request_id,
+        return int(resp["Attributes"]["attempt"])
+
+    def transition(self, from_states: tuple, to_state: str) -> bool:
+        """Moves the job to `to_state` from one of `from_states`.
+
+        Returns False when the job is in another state, e.g. a concurrent
+        handler has already moved it.
+        """
+        from_values = {f":from{i}": state for i, state in enumerate(from_states)}
+        try:
+            self.requests_table.update_item(
+                Key={"request_id": self.request_id, "engine": self.engine_id},
+                UpdateExpression="SET #state = :to, updated_at = :now",
+                ConditionExpression=f"#state IN ({', '.join(from_values)})",
+                ExpressionAttributeNames={"#state": "state"},
+                ExpressionAttributeValues={
+                    **from_values,
+                    ":to": to_state,
+                    ":now": int(time.time()),
                 },
-                "engine": {"S": self.engine_id},
-            },
-            Table="conversation-id-index",
-        )
-        self.conversation_id = None
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                logging.info(f"Job {self.request_id} is not in {from_states} anymore")
+                return False
+            raise
+        return True
+
+
+def find_jobs(state: str, engine_id: str, created_before: int, limit: int = 100) -> list:
+    """Jobs of the engine in `state` created before the timestamp, oldest first."""
+    requests_table = table("request-jobs")
+    query = {
+        "IndexName": "state-index",
+        "KeyConditionExpression": Key("state").eq(state) & Key("timestamp").lt(created_before),
+        "FilterExpression": Attr("engine").eq(engine_id),
+    }
+    jobs = []
+    while len(jobs) < limit:
+        resp = requests_table.query(**query)
+        jobs.extend({**item, "context": json.loads(item["context"])} for item in resp["Items"])
+        if "LastEvaluatedKey" not in resp:
+            break
+        query["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+    return jobs[:limit]
+
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from .aws_clients import table
+from .bot_state import Lease, state_key, table_name
+from .image_cache import normalize_prompt
+from .metrics import elapsed_ms, put_metrics
+
+cache_ttl = 24 * 60 * 60
+# DynamoDB items are limited to 400 KB
+max_cached_size = 300 * 1024
+# answers read or generated by this container are served without a table read
+local_cache_size = 256
+# an identical prompt arriving while the first one is answered waits that long at most
+lease_duration = 90
+
+_responses: OrderedDict = OrderedDict()
+_responses_lock = threading.Lock()
+
+
+def response_cache_key(prompt: str, engine: str, model: str, style: Optional[str]) -> str:
+    """The cache row of a first-turn prompt answered by the engine model in the style."""
+    value = json.dumps([normalize_prompt(prompt), engine, model, style or ""])
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Answers to the first turn of a conversation shared by all users.
+
+    Only first turns are cached, their answer depends on the prompt alone. Rows
+    live in the 'bot-state' table and expire after `cache_ttl` seconds, the
+    last `local_cache_size` answers are also kept by the container. Identical
+    prompts asked at the same time share one engine call: the first request
+    holds a lease on the key and the others wait for its answer.
+    """
+
+    def __init__(self, engine: str, model: str, style: Optional[str] = None) -> None:
+        self.engine = engine
+        self.model = model
+        self.style = style
+        self.table = table(table_name)
+
+    def answer(self, prompt: str, generate: Callable[[], str]) -> str:
+        """The cached answer to the prompt, `generate` makes it on a miss."""
+        key = response_cache_key(prompt, self.engine, self.model, self.style)
+        cached = self.get(key)
+        if cached:
+            return self.__hit(cached, coalesced=False)
+        lease = Lease(f"response_{key}", duration=lease_duration)
+        try:
+            leased = lease.acquire()
+        except Exception as e:
+            logging.error(f"Cannot lease response cache {key}", exc_info=e)
+            leased = None
+        if leased is False:
+            logging.info(f"Waiting for the answer to the same prompt {key}")
+            lease.wait()
+            cached = self.get(key)
+            if cached:
+                return self.__hit(cached, coalesced=True)
+        try:
+            started = time.perf_counter()
+            response = generate()
+            latency = elapsed_ms(started)
+            self.put(key, response, latency)
+        finally:
+            if leased:
+                lease.release()
+        put_metrics(
+            {"ResponseCacheLookups": (1, "Count"), "ResponseCacheHits": (0, "Count")},
+            engine=self.engine,
+        )
+        return response
+
+    def get(self, key: str) -> Optional[dict]:
+        with _responses_lock:
+            entry = _responses.get(key)
+            if entry is not None and entry["exp"] > time.time():
+                _responses.move_to_end(key)
+                return entry
+            _responses.pop(key, None)
+        try:
+            resp = self.table.get_item(
+                Key=state_key("response", key),
+                ProjectionExpression="response, latency_ms, #exp",
+                ExpressionAttributeNames={"#exp": "exp"},
+            )
+        except Exception as e:
+            logging.error(f"Cannot read response cache {key}", exc_info=e)
+            return None
+        item = resp.get("Item")
+        # the TTL attribute removes expired rows within days, not right away
+        if not item or item["exp"] < time.time():
+            return None
+        self.__remember(key, item)
+        return item
+
+    def put(self, key: str, response: str, latency_ms: int) -> None:
+        if not response or len(response.encode("utf-8")) > max_cached_size:
+            return
+        item = {
+            "response": response,
+            "latency_ms": latency_ms,
+            "exp": int(time.time()) + cache_ttl,
+        }
+        self.__remember(key, item)
+        try:
+            self.table.put_item(Item={**state_key("response", key), **item})
+        except Exception as e:
+            logging.error(f"Cannot save response cache {key}", exc_info=e)
+
+    def __hit(self, cached: dict, coalesced: bool) -> str:
+        logging.info(f"Answered from the response cache of {self.engine}")
+        put_metrics(
+            {
+                "ResponseCacheLookups": (1, "Count"),
+                "ResponseCacheHits": (1, "Count"),
+                "ResponseCacheCoalesced": (int(coalesced), "Count"),
+                "ResponseCacheSavedLatency": (int(cached["latency_ms"]), "Milliseconds"),
+            },
+            engine=self.engine,
+        )
+        return cached["response"]
+
+    def __remember(self, key: str, item: dict) -> None:
+        with _responses_lock:
+            _responses[key] = item
+            _responses.move_to_end(key)
+            while len(_responses) > local_cache_size:
+                _responses.popitem(last=False)
@@ -0,0 +1,78 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from .aws_clients import put_call_metrics
+
+logging.basicConfig()
+logging.getLogger().setLevel("INFO")
+
+# upstream APIs rate limit per account, so a batch is never fanned out wider than this
+max_batch_workers = 4
+# a record is not started with less Lambda time left, an invocation timing out
+# reports no failures and SQS redelivers the records already answered too
+default_time_margin = 10
+
+
+def user_key(payload: Any) -> Optional[tuple]:
+    """The user and chat of a request envelope, None for other messages."""
+    if not isinstance(payload, dict) or payload.get("user_id") is None:
+        return None
+    return (payload["user_id"], payload.get("chat_id"))
+
+
+def process_records(
+    records: list,
+    handler: Callable[[Any, str], None],
+    max_workers: int = max_batch_workers,
+    order_key: Callable[[Any], Optional[Any]] = user_key,
+    context: Optional[Any] = None,
+    time_margin: float = default_time_margin,
+) -> dict:
+    """Runs `handler(payload, message_id)` for every SQS record of a batch.
+
+    The message ID identifies the record, unlike the Lambda request ID shared
+    by the whole batch. Records with the same `order_key` (the user and chat of
+    an envelope) are handled one after another in batch order, the others
+    concurrently. Once a record of a user fails, the later ones of that user are
+    not handled and are retried with it, so they are never answered before it.
+    Records not started `time_margin` seconds before the Lambda `context` times
+    out are retried as well.
+
+    Returns the partial batch response, so only failed records are retried
+    by SQS and the ones already answered are not processed again.
+    """
+    failures = []
+    groups: dict = {}
+    for record in records:
+        try:
+            payload = json.loads(record["body"])
+        except Exception as e:
+            logging.error(f"Message {record['messageId']} is not JSON", exc_info=e)
+            failures.append({"itemIdentifier": record["messageId"]})
+            continue
+        key = order_key(payload)
+        groups.setdefault(record["messageId"] if key is None else key, []).append(
+            (record["messageId"], payload)
+        )
+
+    def process(group: list) -> list:
+        for i, (message_id, payload) in enumerate(group):
+            if context and context.get_remaining_time_in_millis() < time_margin * 1000:
+                logging.info(f"Lambda time is running out, {len(group) - i} messages left")
+                return [failed_id for failed_id, _ in group[i:]]
+            try:
+                handler(payload, message_id)
+            except Exception as e:
+                logging.error(f"Processing of message {message_id} failed", exc_info=e)
+                return [failed_id for failed_id, _ in group[i:]]
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(groups) or 1)) as pool:
+        for failed_ids in pool.map(process, groups.values()):
+            failures.extend({"itemIdentifier": message_id} for message_id in failed_ids)
+    if failures:
+        logging.info(f"{len(failures)} of {len(records)} messages failed")
+    put_call_metrics()
+    return {"batchItemFailures": failures}
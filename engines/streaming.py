@@ -0,0 +1,98 @@
+import copy
+import json
+import logging
+import time
+from typing import Any, Callable, Optional
+
+from .common_utils import encode_message
+from .metrics import elapsed_ms, put_metric
+
+logging.basicConfig()
+logging.getLogger().setLevel("INFO")
+
+# Telegram allows roughly one message edit per second in a chat,
+# so partial results are not published more often than that
+stream_interval = 1.5
+stream_error = "Error: the answer could not be generated, please ask again"
+
+
+class ResultStream:
+    """Publishes partial engine output to the result topic while it is generated.
+
+    Every publication carries the whole text produced so far together with an
+    increasing sequence number, so the results handler can drop stale snapshots
+    delivered out of order and only ever edit the Telegram message forward.
+    """
+
+    def __init__(
+        self,
+        sns: Any,
+        topic_arn: str,
+        payload: dict,
+        engine: str,
+        formatter: Optional[Callable[[str], str]] = None,
+        interval: float = stream_interval,
+    ) -> None:
+        self.sns = sns
+        self.topic_arn = topic_arn
+        self.payload = payload
+        self.engine = engine
+        self.formatter = formatter or (lambda text: text)
+        self.interval = interval
+        self.seq = 0
+        self.parts: list = []
+        self.started = time.perf_counter()
+        self.last_flush = self.started
+        self.ttft_ms: Optional[int] = None
+        self.flushed_size = 0
+
+    def start(self) -> None:
+        """Publishes an empty snapshot so the user gets a placeholder message."""
+        self.started = time.perf_counter()
+        self.__publish(text="", final=False)
+        self.last_flush = time.perf_counter()
+
+    def append(self, delta: str) -> None:
+        if not delta:
+            return
+        if self.ttft_ms is None:
+            self.ttft_ms = elapsed_ms(self.started)
+            logging.info(f"Time to first token {self.ttft_ms} ms")
+            put_metric("TimeToFirstToken", self.ttft_ms, engine=self.engine)
+        self.parts.append(delta)
+        if time.perf_counter() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self) -> None:
+        text = self.text()
+        if len(text) == self.flushed_size:
+            return
+        self.__publish(text=self.formatter(text), final=False)
+        self.flushed_size = len(text)
+        self.last_flush = time.perf_counter()
+
+    def close(self, response: str) -> None:
+        """Publishes the final formatted response."""
+        self.__publish(text=response, final=True)
+        put_metric("StreamDuration", elapsed_ms(self.started), engine=self.engine)
+
+    def fail(self) -> None:
+        """Replaces the placeholder or the partial answer with an error and ends the stream."""
+        self.__publish(text=self.formatter(stream_error), final=True)
+
+    def text(self) -> str:
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+    def __publish(self, text: str, final: bool) -> None:
+        message = copy.copy(self.payload)
+        message["engine"] = self.engine
+        message["response"] = encode_message(text)
+        message["stream"] = {
+            "seq": self.seq,
+            "final": final,
+            "ttft_ms": self.ttft_ms,
+        }
+        self.seq += 1
+        self.sns.publish(TopicArn=self.topic_arn, Message=json.dumps(message))
@@ -0,0 +1,168 @@
+import logging
+from typing import Optional
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from google import genai
+from google.genai import types
+
+from .aws_clients import put_call_metrics, table
+from .common_utils import read_ssm_param
+from .conversation_codec import body_attributes, unpack_conversation
+from .conversation_history import summary_request_id, total_tokens, turn_tokens
+from .metrics import put_metrics
+
+logging.basicConfig()
+logging.getLogger().setLevel("INFO")
+
+model = "gemini-2.5-flash-lite"
+# engines sending the stored history with every prompt
+summarized_engines = ["gemini"]
+compaction_threshold_tokens = 8000
+recent_window_tokens = 3000
+recent_window_turns = 2
+summary_prompt = """You maintain a running summary of a chat between a user and an AI assistant.
+Merge the previous summary with the new exchanges below into one updated summary.
+Keep facts about the user, decisions, names, numbers, code identifiers and open questions.
+Drop greetings and repetition. Write in the language of the conversation, at most 400 words.
+
+Previous summary:
+{summary}
+
+New exchanges:
+{exchanges}"""
+
+_client = None
+_table = None
+
+
+def compact(conversation_id: str) -> None:
+    """Folds older turns of a long conversation into its rolling summary."""
+    summary = __read_summary(conversation_id)
+    since = summary["summarized_until"] if summary else 0
+    turns = __read_turns(conversation_id, since)
+    if total_tokens(turns) < compaction_threshold_tokens:
+        return
+
+    kept = 0
+    window_tokens = 0
+    for turn in reversed(turns):
+        window_tokens += turn_tokens(turn)
+        if kept >= recent_window_turns and window_tokens > recent_window_tokens:
+            break
+        kept += 1
+    if kept >= len(turns):
+        return
+    # turns of the same second stay together, the boundary is a timestamp
+    until = turns[len(turns) - kept]["timestamp"]
+    folded = [turn for turn in turns if turn["timestamp"] < until]
+    if not folded:
+        return
+
+    logging.info(f"Summarizing {len(folded)} turns of conversation {conversation_id}")
+    text = __summarize(summary["summary"] if summary else "", folded)
+    if text and __save_summary(conversation_id, text, until):
+        put_metrics(
+            {
+                "SummarizedTurns": (len(folded), "Count"),
+                "SummarizedTokens": (total_tokens(folded), "Count"),
+            },
+            engine="summarizer",
+        )
+
+
+def __summarize(summary: str, turns: list) -> Optional[str]:
+    global _client
+    if _client is None:
+        _client = genai.Client(api_key=read_ssm_param(param_name="GEMINI_API_KEY"))
+    exchanges = "\n\n".join(
+        f"User: {turn['request']}\nAssistant: {turn['response']}" for turn in turns
+    )
+    response = _client.models.generate_content(
+        model=model,
+        contents=summary_prompt.format(summary=summary or "(none)", exchanges=exchanges),
+        config=types.GenerateContentConfig(temperature=0.2, max_output_tokens=1024),
+    )
+    return response.text
+
+
+def __get_table():
+    global _table
+    if _table is None:
+        _table = table("user-conversations")
+    return _table
+
+
+def __read_summary(conversation_id: str) -> Optional[dict]:
+    resp = __get_table().get_item(
+        Key={"conversation_id": conversation_id, "request_id": summary_request_id}
+    )
+    if "Item" not in resp:
+        return None
+    return {
+        "summary": resp["Item"]["summary"],
+        "summarized_until": int(resp["Item"]["summarized_until"]),
+    }
+
+
+def __read_turns(conversation_id: str, since: int) -> list:
+    query = {
+        "IndexName": "timestamp-index",
+        "KeyConditionExpression": Key("conversation_id").eq(conversation_id)
+        & Key("timestamp").gte(since),
+        "ProjectionExpression": f"request_id, #ts, {body_attributes}",
+        "ExpressionAttributeNames": {"#ts": "timestamp"},
+    }
+    turns = []
+    while True:
+        resp = __get_table().query(**query)
+        for item in resp["Items"]:
+            conversation = unpack_conversation(item)
+            turns.append(
+                {
+                    "request_id": item["request_id"],
+                    "timestamp": int(item["timestamp"]),
+                    "request": conversation.get("request") or "",
+                    "response": conversation.get("response") or "",
+                }
+            )
+        if "LastEvaluatedKey" not in resp:
+            return turns
+        query["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+
+def __save_summary(conversation_id: str, summary: str, until: int) -> bool:
+    # the summary item has no timestamp, user_id or engine and so stays out of the indexes
+    try:
+        __get_table().put_item(
+            Item={
+                "conversation_id": conversation_id,
+                "request_id": summary_request_id,
+                "summary": summary,
+                "summarized_until": until,
+            },
+            ConditionExpression="attribute_not_exists(summarized_until) OR summarized_until < :until",
+            ExpressionAttributeValues={":until": until},
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            logging.info(f"Conversation {conversation_id} already summarized further")
+            return False
+        raise
+    return True
+
+
+def stream_handler(event, context):
+    """AWS DynamoDB stream event handler"""
+    request_id = context.aws_request_id
+    logging.info(f"Request ID: {request_id}")
+    conversation_ids = []
+    for record in event["Records"]:
+        image = record["dynamodb"].get("NewImage", {})
+        engine = image.get("engine", {}).get("S")
+        conversation_id = image.get("conversation_id", {}).get("S")
+        if engine in summarized_engines and conversation_id not in conversation_ids:
+            conversation_ids.append(conversation_id)
+    for conversation_id in conversation_ids:
+        compact(conversation_id)
+    put_call_metrics()
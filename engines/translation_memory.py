@@ -0,0 +1,92 @@
+import datetime
+import hashlib
+import logging
+import re
+from typing import Optional
+
+from .aws_clients import table
+from .bot_state import state_key, table_name
+
+# sentence ends followed by whitespace and line breaks, list numbers like "1." are kept
+sentence_boundary = re.compile(
+    r"((?<!\b\d\.)(?<!\b\d\d\.)(?<=[.!?…。！？])\s+|\s*\n\s*)"
+)
+memory_ttl_days = 30
+source_auto = "auto"
+# BatchGetItem accepts up to 100 keys
+batch_get_size = 100
+
+
+def split_sentences(text: str) -> list:
+    """Splits the text into sentences and the whitespace between them.
+
+    Sentences are at even indexes, joining all parts gives back the text.
+    """
+    return sentence_boundary.split(text)
+
+
+def normalize(sentence: str) -> str:
+    return " ".join(sentence.split())
+
+
+def sentence_hash(sentence: str) -> str:
+    return hashlib.sha256(normalize(sentence).encode("utf-8")).hexdigest()
+
+
+class TranslationMemory:
+    """Translations of single sentences shared by all users.
+
+    Entries are kept in the 'bot-state' table keyed by the normalized
+    sentence hash, the source and the target language, and expire after
+    `memory_ttl_days`.
+    """
+
+    def __init__(self, engine: str = "deepl") -> None:
+        self.engine = engine
+        self.table = table(table_name)
+
+    def lookup(self, sentences: list, targets: list, source: Optional[str] = None) -> dict:
+        """Returns known translations keyed by (sentence hash, target language)."""
+        keys = {}
+        for sentence in sentences:
+            for target in targets:
+                key = self.__key(sentence_hash(sentence), source, target)
+                keys[key["state_id"]] = key
+        keys = list(keys.values())
+        found = {}
+        for i in range(0, len(keys), batch_get_size):
+            request = {
+                table_name: {
+                    "Keys": keys[i : i + batch_get_size],
+                    "ProjectionExpression": "state_id, translation",
+                }
+            }
+            while request:
+                resp = self.table.meta.client.batch_get_item(RequestItems=request)
+                for item in resp["Responses"].get(table_name, []):
+                    digest = item["state_id"].split("_", 1)[0]
+                    target = item["state_id"].rsplit("_", 1)[-1]
+                    found[(digest, target)] = item["translation"]
+                request = resp.get("UnprocessedKeys")
+        return found
+
+    def store(self, translations: list, source: Optional[str] = None) -> None:
+        """Saves (sentence, target language, translation) tuples."""
+        exp_time = datetime.datetime.utcnow() + datetime.timedelta(days=memory_ttl_days)
+        try:
+            with self.table.batch_writer(overwrite_by_pkeys=["state_id", "kind"]) as batch:
+                for sentence, target, translation in translations:
+                    batch.put_item(
+                        Item={
+                            **self.__key(sentence_hash(sentence), source, target),
+                            "translation": translation,
+                            "exp": int(exp_time.timestamp()),
+                        }
+                    )
+        except Exception as e:
+            logging.error("Cannot save translation memory", exc_info=e)
+
+    def __key(self, digest: str, source: Optional[str], target: str) -> dict:
+        return state_key(
+            "translation", f"{digest}_{self.engine}_{source or source_auto}_{target}"
+        )
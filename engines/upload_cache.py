@@ -0,0 +1,72 @@
+import datetime
+import hashlib
+import json
+import logging
+from typing import Any, Optional
+
+from .aws_clients import table
+from .bot_state import state_key, table_name
+
+# DynamoDB items are limited to 400 KB
+max_cached_size = 350 * 1024
+cache_ttl_days = 10
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+class UploadCache:
+    """Attachments already uploaded to an engine within a conversation.
+
+    Entries are kept in the 'bot-state' table keyed by the content hash and
+    the conversation, so a follow-up question about the same document reuses the
+    uploaded file instead of sending it again. Uploads of a new conversation are
+    saved once the engine has assigned the conversation ID.
+    """
+
+    def __init__(self, engine_id: str, conversation_id: Optional[str]) -> None:
+        self.engine_id = engine_id
+        self.conversation_id = conversation_id
+        self.pending = {}
+        self.table = table(table_name)
+
+    def get(self, digest: str) -> Optional[Any]:
+        if self.conversation_id is None:
+            return None
+        try:
+            item = self.table.get_item(Key=self.__key(self.conversation_id, digest)).get("Item")
+        except Exception as e:
+            logging.error(f"Cannot read upload cache {digest}", exc_info=e)
+            return None
+        cached = json.loads(item["upload"]) if item else None
+        if cached:
+            logging.info(f"Reusing upload {digest} in conversation {self.conversation_id}")
+        return cached or None
+
+    def put(self, digest: str, value: Any) -> None:
+        if len(json.dumps(value)) > max_cached_size:
+            logging.info(f"Upload {digest} is too large to be cached")
+            return
+        self.pending[digest] = value
+
+    def save(self, conversation_id: Optional[str]) -> None:
+        if conversation_id is None:
+            return
+        exp_time = datetime.datetime.utcnow() + datetime.timedelta(days=cache_ttl_days)
+        for digest, value in self.pending.items():
+            try:
+                self.table.put_item(
+                    Item={
+                        **self.__key(conversation_id, digest),
+                        "upload": json.dumps(value),
+                        "exp": int(exp_time.timestamp()),
+                    }
+                )
+            except Exception as e:
+                logging.error(f"Cannot cache upload {digest}", exc_info=e)
+        self.pending = {}
+
+    def __key(self, conversation_id: str, digest: str) -> dict:
+        return state_key("upload", f"{self.engine_id}_{conversation_id}_{digest}")
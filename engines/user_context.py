@@ -1,13 +1,167 @@
+import base64
+import copy
 import datetime
 import json
 import logging
+import threading
+import time
+from collections import OrderedDict
 from typing import Any, Optional
 
-import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+from .aws_clients import client, table
+from .conversation_codec import body_attributes, pack_conversation, unpack_conversation
+from .conversation_history import summary_request_id
+from .metrics import put_metrics
+from .sqs_batch import process_records
 
 logging.basicConfig()
 logging.getLogger().setLevel("INFO")
 
+# contexts read or saved by this container are reused on the next turns, a reset
+# made by another container is noticed when the next save fails its condition
+context_cache_ttl = 5 * 60
+context_cache_size = 1024
+# conversations whose write failed on the engine side are retried from this queue
+persist_queue_name = "Conversation-Persist-Queue"
+# the start of the request listed by /history without reading the whole exchange
+preview_length = 60
+binary_tag = "__binary__"
+
+_contexts: OrderedDict = OrderedDict()
+_contexts_lock = threading.Lock()
+_persist_queue_url = None
+
+
+def _cached_context(key: tuple) -> Optional[dict]:
+    with _contexts_lock:
+        entry = _contexts.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del _contexts[key]
+            return None
+        _contexts.move_to_end(key)
+        # callers modify 'optional' in place
+        return copy.deepcopy(entry[1])
+
+
+def _cache_context(key: tuple, context: Optional[dict]) -> None:
+    with _contexts_lock:
+        if context is None:
+            _contexts.pop(key, None)
+            return
+        _contexts[key] = (time.time() + context_cache_ttl, copy.deepcopy(context))
+        _contexts.move_to_end(key)
+        while len(_contexts) > context_cache_size:
+            _contexts.popitem(last=False)
+
+
+def _context_condition(conversation_id: Optional[str]) -> dict:
+    """Lets a context be written only over the conversation it was read with.
+
+    A container still caching a conversation reset by another one would
+    otherwise bring the deleted row back.
+    """
+    if conversation_id is None:
+        return {
+            "ConditionExpression": "attribute_not_exists(conversation_id) OR attribute_type(conversation_id, :null)",
+            "ExpressionAttributeValues": {":null": "NULL"},
+        }
+    return {
+        "ConditionExpression": "conversation_id = :conversation_id",
+        "ExpressionAttributeValues": {":conversation_id": conversation_id},
+    }
+
+
+def _condition_failed(e: ClientError) -> bool:
+    if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+        return True
+    reasons = e.response.get("CancellationReasons") or []
+    return any(reason.get("Code") == "ConditionalCheckFailed" for reason in reasons)
+
+
+def _drop_stale_context(item: dict) -> None:
+    logging.info(f"Context of {item['user_id']} was changed by another container, not saved")
+    _cache_context((item["user_id"], item["engine"]), None)
+
+
+def write_items(items: list) -> None:
+    """Puts (table_name, item[, condition]) tuples in a single DynamoDB transaction.
+
+    A user context failing its condition was reset by another container, it
+    is dropped from the cache and the other items are written without it.
+    """
+    dynamodb = table(items[0][0]).meta.client
+    try:
+        dynamodb.transact_write_items(
+            TransactItems=[
+                {"Put": {"TableName": name, "Item": item, **(condition[0] if condition else {})}}
+                for name, item, *condition in items
+            ]
+        )
+    except ClientError as e:
+        if not _condition_failed(e):
+            raise
+        for _, item, *condition in items:
+            if condition:
+                _drop_stale_context(item)
+        unconditional = [item for item in items if len(item) < 3]
+        if unconditional:
+            write_items(unconditional)
+
+
+def _preview(conversation: dict) -> str:
+    text = " ".join(str(conversation.get("request") or conversation.get("text") or "").split())
+    return text if len(text) <= preview_length else text[: preview_length - 1] + "…"
+
+
+def _encode_binary(value: Any) -> dict:
+    # compressed bodies are binary attributes, JSON needs them as text
+    if isinstance(value, bytes):
+        return {binary_tag: base64.b64encode(value).decode("ascii")}
+    raise TypeError(f"Cannot serialize {type(value)}")
+
+
+def _decode_items(items: list) -> list:
+    return [
+        (
+            table,
+            {
+                name: base64.b64decode(value[binary_tag])
+                if isinstance(value, dict) and binary_tag in value
+                else value
+                for name, value in item.items()
+            },
+            *condition,
+        )
+        for table, item, *condition in items
+    ]
+
+
+def _enqueue_items(items: list) -> None:
+    global _persist_queue_url
+    try:
+        sqs = client("sqs")
+        if _persist_queue_url is None:
+            _persist_queue_url = sqs.get_queue_url(QueueName=persist_queue_name)["QueueUrl"]
+        body = json.dumps({"items": items}, default=_encode_binary)
+        sqs.send_message(QueueUrl=_persist_queue_url, MessageBody=body)
+    except Exception as e:
+        # the answer is already delivered, only the history of this turn is lost
+        logging.error(f"Cannot queue conversation items {items}", exc_info=e)
+
+
+def persist_handler(event, context):
+    """AWS SQS event handler, writes conversations the engines failed to save"""
+    return process_records(
+        records=event["Records"],
+        handler=lambda payload, _: write_items(_decode_items(payload["items"])),
+        context=context,
+    )
+
 
 class UserContext:
     def __init__(
@@ -21,26 +175,30 @@ class UserContext:
         self.username = username or "anonymous"
         self.engine_id = engine_id
         self.request_id = request_id
-        dynamodb = boto3.resource("dynamodb")
-        self.context_table = dynamodb.Table("user-context") # type: ignore
-        self.conversations_table = dynamodb.Table("user-conversations") # type: ignore
+        self.context_table = table("user-context")
+        self.conversations_table = table("user-conversations")
         self.context = self.read_context()
+        self.optional = (self.context or {}).get("optional") or {}
         self.conversation_id = self.__get_conversation_id()
+        # the conversation stored in 'user-context', saves expect it unchanged
+        self.stored_conversation_id = self.conversation_id
         self.parent_id = self.__get_parent_id()
 
     def reset_conversation(self) -> None:
         logging.info(f"Reset conversation {self.conversation_id}")
         self.context_table.delete_item(
-            Key={
-                "conversation_id": {
-                    "S": self.conversation_id,
-                }
-            },
-            Table="conversation-id-index",
+            Key={"user_id": self.user_id, "engine": self.engine_id}
         )
+        _cache_context((self.user_id, self.engine_id), None)
+        self.context = None
         self.conversation_id = None
+        self.stored_conversation_id = None
+        self.parent_id = None
 
     def read_context(self) -> Optional[Any]:
+        cached = _cached_context((self.user_id, self.engine_id))
+        if cached is not None:
+            return cached
         logging.info(f"Read user context {self.user_id}")
         try:
             resp = self.context_table.get_item(
@@ -48,14 +206,16 @@ class UserContext:
             )
             if "Item" in resp and resp["Item"]:
                 item = resp["Item"]
-                return {
+                context = {
                     "user_id": item["user_id"],
                     "engine": item["engine"],
                     "conversation_id": item["conversation_id"],
                     "parent_id": item["parent_id"],
-                    "optional": json.loads(item["optional"] or ""),
+                    "optional": json.loads(item["optional"] or "{}"),
                     "exp": int(item["exp"]),
                 }
+                _cache_context((self.user_id, self.engine_id), context)
+                return context
         except Exception as e:
             logging.error(
                 f"Cannot read from 'user-context' table with PK '{self.user_id}' and SK '{self.engine_id}'",
@@ -65,43 +225,82 @@ class UserContext:
 
     def save_context(self, optional_context: Optional[Any] = None) -> None:
         logging.info(f"Save user context for {self.user_id}, engine {self.engine_id}")
-        tme = datetime.datetime.utcnow()
-        exp_time = tme + datetime.timedelta(days=60)
-        self.context_table.put_item(
-            Item={
-                "user_id": self.user_id,
-                "engine": self.engine_id,
-                "conversation_id": self.conversation_id,
-                "parent_id": self.parent_id,
-                "optional": json.dumps(optional_context or {}),
-                "exp": int(exp_time.timestamp()),
-            }
-        )
+        try:
+            self.context_table.put_item(
+                Item=self.__context_item(optional_context),
+                **_context_condition(self.stored_conversation_id),
+            )
+        except ClientError as e:
+            if not _condition_failed(e):
+                raise
+            _drop_stale_context(self.context)
+            return
+        self.stored_conversation_id = self.conversation_id
 
     def save_conversation(
         self,
         conversation: Optional[Any] = None,
     ) -> None:
+        """Writes the user context and the exchange in one transaction.
+
+        Engines call it after the answer is published, so the user does not wait
+        for the write. A failed write is handed to the persist queue and retried
+        there instead of being lost.
+        """
         logging.info(f"Save conversation for {self.user_id}, engine {self.engine_id}")
         tme = datetime.datetime.utcnow()
+        started = time.time()
+        items = [
+            (
+                "user-context",
+                self.__context_item(None),
+                _context_condition(self.stored_conversation_id),
+            )
+        ]
         try:
-            self.save_context(optional_context=None)
             if self.conversation_id:
-                self.conversations_table.put_item(
-                    Item={
-                        "conversation_id": self.conversation_id,
-                        "request_id": self.request_id,
-                        "user_id": self.user_id,
-                        "engine": self.engine_id,
-                        "timestamp": int(tme.timestamp()),
-                        "conversation": json.dumps(conversation or {}),
-                    }
+                item = {
+                    "conversation_id": self.conversation_id,
+                    "request_id": self.request_id,
+                    "user_id": self.user_id,
+                    "engine": self.engine_id,
+                    "timestamp": int(tme.timestamp()),
+                    "preview": _preview(conversation or {}),
+                }
+                item.update(
+                    pack_conversation(conversation or {}, self.conversation_id, self.request_id)
                 )
+                items.append(("user-conversations", item))
+            write_items(items)
+            self.stored_conversation_id = self.conversation_id
         except Exception as e:
             logging.error(
                 f"save_conversation failed with error. User: {self.user_id}, engine_id: {self.engine_id}, conversation_id: {self.conversation_id}",
                 exc_info=e,
             )
+            _enqueue_items(items)
+            return
+        # the time the answer used to wait for before it was published
+        put_metrics(
+            {"PersistLatency": (int((time.time() - started) * 1000), "Milliseconds")},
+            engine=self.engine_id,
+        )
+
+    def __context_item(self, optional_context: Optional[Any]) -> dict:
+        """The 'user-context' row, also kept in the container cache."""
+        tme = datetime.datetime.utcnow()
+        exp_time = tme + datetime.timedelta(days=60)
+        optional = optional_context or self.optional
+        self.context = {
+            "user_id": self.user_id,
+            "engine": self.engine_id,
+            "conversation_id": self.conversation_id,
+            "parent_id": self.parent_id,
+            "optional": optional,
+            "exp": int(exp_time.timestamp()),
+        }
+        _cache_context((self.user_id, self.engine_id), self.context)
+        return {**self.context, "optional": json.dumps(optional)}
 
     def read_conversation(self) -> Optional[Any]:
         try:
@@ -112,7 +311,7 @@ class UserContext:
                 }
             )
             if "Item" in resp:
-                return json.loads(resp["Item"]["conversation"])
+                return unpack_conversation(resp["Item"])
             return None
         except Exception as e:
             logging.error(
@@ -120,12 +319,69 @@ class UserContext:
                 exc_info=e,
             )
 
+    def read_summary(self) -> Optional[dict]:
+        """Returns the rolling summary of older turns written by the summarizer."""
+        if not self.conversation_id:
+            return None
+        try:
+            resp = self.conversations_table.get_item(
+                Key={
+                    "conversation_id": self.conversation_id,
+                    "request_id": summary_request_id,
+                }
+            )
+            if "Item" in resp:
+                item = resp["Item"]
+                return {
+                    "summary": item["summary"],
+                    "summarized_until": int(item["summarized_until"]),
+                }
+        except Exception as e:
+            logging.error(
+                f"read_summary failed with error. User: {self.user_id}, conversation_id: {self.conversation_id}",
+                exc_info=e,
+            )
+        return None
+
+    def read_history(self, limit: int = 50, oldest: bool = False) -> list:
+        """Returns up to `limit` latest (or first) exchanges of the conversation, oldest first."""
+        if not self.conversation_id:
+            return []
+        try:
+            resp = self.conversations_table.query(
+                IndexName="timestamp-index",
+                KeyConditionExpression=Key("conversation_id").eq(self.conversation_id),
+                ProjectionExpression=f"request_id, #ts, {body_attributes}",
+                ExpressionAttributeNames={"#ts": "timestamp"},
+                ScanIndexForward=oldest,
+                Limit=limit,
+            )
+            items = resp["Items"] if oldest else reversed(resp["Items"])
+            history = []
+            for item in items:
+                conversation = unpack_conversation(item)
+                history.append(
+                    {
+                        "request_id": item["request_id"],
+                        "timestamp": int(item["timestamp"]),
+                        "request": conversation.get("request") or "",
+                        "response": conversation.get("response") or "",
+                    }
+                )
+            return history
+        except Exception as e:
+            logging.error(
+                f"read_history failed with error. User: {self.user_id}, engine_id: {self.engine_id}, conversation_id: {self.conversation_id}",
+                exc_info=e,
+            )
+        return []
+
     def __get_conversation_id(self) -> Optional[str]:
         if self.context:
-            self.context.get("conversation_id", None)
+            return self.context.get("conversation_id", None)
         return None
 
     def __get_parent_id(self) -> Optional[str]:
         if self.context:
-            self.context.get("parent_id", None)
+            return self.context.get("parent_id", None)
         return None
@@ -4,8 +4,6 @@ import logging
 import time
 from typing import Any, Optional
 
-import boto3
-import boto3.session
 from botocore.exceptions import ClientError
 from telegram import (
     ReplyKeyboardMarkup,
@@ -16,6 +14,7 @@ from telegram import (
 from telegram.ext import (
     Application,
     CallbackContext,
+    CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
@@ -23,7 +22,11 @@ from telegram.ext import (
     filters,
 )
 
+from engines.aws_clients import client, put_call_metrics
+
 from .help_command import help_handler, start_handler
+from .history_command import callback_prefix, history_callback, history_handler
+from .media_groups import MediaGroup
 from .user_config import UserConfig
 from .utils import (
     escape_markdown_v2,
@@ -43,7 +46,7 @@ logging.basicConfig()
 logging.getLogger().setLevel("INFO")
 
 user_config = UserConfig()
-sns = boto3.session.Session().client("sns")
+sns = client("sns")
 
 
 telegram_token = read_ssm_param(param_name="TELEGRAM_TOKEN")
@@ -108,6 +111,45 @@ async def set_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+async def toggle_stream(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user is None or update.effective_message is None:
+        return
+
+    user_id = update.effective_user.id
+    config = user_config.read(user_id)
+    config["stream"] = not config.get("stream", False)
+    logging.info(f"user: {user_id} set streaming to: '{config['stream']}'")
+    user_config.write(user_id, config)
+    state = "enabled" if config["stream"] else "disabled"
+    await update.effective_message.reply_text(text=f"Streaming of answers is {state}")
+
+
+async def toggle_cache(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user is None or update.effective_message is None:
+        return
+
+    user_id = update.effective_user.id
+    config = user_config.read(user_id)
+    config["cache"] = not config.get("cache", False)
+    logging.info(f"user: {user_id} set response cache to: '{config['cache']}'")
+    user_config.write(user_id, config)
+    state = "enabled" if config["cache"] else "disabled"
+    await update.effective_message.reply_text(text=f"Cached answers are {state}")
+
+
+async def toggle_race(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user is None or update.effective_message is None:
+        return
+
+    user_id = update.effective_user.id
+    config = user_config.read(user_id)
+    config["race"] = not config.get("race", False)
+    logging.info(f"user: {user_id} set race mode to: '{config['race']}'")
+    user_config.write(user_id, config)
+    state = "enabled" if config["race"] else "disabled"
+    await update.effective_message.reply_text(text=f"Race of engines is {state}")
+
+
 @send_typing_action
 async def engines(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if (
@@ -202,12 +244,12 @@ async def grab_errors(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
 
 def __query_cloudwatch_logs(query_string):
-    client = boto3.client("logs")
+    logs = client("logs")
     try:
-        group_response = client.describe_log_groups(logGroupNamePattern="Handler")
+        group_response = logs.describe_log_groups(logGroupNamePattern="Handler")
         group_names = [group["logGroupName"] for group in group_response["logGroups"]]
         logging.info(group_names)
-        response = client.start_query(
+        response = logs.start_query(
             logGroupNames=group_names,
             startTime=int((time.time() - 3600 * 3) * 1000),  # 3h
             endTime=int(time.time() * 1000),
@@ -216,7 +258,7 @@ def __query_cloudwatch_logs(query_string):
         )
         query_id = response["queryId"]
         while True:
-            query_status = client.get_query_results(queryId=query_id)
+            query_status = logs.get_query_results(queryId=query_id)
             if query_status["status"] == "Complete":
                 break
             time.sleep(1)
@@ -242,9 +284,8 @@ async def redrive_dlq(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
 
 def __start_redrive_dlq() -> Any:
-    session = boto3.session.Session()
-    sqs = session.client("sqs")
-    sns = session.client("sns")
+    sqs = client("sqs")
+    sns = client("sns")
     count = 0
     for queue_url in sqs.list_queues()["QueueUrls"]:
         if "-DLQ" in queue_url:
@@ -255,6 +296,10 @@ def __start_redrive_dlq() -> Any:
                         QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=10
                     )
                     if "Messages" in messages:
+                        if "Records" not in json.loads(messages["Messages"][0]["Body"]):
+                            __start_message_move_task(sqs, queue_url, messages["Messages"])
+                            count += len(messages["Messages"])
+                            break
                         for msg in messages["Messages"]:
                             receipt_handle = msg["ReceiptHandle"]
                             body = json.loads(msg["Body"])
@@ -304,6 +349,19 @@ def __start_redrive_dlq() -> Any:
     return escape_markdown_v2("Finished DLQ redrive. {} messages moved".format(count))
 
 
+def __start_message_move_task(sqs: Any, queue_url: str, messages: list) -> None:
+    """Moves messages of an engine request DLQ back to the request queue."""
+    for msg in messages:
+        sqs.change_message_visibility(
+            QueueUrl=queue_url, ReceiptHandle=msg["ReceiptHandle"], VisibilityTimeout=0
+        )
+    queue_arn = sqs.get_queue_attributes(
+        QueueUrl=queue_url, AttributeNames=["QueueArn"]
+    )["Attributes"]["QueueArn"]
+    task = sqs.start_message_move_task(SourceArn=queue_arn)
+    logging.info(f"Started message move task {task['TaskHandle']} for {queue_url}")
+
+
 # Translation handlers
 
 
@@ -318,9 +376,10 @@ async def tr_start(update: Update, context: CallbackContext) -> int:
         logging.info(update.message.text)
         logging.info(context.args)
         langs = ",".join(context.args).strip().upper()
+        config["languages"] = langs
         user_config.write(user_id, config)
         await update.message.reply_text(
-            f"Set language(s) to: {langs}. Send your text to translate"
+            f"Set language(s) to: {langs}. Send your text or document to translate"
         )
         return TEXT
 
@@ -352,7 +411,7 @@ async def tr_lang(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         config["languages"] = update.message.text.strip().upper()
     user_config.write(user_id, config)
     await update.message.reply_text(
-        "Please send your text to translate",
+        "Please send your text or document to translate",
         reply_markup=ReplyKeyboardRemove(),
     )
     return TEXT
@@ -371,6 +430,14 @@ async def tr_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 
+async def tr_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Run document translations"""
+    user_id = update.effective_user.id
+    config = user_config.read(user_id)
+    await __process_document_translation(update, context, config["languages"])
+    return ConversationHandler.END
+
+
 async def tr_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels and ends the translation request"""
     user = update.message.from_user
@@ -424,8 +491,19 @@ async def process_upload(
 ) -> None:
     s3_bucket = read_ssm_param(param_name="BOT_S3_BUCKET")
     file = await bot.get_file(file_id)
-    path = await upload_to_s3(file, s3_bucket, "att", file_name)
+    # files of different updates may share a name
+    path = await upload_to_s3(file, s3_bucket, f"att/{update.update_id}", file_name)
     logging.info(f"File uploaded {path}")
+    text = update.message.caption
+    files = [path]
+    if update.message.media_group_id:
+        collected = await MediaGroup(update.message.media_group_id).collect(path, text)
+        if collected is None:
+            return
+        files, text = collected
+        # only the caption of the album may address the bot in a group
+        if bot.name not in (text or "") and "group" in update.message.chat.type:
+            return
     user_id = int(update.effective_user.id)
     config = user_config.read(user_id)
     envelop = {
@@ -434,11 +512,12 @@ async def process_upload(
         "username": update.effective_user.name,
         "update_id": update.update_id,
         "message_id": update.effective_message.id,
-        "text": update.message.caption,
+        "text": text,
         "chat_id": update.effective_chat.id,
         "timestamp": update.effective_message.date.timestamp(),
         "config": config,
-        "file": path,
+        "file": files[0],
+        "files": files,
     }
     # logging.info(envelop)
     await __send_envelop(envelop, json.dumps(config["engines"]))
@@ -449,7 +528,11 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     logging.info("File upload in 'process_photo'")
     # logging.info(update.message)
-    if bot.name not in update.message.caption and "group" in update.message.chat.type:
+    if (
+        bot.name not in (update.message.caption or "")
+        and "group" in update.message.chat.type
+        and update.message.media_group_id is None
+    ):
         return
     photo = max(update.message.photo, key=lambda x: x.file_size)
     logging.info(photo)
@@ -474,7 +557,19 @@ async def process_attachment(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if update.message is None:
         return
     logging.info(update.message)
-    if bot.name not in update.message.caption and "group" in update.message.chat.type:
+    if (
+        bot.name not in (update.message.caption or "")
+        and "group" in update.message.chat.type
+        and update.message.media_group_id is None
+    ):
+        return
+    caption = (update.message.caption or "").replace(bot.name, "").strip()
+    if caption.startswith("/tr"):
+        # "/tr pl,de" as the caption of a document, the languages of /tr otherwise
+        lang = caption.removeprefix("/tr").strip()
+        if not lang:
+            lang = user_config.read(int(update.effective_user.id)).get("languages", "PL")
+        await __process_document_translation(update, context, lang)
         return
     attachment = update.message.effective_attachment
     logging.info(attachment)
@@ -552,6 +647,36 @@ async def __process_translation(
     await __send_envelop(envelop)
 
 
+@send_typing_action
+async def __process_document_translation(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    lang: str = "PL",
+):
+    document = update.message.document
+    if document is None:
+        return
+    s3_bucket = read_ssm_param(param_name="BOT_S3_BUCKET")
+    file = await bot.get_file(document.file_id)
+    path = await upload_to_s3(
+        file, s3_bucket, f"att/{update.update_id}", document.file_name
+    )
+    logging.info(f"Document uploaded {path}")
+    envelop = {
+        "type": "translate",
+        "user_id": update.effective_user.id,
+        "username": update.effective_user.name,
+        "update_id": update.update_id,
+        "message_id": update.effective_message.id,
+        "text": "",
+        "chat_id": update.effective_chat.id,
+        "timestamp": update.effective_message.date.timestamp(),
+        "languages": lang.upper(),
+        "file": path,
+    }
+    await __send_envelop(envelop)
+
+
 async def __process_images(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -605,7 +730,10 @@ async def error_handle(update: Update, context: CallbackContext) -> None:
 
 
 def telegram_api_handler(event, context):
-    return asyncio.get_event_loop().run_until_complete(_main(event))
+    try:
+        return asyncio.get_event_loop().run_until_complete(_main(event))
+    finally:
+        put_call_metrics()
 
 
 async def _main(event):
@@ -624,7 +752,12 @@ async def _main(event):
             ["creative", "balanced", "precise"], set_style, filters=filters.COMMAND
         )
     )
+    app.add_handler(CommandHandler("stream", toggle_stream, filters=filters.COMMAND))
+    app.add_handler(CommandHandler("cache", toggle_cache, filters=filters.COMMAND))
+    app.add_handler(CommandHandler("race", toggle_race, filters=filters.COMMAND))
     app.add_handler(CommandHandler("help", help_handler, filters=filters.COMMAND))
+    app.add_handler(CommandHandler("history", history_handler, filters=filters.COMMAND))
+    app.add_handler(CallbackQueryHandler(history_callback, pattern=f"^{callback_prefix}\\|"))
     app.add_handler(CommandHandler("errors", grab_errors, filters=filters.COMMAND))
     app.add_handler(CommandHandler("redrive", redrive_dlq, filters=filters.COMMAND))
     app.add_handler(CommandHandler("ping", ping, filters=filters.COMMAND))
@@ -638,7 +771,10 @@ async def _main(event):
                     filters.Regex(r"^([a-zA-Z]{2}(\-[a-zA-Z]{2})*,*\s*)+$"), tr_lang
                 )
             ],
-            TEXT: [MessageHandler(filters.TEXT, tr_text)],
+            TEXT: [
+                MessageHandler(filters.TEXT, tr_text),
+                MessageHandler(filters.Document.ALL, tr_document),
+            ],
         },
         fallbacks=[CommandHandler("cancel", tr_cancel)],
     )
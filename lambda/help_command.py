@@ -18,6 +18,7 @@ async def help_handler(update: Update, context: CallbackContext) -> None:
 Target language can be set either clicking menu button *or* typing in language code\(s\) by hands\. 
 You also can set languages separated with commas directly in the \/tr command, like this: \/tr pl,ru - in this case bot skips the question about language.  
 Several language codes must be separated by comma\. Example: _pl,ru,en\-gb_
+Documents \(docx, pptx, xlsx, pdf, txt, html\) are translated too: send the file after \/tr or with the caption \/tr pl,ru, the translated files come back one per language\.
 
 Supported languages are:
 
@@ -53,10 +54,12 @@ TR    Turkish
 UA    Ukrainian"""  # noqa: E501
     elif text.endswith("imagine"):
         message = """\/imagine \- Creating images using *DALL\-E* AI engine\. Usage: \/imagine PROMPT
-Example: \/imagine Cute kitty plays with yarn ball"""  # noqa: E501
+Example: \/imagine Cute kitty plays with yarn ball
+Images of a prompt asked before are sent again right away, add *\-\-fresh* to the prompt to generate new ones\."""  # noqa: E501
     elif text.endswith("ideogram"):
         message = """\/ideogram \- Creating images and typographics using *Ideogram.ai* engine\. Usage: \/imagine PROMPT
-Example: \/imagine Cute kitty plays with yarn ball"""  # noqa: E501
+Example: \/imagine Cute kitty plays with yarn ball
+Images of a prompt asked before are sent again right away, add *\-\-fresh* to the prompt to generate new ones\."""  # noqa: E501
     elif (
         text.endswith("creative")
         or text.endswith("balanced")
@@ -67,6 +70,19 @@ Available values are:
     \• *creative* \(default\)\. More imaginative responses, suitable for creative writing and brainstorming\.
     \• *balanced*\. Balanced mix of information and creativity\.
     \• *precise*\. Concise and factual responses\."""  # noqa: E501
+    elif text.endswith("stream"):
+        message = """\/stream \- Switches streaming of answers on and off\. When it is on, the answer appears in a single message that is updated while the engine is still writing it\.
+Streaming is supported by the *gemini* and *claude* engines, other engines reply once the answer is complete\."""  # noqa: E501
+    elif text.endswith("cache"):
+        message = """\/cache \- Switches cached answers on and off\. When it is on, the first question of a new conversation asked before word for word gets the answer given then right away\.
+Cached answers are supported by the *gemini* engine and are kept for a day\."""  # noqa: E501
+    elif text.endswith("race"):
+        message = """\/race \- Switches the race of engines on and off\. When it is on and several engines are set with \/engines, only the first answer is sent and the other engines stop writing theirs\.
+Racing answers are sent once complete, even when streaming is on\."""  # noqa: E501
+    elif text.endswith("history"):
+        message = """\/history \- Lists the latest exchanges of your current conversation with every engine\. Usage: \/history \[ENGINE\]
+Example: \/history gemini \- lists the *gemini* conversation only\.
+Tap a number to read the whole exchange, *Older* shows the previous page\."""  # noqa: E501
     elif text.endswith("engines"):
         message = """\/engines \- You can activate multiple AI engines to set them answering in parallel\. Put their names separated with comma as an argument\.
 Example: \/engines gemini,claude,llama \- all listed engines will respond simultaneously\.
@@ -95,6 +111,10 @@ Supported commands are:
 \/claude \- Switch answers to Anthropic Claude\.ai AI model
 \/gemini \- Switch answers to Google Gemini AI model
 \/engines \- Activates multiple AI engines at once, comma separated list
+\/stream \- Switch streaming of answers on or off
+\/cache \- Switch cached answers to repeated questions on or off
+\/race \- Switch between answers of all engines and the first answer only
+\/history \- List the latest exchanges of your conversations
 \/creative \- Set tone of responses to more creative \(Default\)
 \/balanced \- Set tone of responses to more balanced
 \/precise \- Set tone of responses to more precise"""  # noqa: E501
@@ -0,0 +1,215 @@
+import datetime
+import logging
+from typing import Optional
+
+from boto3.dynamodb.conditions import Key
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import CallbackContext
+
+from engines.aws_clients import table
+from engines.conversation_codec import body_attributes, unpack_conversation
+
+from .utils import decode_message, split_long_message
+
+logging.basicConfig()
+logging.getLogger().setLevel("INFO")
+
+page_size = 5
+history_engines = ["gemini", "claude", "llama", "ideogram"]
+# callback data is limited to 64 bytes by Telegram, a page token is the engine, the
+# timestamp and the start of the request ID of the last listed exchange, the
+# conversation is looked up by the user
+callback_prefix = "hist"
+token_id_length = 16
+max_message_length = 4000
+
+
+class ConversationHistory:
+    """Reads the exchanges of the current conversation of a user with an engine.
+
+    Pages are queried from the 'timestamp-index' with the short preview only,
+    the full exchange is read when the user opens it.
+    """
+
+    def __init__(self) -> None:
+        self.context_table = table("user-context")
+        self.conversations_table = table("user-conversations")
+
+    def conversations(self, user_id: str) -> dict:
+        """Current conversation IDs of the user, by engine, in a single query."""
+        resp = self.context_table.query(
+            KeyConditionExpression=Key("user_id").eq(user_id),
+            ProjectionExpression="engine, conversation_id",
+        )
+        return {
+            item["engine"]: item["conversation_id"]
+            for item in resp["Items"]
+            if item.get("conversation_id")
+        }
+
+    def conversation_id(self, user_id: str, engine: str) -> Optional[str]:
+        resp = self.context_table.get_item(
+            Key={"user_id": user_id, "engine": engine},
+            ProjectionExpression="conversation_id",
+        )
+        return (resp.get("Item") or {}).get("conversation_id")
+
+    def page(self, conversation_id: str, before: Optional[tuple] = None) -> tuple:
+        """Returns the latest exchanges listed after the `before` token and the next token.
+
+        A token is the (timestamp, request ID start) of the last listed exchange.
+        Exchanges of the same second are listed by request ID, so the ones
+        sharing the second of the last listed exchange go on the next page.
+        """
+        condition = Key("conversation_id").eq(conversation_id)
+        if before is not None:
+            condition = condition & Key("timestamp").lte(before[0])
+        query = {
+            "IndexName": "timestamp-index",
+            "KeyConditionExpression": condition,
+            "ProjectionExpression": "request_id, #ts, preview",
+            "ExpressionAttributeNames": {"#ts": "timestamp"},
+            "ScanIndexForward": False,
+            "Limit": page_size + 1,
+        }
+        items = []
+        while True:
+            resp = self.conversations_table.query(**query)
+            items.extend(
+                item for item in resp["Items"] if before is None or _listing_key(item) < before
+            )
+            if "LastEvaluatedKey" not in resp:
+                break
+            # the page is complete once an older second follows it
+            if len(items) > page_size and int(items[-1]["timestamp"]) < int(
+                items[page_size - 1]["timestamp"]
+            ):
+                break
+            query["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+        items.sort(key=_listing_key, reverse=True)
+        if len(items) <= page_size:
+            return items, None
+        last = items[page_size - 1]
+        return items[:page_size], (int(last["timestamp"]), last["request_id"][:token_id_length])
+
+    def exchange(self, conversation_id: str, request_id: str) -> Optional[dict]:
+        resp = self.conversations_table.get_item(
+            Key={"conversation_id": conversation_id, "request_id": request_id},
+            ProjectionExpression=body_attributes,
+        )
+        if "Item" not in resp:
+            return None
+        return unpack_conversation(resp["Item"])
+
+
+def _listing_key(item: dict) -> tuple:
+    return (int(item["timestamp"]), item["request_id"])
+
+
+history = ConversationHistory()
+
+
+async def history_handler(update: Update, context: CallbackContext) -> None:
+    """/history [engine] lists the latest exchanges of one or every engine."""
+    if update.effective_user is None or update.effective_message is None:
+        return
+    args = (update.effective_message.text or "").split()[1:]
+    user_id = __user_id(update)
+    if args:
+        engine = args[0].lower()
+        if engine not in history_engines:
+            await update.effective_message.reply_text(
+                text=f"No history for '{engine}', use one of {', '.join(history_engines)}"
+            )
+            return
+        conversations = {engine: history.conversation_id(user_id, engine)}
+    else:
+        conversations = history.conversations(user_id)
+    pages = [
+        __render_page(engine, conversations.get(engine), before=None)
+        for engine in history_engines
+        if engine in conversations
+    ]
+    if not pages:
+        await update.effective_message.reply_text(text="There is no conversation yet")
+    for text, markup in pages:
+        await update.effective_message.reply_text(text=text, reply_markup=markup)
+
+
+async def history_callback(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    if query is None or query.data is None or update.effective_user is None:
+        return
+    await query.answer()
+    _, action, engine, value = query.data.split("|", 3)
+    user_id = __user_id(update)
+    conversation_id = history.conversation_id(user_id, engine)
+    if action == "p":
+        # tokens without the request ID start from before it was added
+        timestamp, _, request_id = value.partition(":")
+        text, markup = __render_page(
+            engine, conversation_id, before=(int(timestamp), request_id)
+        )
+        await query.edit_message_text(text=text, reply_markup=markup)
+        return
+    exchange = history.exchange(conversation_id, value) if conversation_id else None
+    if exchange is None:
+        await query.message.reply_text(text="This exchange is no longer available")
+        return
+    text = f"Request:\n{__request_text(exchange)}\n\nResponse:\n{__response_text(exchange)}"
+    messages = [text]
+    if len(text) > max_message_length:
+        messages = split_long_message(text, header=engine, max_length=max_message_length)
+    for message in messages:
+        await query.message.reply_text(text=message)
+
+
+def __render_page(
+    engine: str, conversation_id: Optional[str], before: Optional[tuple]
+) -> tuple:
+    if not conversation_id:
+        return f"No {engine} conversation yet", None
+    items, next_before = history.page(conversation_id, before=before)
+    if not items:
+        return f"No older {engine} exchanges", None
+    lines = [f"Latest {engine} exchanges:" if before is None else f"Older {engine} exchanges:"]
+    buttons = []
+    for i, item in enumerate(items, start=1):
+        time = datetime.datetime.fromtimestamp(int(item["timestamp"]), datetime.UTC)
+        lines.append(f"{i}. {time:%Y-%m-%d %H:%M} {item.get('preview') or '(no preview)'}")
+        buttons.append(
+            InlineKeyboardButton(
+                text=str(i), callback_data=f"{callback_prefix}|o|{engine}|{item['request_id']}"
+            )
+        )
+    keyboard = [buttons]
+    if next_before is not None:
+        token = f"{next_before[0]}:{next_before[1]}"
+        keyboard.append(
+            [
+                InlineKeyboardButton(
+                    text="Older", callback_data=f"{callback_prefix}|p|{engine}|{token}"
+                )
+            ]
+        )
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
+def __user_id(update: Update) -> str:
+    return f"{update.effective_user.id}_{getattr(update.effective_chat, 'id', None)}"
+
+
+def __request_text(exchange: dict) -> str:
+    return exchange.get("request") or exchange.get("text") or ""
+
+
+def __response_text(exchange: dict) -> str:
+    response = exchange.get("response") or ""
+    if "request" in exchange:
+        return response
+    # image engines store the delivered payload, its response is encoded
+    try:
+        return decode_message(response)
+    except Exception as e:
+        logging.error("Cannot decode stored response", exc_info=e)
+        return "(not available)"
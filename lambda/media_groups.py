@@ -0,0 +1,68 @@
+import asyncio
+import datetime
+import logging
+from typing import Optional
+
+from botocore.exceptions import ClientError
+
+from engines.aws_clients import table
+from engines.bot_state import state_key, table_name
+
+logging.basicConfig()
+logging.getLogger().setLevel("INFO")
+
+# Telegram sends the files of an album as separate updates within a second or so
+media_group_wait = 2.0
+
+
+class MediaGroup:
+    """Files of a Telegram album collected into a single request.
+
+    Every update of the album appends its uploaded file to a row in the
+    'bot-state' table and waits for the others. The update that is still the
+    last one after `media_group_wait` sends the envelope with all the files,
+    the caption is taken from whichever update carried it.
+    """
+
+    def __init__(self, media_group_id: str) -> None:
+        self.name = f"album {media_group_id}"
+        self.key = state_key("album", media_group_id)
+        self.table = table(table_name)
+
+    async def collect(self, path: str, caption: Optional[str]) -> Optional[tuple]:
+        """Adds the file, returns (files, caption) when this update sends the album.
+
+        A file arriving after the album has been sent is returned on its own.
+        """
+        exp_time = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        update = "SET files = list_append(if_not_exists(files, :empty), :file), #exp = :exp"
+        values = {":empty": [], ":file": [path], ":exp": int(exp_time.timestamp())}
+        if caption:
+            update += ", caption = :caption"
+            values[":caption"] = caption
+        resp = self.table.update_item(
+            Key=self.key,
+            UpdateExpression=update,
+            ExpressionAttributeNames={"#exp": "exp"},
+            ExpressionAttributeValues=values,
+            ReturnValues="ALL_NEW",
+        )
+        count = len(resp["Attributes"]["files"])
+        await asyncio.sleep(media_group_wait)
+        try:
+            resp = self.table.update_item(
+                Key=self.key,
+                UpdateExpression="SET sent = :count",
+                ConditionExpression="attribute_not_exists(sent) AND size(files) = :count",
+                ExpressionAttributeValues={":count": count},
+                ReturnValues="ALL_NEW",
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            item = self.table.get_item(Key=self.key, ConsistentRead=True)["Item"]
+            if "sent" in item and count > item["sent"]:
+                logging.info(f"File {path} arrived after {self.name} was sent")
+                return ([path], caption)
+            return None
+        return (resp["Attributes"]["files"], resp["Attributes"].get("caption"))
@@ -1,14 +1,19 @@
 import asyncio
 import json
 import logging
+import time
 from urllib.parse import urlparse
 
-from telegram import constants
-from telegram.error import BadRequest
+from telegram import InputFile, constants
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
 )
 
+from engines.aws_clients import client, put_call_metrics
+from engines.image_cache import ImageCache
+
+from .stream_messages import StreamMessages
 from .utils import decode_message, read_ssm_param, split_long_message
 
 MAX_MESSAGE_SIZE = 4060
@@ -31,7 +36,18 @@ def response_handler(event, context) -> None:
         message_id = int(payload["message_id"])
         message = decode_message(payload["response"])
         if "imagine" in payload["type"] or "ideogram" in payload["type"]:
-            __send_images(chat_id, message_id, message)
+            by_file_id = payload.get("file_ids", False)
+            file_ids = __send_images(chat_id, message_id, message, by_file_id)
+            # only a complete delivery is reused
+            complete = len(file_ids) == len(message.splitlines())
+            if payload.get("image_cache_key") and not by_file_id and complete:
+                __save_file_ids(payload["image_cache_key"], payload["engine"], file_ids)
+        elif "document" in payload:
+            __send_document(
+                chat_id, message_id, payload["engine"], message, payload["document"]
+            )
+        elif "stream" in payload:
+            __send_stream(chat_id, message_id, payload["engine"], message, payload["stream"])
         else:
             parts = split_long_message(
                 message, f"*__{payload['engine']}__*", MAX_MESSAGE_SIZE
@@ -39,11 +55,12 @@ def response_handler(event, context) -> None:
             logging.info(f"Sending message in {parts.__len__()} parts")
             for part in parts:
                 __send_text(chat_id, message_id, part)
+    put_call_metrics()
 
 
-def __send_text(chat_id: str, message_id: int, text: str) -> None:
+def __send_text(chat_id: str, message_id: int, text: str) -> int:
     try:
-        asyncio.get_event_loop().run_until_complete(
+        sent = asyncio.get_event_loop().run_until_complete(
             bot.send_message(
                 chat_id=chat_id,
                 text=text,
@@ -57,7 +74,7 @@ def __send_text(chat_id: str, message_id: int, text: str) -> None:
         logging.error(br)
         logging.info(text)
         # send without reply
-        asyncio.get_event_loop().run_until_complete(
+        sent = asyncio.get_event_loop().run_until_complete(
             bot.send_message(
                 chat_id=chat_id,
                 text=text,
@@ -68,7 +85,7 @@ def __send_text(chat_id: str, message_id: int, text: str) -> None:
     except Exception as e:
         logging.error(f"Cannot send message, error: {e}, \nPayload: {text}")
         # send plaintext
-        asyncio.get_event_loop().run_until_complete(
+        sent = asyncio.get_event_loop().run_until_complete(
             bot.send_message(
                 chat_id=chat_id,
                 text=text.replace("__", " "),
@@ -77,15 +94,111 @@ def __send_text(chat_id: str, message_id: int, text: str) -> None:
                 disable_web_page_preview=True,
             )
         )
+    return sent.message_id
+
+
+def __send_stream(
+    chat_id: str, message_id: int, engine: str, message: str, stream: dict
+) -> None:
+    """Renders a snapshot of a streamed response by editing already sent messages."""
+    seq = int(stream["seq"])
+    final = stream.get("final", False)
+    messages = StreamMessages(chat_id=chat_id, message_id=message_id, engine=engine)
+    message_ids = messages.acquire(seq, final)
+    if message_ids is None:
+        return
+    if message:
+        pages = split_long_message(message, f"*__{engine}__*", MAX_MESSAGE_SIZE)
+    else:
+        pages = [f"*__{engine}__*\n\\.\\.\\."]
+    # the page counter in headers changes only when the text rolls over to a new page,
+    # the final snapshot re-renders every page over whatever was edited before
+    first = len(message_ids) - 1 if len(pages) == len(message_ids) and not final else 0
+    rendered = False
+    try:
+        for i in range(max(first, 0), len(pages)):
+            if i < len(message_ids):
+                __edit_text(chat_id, message_ids[i], pages[i], final)
+            else:
+                message_ids.append(__send_text(chat_id, message_id, pages[i]))
+        rendered = True
+    finally:
+        # a final snapshot failing half way is rendered again when redelivered
+        messages.release(message_ids, finished=final and rendered)
+    if final:
+        logging.info(
+            f"Stream of {engine} finished in {seq} snapshots, ttft {stream.get('ttft_ms')} ms"
+        )
+
+
+def __edit_text(chat_id: str, message_id: int, text: str, final: bool) -> None:
+    try:
+        asyncio.get_event_loop().run_until_complete(
+            bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+                parse_mode=constants.ParseMode.MARKDOWN_V2,
+                disable_web_page_preview=True,
+            )
+        )
+    except RetryAfter as ra:
+        # intermediate snapshots are superseded by the next one anyway
+        if not final:
+            logging.info(f"Edit throttled, skipping snapshot: {ra}")
+            return
+        time.sleep(ra.retry_after)
+        __edit_text(chat_id, message_id, text, final)
+    except BadRequest as br:
+        if "not modified" in str(br):
+            return
+        logging.error(br)
+        asyncio.get_event_loop().run_until_complete(
+            bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+                disable_web_page_preview=True,
+            )
+        )
+
+
+def __send_document(
+    chat_id: str, message_id: int, engine: str, message: str, document: dict
+) -> None:
+    """Sends a file produced by an engine from the results prefix of the bot bucket."""
+    logging.info(f"Sending document s3 {document['bucket']}/{document['key']}")
+    body = client("s3").get_object(Bucket=document["bucket"], Key=document["key"])["Body"]
+    try:
+        asyncio.get_event_loop().run_until_complete(
+            bot.send_document(
+                chat_id=chat_id,
+                document=InputFile(body, filename=document["file_name"]),
+                caption=f"*__{engine}__*\n{message}",
+                parse_mode=constants.ParseMode.MARKDOWN_V2,
+                reply_to_message_id=message_id,
+                disable_notification=True,
+            )
+        )
+    except Exception as e:
+        logging.error(f"Cannot send document, error: {e}")
+        __send_text(chat_id, message_id, f"*__{engine}__*\n{message}\nCannot send the file")
+    finally:
+        body.close()
 
 
-def __send_images(chat_id: str, message_id: int, message: str) -> None:
+def __send_images(
+    chat_id: str, message_id: int, message: str, by_file_id: bool = False
+) -> list:
+    """Sends images by URL or by Telegram file ID, returns the file IDs of the sent ones."""
+    file_ids = []
     for url in iter(message.splitlines()):
-        if not __is_valid_url(url):
+        if not by_file_id and not __is_valid_url(url):
             logging.error(f"chat_id:{chat_id}, message_id: {message_id}")
             __send_text(chat_id, message_id, f"Error: {url}")
+            continue
         try:
-            asyncio.get_event_loop().run_until_complete(
+            sent = asyncio.get_event_loop().run_until_complete(
                 bot.send_photo(
                     chat_id=chat_id,
                     photo=url,
@@ -93,9 +206,18 @@ def __send_images(chat_id: str, message_id: int, message: str) -> None:
                     disable_notification=True,
                 )
             )
+            file_ids.append(sent.photo[-1].file_id)
         except Exception as e:
             logging.error(f"Cannot send message, error: {e}, \nPayload: {url}")
             logging.info(message)
+    return file_ids
+
+
+def __save_file_ids(cache_key: str, engine: str, file_ids: list) -> None:
+    """Lets later requests of the same prompt send the images by file ID."""
+    if not file_ids:
+        return
+    ImageCache(engine=engine).save_file_ids(cache_key, file_ids)
 
 
 def __is_valid_url(url) -> bool:
@@ -0,0 +1,95 @@
+import datetime
+import logging
+import time
+from typing import Optional
+
+from botocore.exceptions import ClientError
+
+from engines.aws_clients import table
+from engines.bot_state import state_key, table_name
+
+logging.basicConfig()
+logging.getLogger().setLevel("INFO")
+
+# a results handler renders one snapshot of a stream at a time, a crashed one
+# blocks the stream that long at most
+lock_duration = 20
+lock_poll_interval = 0.2
+
+
+class StreamMessages:
+    """Telegram messages displaying a streamed engine response.
+
+    State is kept in the 'bot-state' table so that every results handler
+    invocation of the same stream edits the same messages. Snapshots are
+    rendered one at a time under a lock on the row: an intermediate snapshot
+    finding the stream locked is skipped, the next one supersedes it, while
+    the final snapshot waits for the lock and is always rendered.
+    """
+
+    def __init__(self, chat_id: str, message_id: int, engine: str) -> None:
+        self.name = f"stream {chat_id}_{message_id} of {engine}"
+        self.key = state_key("stream", f"{chat_id}_{message_id}_{engine}")
+        self.seq = None
+        self.table = table(table_name)
+
+    def acquire(self, seq: int, final: bool) -> Optional[list]:
+        """Locks the stream to render snapshot `seq`, returns ids of already sent messages.
+
+        Returns None when the snapshot is stale, the final one has already been
+        rendered, or another intermediate snapshot is being rendered.
+        """
+        exp_time = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        condition = "attribute_not_exists(final) AND (attribute_not_exists(locked_until) OR locked_until < :now)"  # noqa: E501
+        if not final:
+            condition += " AND (attribute_not_exists(seq) OR seq < :seq)"
+        deadline = time.time() + lock_duration
+        while True:
+            now = int(time.time())
+            try:
+                resp = self.table.update_item(
+                    Key=self.key,
+                    UpdateExpression="SET seq = :seq, locked_until = :until, #exp = :exp",
+                    ConditionExpression=condition,
+                    ExpressionAttributeNames={"#exp": "exp"},
+                    ExpressionAttributeValues={
+                        ":seq": seq,
+                        ":now": now,
+                        ":until": now + lock_duration,
+                        ":exp": int(exp_time.timestamp()),
+                    },
+                    ReturnValues="ALL_NEW",
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+                if not final or time.time() > deadline or self.__finished():
+                    logging.info(f"Skipping snapshot {seq} of {self.name}")
+                    return None
+                time.sleep(lock_poll_interval)
+                continue
+            self.seq = seq
+            return [int(i) for i in resp["Attributes"].get("message_ids", [])]
+
+    def release(self, message_ids: list, finished: bool) -> None:
+        """Saves the sent messages and unlocks the stream, `finished` once the final one is rendered."""
+        update = "SET message_ids = :ids REMOVE locked_until"
+        values = {":ids": message_ids, ":seq": self.seq}
+        if finished:
+            update = "SET message_ids = :ids, final = :final REMOVE locked_until"
+            values[":final"] = True
+        try:
+            self.table.update_item(
+                Key=self.key,
+                UpdateExpression=update,
+                ConditionExpression="seq = :seq",
+                ExpressionAttributeValues=values,
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            logging.info(f"Lock of {self.name} was taken over after expiry")
+
+    def __finished(self) -> bool:
+        item = self.table.get_item(Key=self.key, ConsistentRead=True).get("Item")
+        return bool(item and item.get("final"))
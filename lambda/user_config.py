@@ -2,7 +2,7 @@ import json
 import logging
 import time
 
-import boto3
+from engines.aws_clients import table
 
 logging.basicConfig()
 logging.getLogger().setLevel("INFO")
@@ -10,8 +10,7 @@ logging.getLogger().setLevel("INFO")
 
 class UserConfig:
     def __init__(self) -> None:
-        dynamodb = boto3.resource("dynamodb")
-        self.table = dynamodb.Table("user-configurations")  # type: ignore
+        self.table = table("user-configurations")
 
     def read(self, user_id: int) -> dict:
         try:
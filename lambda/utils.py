@@ -1,4 +1,6 @@
+import asyncio
 import base64
+import io
 import json
 import logging
 import os
@@ -7,14 +9,17 @@ import uuid
 import zlib
 from functools import wraps
 
-import boto3
 import wget
+import zstandard
 from telegram import File, Update, constants
 
+from engines.aws_clients import client
+
 logging.basicConfig()
 logging.getLogger().setLevel("INFO")
 
 ref_link_pattern = re.compile(r"\[(.*?)\]\:\s?(.*?)\s\"(.*?)\"\n?")
+transcription_poll_interval = 0.5
 esc_pattern = re.compile(f"(?<!\|)([{re.escape(r'.-+#|{}!=()<>')}])(?!\|)")
 
 
@@ -59,7 +64,7 @@ def restricted(allowed_roles: list):
 
 
 async def generate_transcription(file) -> str:
-    transcribe_client = boto3.client("transcribe")
+    transcribe_client = client("transcribe")
     message_id = str(uuid.uuid4())
     s3_bucket = read_ssm_param(param_name="BOT_S3_BUCKET")
     remote_s3_path = await upload_to_s3(file, s3_bucket, "voice", f"{message_id}.ogg")
@@ -74,6 +79,8 @@ async def generate_transcription(file) -> str:
     while job_status != "COMPLETED":
         status = transcribe_client.get_transcription_job(TranscriptionJobName=job_name)
         job_status = status["TranscriptionJob"]["TranscriptionJobStatus"]
+        if job_status != "COMPLETED":
+            await asyncio.sleep(transcription_poll_interval)
     transcript = status["TranscriptionJob"]["Transcript"]["TranscriptFileUri"]  # type: ignore
     logging.info(transcript)
     output_location = f"/tmp/output_{message_id}.json"
@@ -90,14 +97,13 @@ async def upload_to_s3(
     logging.info(f"Saving file to {local_path}")
     await file.download_to_drive(local_path)
     logging.info(f"Uploading '{local_path}' to s3 {s3_bucket}/{s3_prefix}/{file_name}")
-    boto3.client("s3").upload_file(local_path, s3_bucket, f"{s3_prefix}/{file_name}")
+    client("s3").upload_file(local_path, s3_bucket, f"{s3_prefix}/{file_name}")
     os.remove(local_path)
     return f"s3://{s3_bucket}/{s3_prefix}/{file_name}"
 
 
 def read_ssm_param(param_name: str):
-    ssm_client = boto3.client(service_name="ssm")
-    return ssm_client.get_parameter(Name=param_name)["Parameter"]["Value"]
+    return client("ssm").get_parameter(Name=param_name)["Parameter"]["Value"]
 
 
 def escape_markdown_v2(text: str) -> str:
@@ -105,11 +111,35 @@ def escape_markdown_v2(text: str) -> str:
 
 
 def decode_message(encoded: str) -> str:
-    bin = base64.b64decode(encoded.encode("ascii"))
+    # base64 has no ':' so untagged payloads are the legacy zlib+base64 format
+    codec, tagged, body = encoded.partition(":")
+    if not tagged:
+        codec, body = "z", encoded
+    if codec == "n":
+        return body
+    if codec == "s3":
+        codec, _, location = body.partition(":")
+        bucket, _, key = location.partition("/")
+        return __read_s3_message(codec, bucket, key)
+    bin = base64.b64decode(body.encode("ascii"))
+    if codec == "zs":
+        return zstandard.ZstdDecompressor().decompress(bin).decode("utf-8")
     unzipped = zlib.decompress(bin)
     return unzipped.decode("utf-8")
 
 
+def __read_s3_message(codec: str, bucket: str, key: str) -> str:
+    logging.info(f"Reading result body from s3 {bucket}/{key}")
+    body = client("s3").get_object(Bucket=bucket, Key=key)["Body"]
+    if codec == "zs":
+        reader = zstandard.ZstdDecompressor().stream_reader(body)
+        return io.TextIOWrapper(reader, encoding="utf-8").read()
+    decompressor = zlib.decompressobj()
+    chunks = [decompressor.decompress(chunk) for chunk in body.iter_chunks()]
+    chunks.append(decompressor.flush())
+    return b"".join(chunks).decode("utf-8")
+
+
 def recursive_stringify(arr) -> str:
     result = []
     for item in arr:
@@ -1,16 +1,17 @@
 import asyncio
 import logging
 
-import boto3
 import requests
 from telegram.ext import Application
 
+from engines.aws_clients import client
+
 logging.basicConfig()
 logging.getLogger().setLevel("INFO")
 
 
 async def set_webhook():
-    _ssm_client = boto3.client(service_name="ssm")
+    _ssm_client = client("ssm")
     token = _ssm_client.get_parameter(Name="TELEGRAM_TOKEN")["Parameter"]["Value"]
     url = _ssm_client.get_parameter(Name="BOT_LAMBDA_URL")["Parameter"]["Value"]
     secret = _ssm_client.get_parameter(Name="SECRET_TOKEN")["Parameter"]["Value"]
@@ -57,6 +57,7 @@ class ChatBotStack(Stack):
                     "sqs:ListQueues",
                     "sqs:SendMessage",
                     "sqs:DeleteMessage",
+                    "sqs:ChangeMessageVisibility",
                     "sqs:GetQueueAttributes",
                     "sqs:StartMessageMoveTask",
                     "sqs:ListMessageMoveTasks",
@@ -83,6 +84,14 @@ class ChatBotStack(Stack):
             noncurrent_version_expiration=Duration.days(15),
             enabled=True,
         )
+        # oversized engine results are passed to the results handler through s3
+        bucket.add_lifecycle_rule(
+            id="results-expiration-rule",
+            prefix="results/",
+            expiration=Duration.days(1),
+            noncurrent_version_expiration=Duration.days(1),
+            enabled=True,
+        )
         result_dlq = aws_sqs.Queue(
             self,
             "Result-Queue-DLQ",
@@ -18,7 +18,7 @@ class DatabaseStack(Stack):
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
         )
 
-        new_conversationTable = dynamodb.Table(
+        self.conversations_table = dynamodb.Table(
             self,
             "user-conversations-table",
             table_name="user-conversations",
@@ -30,9 +30,10 @@ class DatabaseStack(Stack):
             ),
             removal_policy=RemovalPolicy.RETAIN,
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            stream=dynamodb.StreamViewType.NEW_IMAGE,
         )
 
-        new_conversationTable.add_global_secondary_index(
+        self.conversations_table.add_global_secondary_index(
             index_name="userid-index",
             partition_key=dynamodb.Attribute(
                 name="user_id", type=dynamodb.AttributeType.STRING
@@ -43,7 +44,7 @@ class DatabaseStack(Stack):
             projection_type=dynamodb.ProjectionType.ALL,
         )
 
-        new_conversationTable.add_local_secondary_index(
+        self.conversations_table.add_local_secondary_index(
             index_name="timestamp-index",
             sort_key=dynamodb.Attribute(
                 name="timestamp", type=dynamodb.AttributeType.NUMBER
@@ -72,7 +73,7 @@ class DatabaseStack(Stack):
             ),
             projection_type=dynamodb.ProjectionType.ALL,
         )
-        dynamodb.Table(
+        jobsTable = dynamodb.Table(
             self,
             "request-jobs-table",
             table_name="request-jobs",
@@ -86,3 +87,29 @@ class DatabaseStack(Stack):
             time_to_live_attribute="exp",
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
         )
+        # sparse, only the tracked jobs have a state
+        jobsTable.add_global_secondary_index(
+            index_name="state-index",
+            partition_key=dynamodb.Attribute(
+                name="state", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="timestamp", type=dynamodb.AttributeType.NUMBER
+            ),
+            projection_type=dynamodb.ProjectionType.ALL,
+        )
+        # caches, claims, leases and other short-lived state, see engines/bot_state.py
+        dynamodb.Table(
+            self,
+            "bot-state-table",
+            table_name="bot-state",
+            partition_key=dynamodb.Attribute(
+                name="state_id", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="kind", type=dynamodb.AttributeType.STRING
+            ),
+            removal_policy=RemovalPolicy.DESTROY,
+            time_to_live_attribute="exp",
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
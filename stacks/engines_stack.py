@@ -6,13 +6,17 @@ from aws_cdk import (
     Stack,
     aws_cloudwatch,
     aws_cloudwatch_actions,
+    aws_events,
+    aws_events_targets,
     aws_iam,
     aws_lambda_event_sources,
     aws_logs,
     aws_sns,
+    aws_sns_subscriptions,
     aws_sqs,
     aws_ssm,
 )
+from aws_cdk import aws_dynamodb as dynamodb
 from aws_cdk import aws_lambda as _lambda
 from aws_cdk.aws_lambda import DockerImageCode, DockerImageFunction
 from constructs import Construct
@@ -21,7 +25,13 @@ ASSET_PATH = "engines"
 
 
 class EnginesStack(Stack):
-    def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+    def __init__(
+        self,
+        scope: Construct,
+        construct_id: str,
+        conversations_table: dynamodb.ITable,
+        **kwargs,
+    ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         self.lambda_role = aws_iam.Role(
@@ -46,6 +56,7 @@ class EnginesStack(Stack):
         self.lambda_role.add_to_policy(
             aws_iam.PolicyStatement(
                 actions=[
+                    "sqs:GetQueueUrl",
                     "sqs:SendMessage",
                     "sqs:DeleteMessage",
                     "sns:ReceiveMessage",
@@ -129,10 +140,77 @@ class EnginesStack(Stack):
                     allowlist=["translate"]
                 ),
             },
-            handler=f"{ASSET_PATH}.deepl_tr.sns_handler",
+            handler=f"{ASSET_PATH}.deepl_tr.sqs_handler",
             log_group=deepl_log_group,
         )
 
+        # DeepL document status checks, delayed by the handler with a growing backoff
+        document_timeout = Duration.minutes(2)
+        document_dlq = aws_sqs.Queue(
+            self,
+            "DeepL-Document-Queue-DLQ",
+            queue_name="DeepL-Document-Queue-DLQ",
+            removal_policy=RemovalPolicy.DESTROY,
+            encryption=aws_sqs.QueueEncryption.SQS_MANAGED,
+            retention_period=Duration.days(5),
+            enforce_ssl=True,
+        )
+        document_queue = aws_sqs.Queue(
+            self,
+            "DeepL-Document-Queue",
+            queue_name="DeepL-Document-Queue",
+            removal_policy=RemovalPolicy.DESTROY,
+            visibility_timeout=document_timeout.plus(Duration.minutes(1)),
+            encryption=aws_sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+            dead_letter_queue=aws_sqs.DeadLetterQueue(
+                max_receive_count=3, queue=document_dlq
+            ),
+        )
+        deepl_document_log_group = aws_logs.LogGroup(
+            self,
+            "DeepLDocumentHandlerLogGroup",
+            log_group_name="/aws/lambda/DeepLDocumentHandler",
+            retention=aws_logs.RetentionDays.TWO_WEEKS,
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+        document_handler = DockerImageFunction(
+            self,
+            "DeepLDocumentHandler",
+            function_name="DeepLDocumentHandler",
+            code=DockerImageCode.from_image_asset(
+                directory=self.docker_file_path,
+                file="Dockerfile",
+                exclude=["cdk.out"],
+                cmd=[f"{ASSET_PATH}.deepl_tr.document_handler"],
+            ),
+            timeout=document_timeout,
+            memory_size=256,
+            log_group=deepl_document_log_group,
+            role=self.lambda_role,
+        )
+        document_handler.add_event_source(
+            aws_lambda_event_sources.SqsEventSource(
+                document_queue,
+                batch_size=5,
+                max_batching_window=Duration.seconds(1),
+                report_batch_item_failures=True,
+            )
+        )
+        document_dlq_alarm = aws_cloudwatch.Alarm(
+            self,
+            "DeepLDocumentDlqAlarm",
+            alarm_name="DeepLDocumentDlqAlarm",
+            alarm_description="Alarm when DeepL document DLQ has messages",
+            metric=document_dlq.metric_approximate_number_of_messages_visible(),
+            threshold=0,
+            evaluation_periods=1,
+            comparison_operator=aws_cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+        )
+        document_dlq_alarm.add_alarm_action(
+            aws_cloudwatch_actions.SnsAction(self.alarm_topic)
+        )
+
         # LLama2
 
         llama_log_group = aws_logs.LogGroup(
@@ -153,7 +231,7 @@ class EnginesStack(Stack):
                     allowlist=["llama"]
                 ),
             },
-            handler=f"{ASSET_PATH}.monsterapi.sns_handler",
+            handler=f"{ASSET_PATH}.monsterapi.sqs_handler",
             log_group=llama_log_group,
         )
 
@@ -222,6 +300,36 @@ class EnginesStack(Stack):
             string_value=callback_lambda_url.url,
         )
 
+        # polls the jobs whose callback did not arrive in time
+        monsterapi_sweeper_log_group = aws_logs.LogGroup(
+            self,
+            "MonsterApiSweeperLogGroup",
+            log_group_name="/aws/lambda/MonsterApiSweeper",
+            retention=aws_logs.RetentionDays.TWO_WEEKS,
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+        sweeper = DockerImageFunction(
+            self,
+            "MonsterApiSweeper",
+            function_name="MonsterApiSweeper",
+            code=DockerImageCode.from_image_asset(
+                directory=self.docker_file_path,
+                file="Dockerfile",
+                exclude=["cdk.out"],
+                cmd=[f"{ASSET_PATH}.monsterapi_result.sweep_handler"],
+            ),
+            timeout=Duration.minutes(2),
+            memory_size=256,
+            role=self.lambda_role,
+            log_group=monsterapi_sweeper_log_group,
+        )
+        aws_events.Rule(
+            self,
+            "MonsterApiSweeperSchedule",
+            schedule=aws_events.Schedule.rate(Duration.minutes(2)),
+            targets=[aws_events_targets.LambdaFunction(sweeper, retry_attempts=0)],
+        )
+
         # Ideogram
 
         ideogram_log_group = aws_logs.LogGroup(
@@ -239,7 +347,7 @@ class EnginesStack(Stack):
                     allowlist=["ideogram"]
                 ),
             },
-            handler=f"{ASSET_PATH}.ideogram_img.sns_handler",
+            handler=f"{ASSET_PATH}.ideogram_img.sqs_handler",
             log_group=ideogram_log_group,
         )
 
@@ -249,10 +357,11 @@ class EnginesStack(Stack):
             "Ideogram-Result-Queue",
             queue_name="Ideogram-Result-Queue",
             removal_policy=RemovalPolicy.DESTROY,
-            visibility_timeout=Duration.seconds(5),
+            visibility_timeout=Duration.seconds(90),
             delivery_delay=Duration.seconds(5),
             encryption=aws_sqs.QueueEncryption.SQS_MANAGED,
             enforce_ssl=True,
+            dead_letter_queue=aws_sqs.DeadLetterQueue(max_receive_count=3, queue=self.dlq),
         )
         # Create log group for ideogram result handler
         ideogram_result_log_group = aws_logs.LogGroup(
@@ -273,13 +382,21 @@ class EnginesStack(Stack):
                 exclude=["cdk.out"],
                 cmd=[f"{ASSET_PATH}.ideogram_result.sqs_handler"],
             ),
+            timeout=Duration.minutes(1),
             log_group=ideogram_result_log_group,
             role=self.lambda_role,
             dead_letter_queue_enabled=True,
             dead_letter_queue=self.dlq,
         )
+        # checks are rescheduled by the handler with a growing delay, failed
+        # records alone are retried
         resultHandler.add_event_source(
-            aws_lambda_event_sources.SqsEventSource(resultQueue)
+            aws_lambda_event_sources.SqsEventSource(
+                resultQueue,
+                batch_size=10,
+                max_batching_window=Duration.seconds(1),
+                report_batch_item_failures=True,
+            )
         )
 
         # Claude
@@ -302,7 +419,7 @@ class EnginesStack(Stack):
                     allowlist=["claude"]
                 ),
             },
-            handler=f"{ASSET_PATH}.claude.sns_handler",
+            handler=f"{ASSET_PATH}.claude.sqs_handler",
             log_group=claude_log_group,
         )
 
@@ -326,19 +443,139 @@ class EnginesStack(Stack):
                     allowlist=["gemini"]
                 ),
             },
-            handler=f"{ASSET_PATH}.gemini.sns_handler",
+            handler=f"{ASSET_PATH}.gemini.sqs_handler",
             log_group=gemini_log_group,
         )
 
+        # Conversation summarizer
+
+        summarizer_log_group = aws_logs.LogGroup(
+            self,
+            "SummarizerHandlerLogGroup",
+            log_group_name="/aws/lambda/SummarizerHandler",
+            retention=aws_logs.RetentionDays.TWO_WEEKS,
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+
+        summarizer = DockerImageFunction(
+            self,
+            "SummarizerHandler",
+            function_name="SummarizerHandler",
+            code=DockerImageCode.from_image_asset(
+                directory=self.docker_file_path,
+                file="Dockerfile",
+                exclude=["cdk.out"],
+                cmd=[f"{ASSET_PATH}.summarizer.stream_handler"],
+            ),
+            timeout=Duration.minutes(2),
+            memory_size=256,
+            log_group=summarizer_log_group,
+            role=self.lambda_role,
+        )
+        # runs off the user-facing path, after a new turn has been stored
+        summarizer.add_event_source(
+            aws_lambda_event_sources.DynamoEventSource(
+                conversations_table,
+                starting_position=_lambda.StartingPosition.LATEST,
+                batch_size=20,
+                max_batching_window=Duration.seconds(5),
+                retry_attempts=2,
+                bisect_batch_on_error=True,
+                filters=[
+                    _lambda.FilterCriteria.filter(
+                        {
+                            "eventName": _lambda.FilterRule.is_equal("INSERT"),
+                            "dynamodb": {
+                                "NewImage": {
+                                    "engine": {"S": _lambda.FilterRule.is_equal("gemini")}
+                                }
+                            },
+                        }
+                    )
+                ],
+            )
+        )
+
+        # Conversations the engines failed to save after answering
+
+        persist_timeout = Duration.minutes(1)
+        persist_dlq = aws_sqs.Queue(
+            self,
+            "Conversation-Persist-Queue-DLQ",
+            queue_name="Conversation-Persist-Queue-DLQ",
+            removal_policy=RemovalPolicy.DESTROY,
+            encryption=aws_sqs.QueueEncryption.SQS_MANAGED,
+            retention_period=Duration.days(5),
+            enforce_ssl=True,
+        )
+        persist_queue = aws_sqs.Queue(
+            self,
+            "Conversation-Persist-Queue",
+            queue_name="Conversation-Persist-Queue",
+            removal_policy=RemovalPolicy.DESTROY,
+            visibility_timeout=persist_timeout.plus(Duration.minutes(1)),
+            encryption=aws_sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+            dead_letter_queue=aws_sqs.DeadLetterQueue(
+                max_receive_count=5, queue=persist_dlq
+            ),
+        )
+        persist_log_group = aws_logs.LogGroup(
+            self,
+            "ConversationPersistHandlerLogGroup",
+            log_group_name="/aws/lambda/ConversationPersistHandler",
+            retention=aws_logs.RetentionDays.TWO_WEEKS,
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+        persist_handler = DockerImageFunction(
+            self,
+            "ConversationPersistHandler",
+            function_name="ConversationPersistHandler",
+            code=DockerImageCode.from_image_asset(
+                directory=self.docker_file_path,
+                file="Dockerfile",
+                exclude=["cdk.out"],
+                cmd=[f"{ASSET_PATH}.user_context.persist_handler"],
+            ),
+            timeout=persist_timeout,
+            memory_size=256,
+            log_group=persist_log_group,
+            role=self.lambda_role,
+        )
+        persist_handler.add_event_source(
+            aws_lambda_event_sources.SqsEventSource(
+                persist_queue,
+                batch_size=10,
+                max_batching_window=Duration.seconds(5),
+                report_batch_item_failures=True,
+            )
+        )
+        persist_dlq_alarm = aws_cloudwatch.Alarm(
+            self,
+            "ConversationPersistDlqAlarm",
+            alarm_name="ConversationPersistDlqAlarm",
+            alarm_description="Alarm when conversation persist DLQ has messages",
+            metric=persist_dlq.metric_approximate_number_of_messages_visible(),
+            threshold=0,
+            evaluation_periods=1,
+            comparison_operator=aws_cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+        )
+        persist_dlq_alarm.add_alarm_action(
+            aws_cloudwatch_actions.SnsAction(self.alarm_topic)
+        )
+
     def __create_engine(
         self,
         engine_name: str,
         sns_filter_policy: any,
         handler: str,
         log_group: aws_logs.LogGroup,
+        batch_size: int = 5,
+        max_concurrency: int = 5,
     ) -> None:
         """Creates infrastructure for the AI engine handler (queue-lambda-alarm)."""
 
+        timeout = Duration.minutes(5)
         lambda_fn = DockerImageFunction(
             self,
             f"{engine_name}Handler",
@@ -349,16 +586,55 @@ class EnginesStack(Stack):
                 exclude=["cdk.out"],
                 cmd=[handler],
             ),
-            timeout=Duration.minutes(5),
+            timeout=timeout,
             memory_size=256,
             log_group=log_group,
             role=self.lambda_role,
-            dead_letter_queue_enabled=True,
-            dead_letter_queue=self.dlq,
         )
-        lambda_fn.add_event_source(
-            aws_lambda_event_sources.SnsEventSource(
-                topic=self.request_topic,
+        dlq = aws_sqs.Queue(
+            self,
+            f"{engine_name}-Request-Queue-DLQ",
+            queue_name=f"{engine_name}-Request-Queue-DLQ",
+            removal_policy=RemovalPolicy.DESTROY,
+            encryption=aws_sqs.QueueEncryption.SQS_MANAGED,
+            retention_period=Duration.days(5),
+            enforce_ssl=True,
+        )
+        # requests are buffered, so a burst is processed with capped concurrency
+        queue = aws_sqs.Queue(
+            self,
+            f"{engine_name}-Request-Queue",
+            queue_name=f"{engine_name}-Request-Queue",
+            removal_policy=RemovalPolicy.DESTROY,
+            visibility_timeout=timeout.plus(Duration.minutes(1)),
+            encryption=aws_sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+            dead_letter_queue=aws_sqs.DeadLetterQueue(max_receive_count=2, queue=dlq),
+        )
+        self.request_topic.add_subscription(
+            aws_sns_subscriptions.SqsSubscription(
+                queue,
+                raw_message_delivery=True,
                 filter_policy=sns_filter_policy,
             )
         )
+        lambda_fn.add_event_source(
+            aws_lambda_event_sources.SqsEventSource(
+                queue,
+                batch_size=batch_size,
+                max_batching_window=Duration.seconds(1),
+                max_concurrency=max_concurrency,
+                report_batch_item_failures=True,
+            )
+        )
+        dlq_alarm = aws_cloudwatch.Alarm(
+            self,
+            f"{engine_name}DlqAlarm",
+            alarm_name=f"{engine_name}DlqAlarm",
+            alarm_description=f"Alarm when {engine_name} request DLQ has messages",
+            metric=dlq.metric_approximate_number_of_messages_visible(),
+            threshold=0,
+            evaluation_periods=1,
+            comparison_operator=aws_cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+        )
+        dlq_alarm.add_alarm_action(aws_cloudwatch_actions.SnsAction(self.alarm_topic))
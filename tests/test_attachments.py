@@ -0,0 +1,73 @@
+import os
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+from engines.attachments import attachment_refs, process_attachments
+
+
+def download(s3_uri: str, bucket_name: str) -> str:
+    """Stand-in for the s3 download, slower for the first files."""
+    name = s3_uri.split("/")[-1]
+    time.sleep(0.1 if name.startswith("0") else 0.01)
+    if "missing" in name:
+        raise FileNotFoundError(name)
+    tmp_file = os.path.join(tempfile.mkdtemp(), name)
+    with open(tmp_file, "w") as file:
+        file.write(name)
+    return tmp_file
+
+
+def test_attachments_keep_order_and_isolate_errors():
+    refs = ["s3://b/att/0.txt", "s3://b/att/missing.pdf", "s3://b/att/2.png"]
+    tmp_files = []
+
+    def handler(tmp_file: str, content_type: str) -> tuple:
+        tmp_files.append(tmp_file)
+        if content_type == "image/png":
+            raise ValueError("upload failed")
+        with open(tmp_file) as file:
+            return (file.read(), content_type)
+
+    with patch("engines.attachments.download_attachment", download):
+        attachments = process_attachments(refs, bucket_name="b", handler=handler)
+
+    assert [a.ref for a in attachments] == refs
+    assert attachments[0].value == ("0.txt", "text/plain")
+    assert isinstance(attachments[1].error, FileNotFoundError)
+    assert isinstance(attachments[2].error, ValueError)
+    assert not any(os.path.exists(tmp_file) for tmp_file in tmp_files)
+
+
+def test_attachments_run_concurrently_within_bound():
+    refs = [f"s3://b/att/0{i}.txt" for i in range(8)]
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def handler(tmp_file: str, content_type: str) -> str:
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return os.path.basename(tmp_file)
+
+    start = time.perf_counter()
+    with patch("engines.attachments.download_attachment", download):
+        attachments = process_attachments(refs, bucket_name="b", handler=handler, max_workers=4)
+    elapsed = time.perf_counter() - start
+
+    assert [a.value for a in attachments] == [f"0{i}.txt" for i in range(8)]
+    assert peak[0] == 4
+    assert elapsed < 8 * 0.15 / 2
+
+
+def test_attachment_refs_accepts_single_and_multiple_files():
+    assert attachment_refs({"file": "s3://b/att/a.pdf"}) == ["s3://b/att/a.pdf"]
+    assert attachment_refs({"files": ["s3://b/att/a.pdf", "s3://b/att/b.png"]}) == [
+        "s3://b/att/a.pdf",
+        "s3://b/att/b.png",
+    ]
+    assert attachment_refs({"text": "hi"}) == []
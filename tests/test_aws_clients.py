@@ -0,0 +1,41 @@
+import pytest
+from botocore.stub import Stubber
+
+from engines import aws_clients
+
+
+@pytest.fixture(autouse=True)
+def container(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-central-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "key")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "secret")
+    monkeypatch.setattr(aws_clients, "_session", None)
+    monkeypatch.setattr(aws_clients, "_clients", {})
+    monkeypatch.setattr(aws_clients, "_dynamodb", None)
+    monkeypatch.setattr(aws_clients, "_stats", {})
+
+
+def test_client_is_created_once_with_tuned_config():
+    sqs = aws_clients.client("sqs")
+    assert aws_clients.client("sqs") is sqs
+    assert sqs.meta.config.retries["mode"] == "adaptive"
+    assert sqs.meta.config.tcp_keepalive
+    assert sqs.meta.config.max_pool_connections == aws_clients.max_pool_connections
+
+
+def test_calls_and_errors_are_counted_per_service():
+    sqs = aws_clients.client("sqs")
+    table = aws_clients.table("user-context")
+    with Stubber(sqs) as sqs_stub, Stubber(table.meta.client) as dynamodb_stub:
+        sqs_stub.add_response("get_queue_url", {"QueueUrl": "url"})
+        sqs_stub.add_client_error("get_queue_url", "QueueDoesNotExist")
+        dynamodb_stub.add_response("get_item", {})
+        sqs.get_queue_url(QueueName="queue")
+        with pytest.raises(sqs.exceptions.ClientError):
+            sqs.get_queue_url(QueueName="missing")
+        table.get_item(Key={"user_id": "1", "engine": "gemini"})
+    stats = aws_clients.call_stats()
+    assert (stats["sqs"]["calls"], stats["sqs"]["errors"]) == (2, 1)
+    assert (stats["dynamodb"]["calls"], stats["dynamodb"]["errors"]) == (1, 0)
+    aws_clients.put_call_metrics()
+    assert aws_clients.call_stats() == {}
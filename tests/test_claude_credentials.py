@@ -0,0 +1,47 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from engines.claude_credentials import ClaudeCredentials
+
+
+class CookieStore:
+    """Stand-in for claude-cookies.json in s3 that counts the reads."""
+
+    def __init__(self):
+        self.loads = 0
+        self.lock = threading.Lock()
+
+    def load(self) -> dict:
+        with self.lock:
+            self.loads += 1
+            loads = self.loads
+        time.sleep(0.05)
+        return {"sessionKey": f"key-{loads}"}
+
+
+def test_credentials_are_loaded_once_and_cached():
+    store = CookieStore()
+    credentials = ClaudeCredentials(store.load, lambda cookies: "org")
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda _: credentials.get(), range(8)))
+    assert store.loads == 1
+    assert {r.cookies["sessionKey"] for r in results} == {"key-1"}
+    assert results[0].organization_id == "org"
+
+
+def test_concurrent_rejections_trigger_one_refresh():
+    store = CookieStore()
+    credentials = ClaudeCredentials(store.load, lambda cookies: "org")
+    stale = credentials.get()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda _: credentials.refresh(stale=stale), range(8)))
+    assert store.loads == 2
+    assert {r.cookies["sessionKey"] for r in results} == {"key-2"}
+
+
+def test_expired_credentials_are_reloaded():
+    store = CookieStore()
+    credentials = ClaudeCredentials(store.load, lambda cookies: "org", ttl=0)
+    credentials.get()
+    assert credentials.get().cookies["sessionKey"] == "key-2"
@@ -0,0 +1,60 @@
+import io
+import json
+import random
+
+import pytest
+
+import engines.conversation_codec as codec
+import engines.user_context as user_context
+from engines.conversation_codec import pack_conversation, unpack_conversation
+
+
+class MemoryS3:
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[f"{Bucket}/{Key}"] = Body
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[f"{Bucket}/{Key}"])}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    s3 = MemoryS3()
+    monkeypatch.setattr(codec, "client", lambda service: s3)
+    monkeypatch.setattr(codec, "_bucket", "bucket")
+    return s3
+
+
+def exchange(size: int) -> dict:
+    rnd = random.Random(size)
+    words = [f"word{rnd.randint(0, 5000)}" for _ in range(size // 8)]
+    return {"request": "question", "response": " ".join(words)}
+
+
+def test_short_exchange_stays_plain(s3):
+    attributes = pack_conversation({"request": "q", "response": "a"}, "c", "r")
+    assert json.loads(attributes["conversation"]) == {"request": "q", "response": "a"}
+
+
+def test_long_exchange_is_compressed(s3):
+    conversation = exchange(40_000)
+    attributes = pack_conversation(conversation, "c", "r")
+    assert set(attributes) == {"body"} and len(attributes["body"]) < 40_000 / 2
+    assert unpack_conversation(attributes) == conversation
+    assert not s3.objects
+
+
+def test_large_exchange_is_offloaded_to_s3(s3):
+    conversation = exchange(400_000)
+    attributes = pack_conversation(conversation, "c", "r")
+    assert attributes == {"body_ref": "bucket/conversations/c/r.zs"}
+    assert unpack_conversation(attributes) == conversation
+
+
+def test_compressed_body_survives_the_persist_queue(s3):
+    items = [("user-conversations", {"request_id": "r", **pack_conversation(exchange(40_000), "c", "r")})]
+    message = json.loads(json.dumps({"items": items}, default=user_context._encode_binary))
+    assert user_context._decode_items(message["items"]) == items
@@ -0,0 +1,29 @@
+from engines.conversation_history import select_turns, total_tokens, with_summary
+
+
+def turns(count: int, size: int = 400) -> list:
+    return [
+        {"request_id": str(i), "timestamp": i, "request": "q" * size, "response": "a" * size}
+        for i in range(count)
+    ]
+
+
+def test_select_turns_keeps_pinned_and_most_recent():
+    history = turns(10)
+    selected = select_turns(history, budget=total_tokens(history[:4]), pinned=1)
+    assert [t["request_id"] for t in selected] == ["0", "7", "8", "9"]
+
+
+def test_select_turns_drops_pinned_when_it_does_not_fit():
+    history = turns(3)
+    history[0]["response"] = "a" * 40000
+    selected = select_turns(history, budget=total_tokens(history[1:]), pinned=1)
+    assert [t["request_id"] for t in selected] == ["1", "2"]
+
+
+def test_with_summary_replaces_folded_turns():
+    history = turns(6)
+    compacted = with_summary({"summary": "earlier", "summarized_until": 4}, history)
+    assert [t["request_id"] for t in compacted] == ["summary_4", "4", "5"]
+    assert "earlier" in compacted[0]["request"]
+    assert with_summary(None, history) == history
@@ -0,0 +1,56 @@
+import importlib
+import json
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+
+class Translator:
+    """DeepL stand-in enforcing the limits of the translation endpoint."""
+
+    def __init__(self):
+        self.requests = []
+
+    def translate_text(self, texts: list, target_lang: str, context=None) -> list:
+        size = len(json.dumps({"text": texts, "target_lang": target_lang, "context": context}))
+        if len(texts) > 50 or size > 128 * 1024:
+            raise Exception("Request too large")
+        self.requests.append((len(texts), context))
+        return [SimpleNamespace(text=text.upper(), billed_characters=len(text)) for text in texts]
+
+
+class Memory:
+    def lookup(self, sentences, targets, source=None):
+        return {}
+
+    def store(self, translations, source=None):
+        pass
+
+
+@pytest.fixture
+def deepl_tr(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-central-1")
+    with patch("engines.common_utils.read_ssm_param", return_value="stand-in"):
+        deepl_tr = importlib.import_module("engines.deepl_tr")
+    monkeypatch.setattr(deepl_tr, "translator", Translator())
+    monkeypatch.setattr(deepl_tr, "TranslationMemory", Memory)
+    monkeypatch.setattr(deepl_tr, "put_metrics", lambda *args, **kwargs: None)
+    return deepl_tr
+
+
+def test_many_sentences_are_sent_in_several_requests(deepl_tr):
+    text = " ".join(f"Sentence {i} is short." for i in range(120))
+    ((lang, translation, error),) = deepl_tr.translate(text, ["PL"])
+    assert error is None and translation == text.upper()
+    assert [count for count, _ in deepl_tr.translator.requests] == [50, 50, 20]
+    assert all(context for _, context in deepl_tr.translator.requests)
+
+
+def test_long_text_is_sent_without_context(deepl_tr):
+    text = " ".join(f"Paragraph {i} is {'ż' * 500}." for i in range(120))
+    ((lang, translation, error),) = deepl_tr.translate(text, ["PL"])
+    assert error is None and translation == text.upper()
+    # every sentence takes 3 KB of the request once escaped
+    assert [count for count, _ in deepl_tr.translator.requests] == [40, 40, 40]
+    assert not any(context for _, context in deepl_tr.translator.requests)
@@ -0,0 +1,46 @@
+import importlib
+
+import pytest
+
+
+class Table:
+    """The 'timestamp-index' of 'user-conversations', newest first, in DynamoDB pages."""
+
+    def __init__(self, items: list):
+        self.items = sorted(items, key=lambda item: item["timestamp"], reverse=True)
+
+    def query(self, Limit: int, ExclusiveStartKey=None, **kwargs) -> dict:
+        condition = kwargs["KeyConditionExpression"].get_expression()
+        candidates = self.items
+        if condition["operator"] == "AND":
+            # conversation_id = :id AND timestamp <= :before
+            before = condition["values"][1].get_expression()["values"][1]
+            candidates = [item for item in self.items if item["timestamp"] <= before]
+        start = ExclusiveStartKey or 0
+        resp = {"Items": candidates[start : start + Limit]}
+        if start + Limit < len(candidates):
+            resp["LastEvaluatedKey"] = start + Limit
+        return resp
+
+
+@pytest.fixture
+def history(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-central-1")
+    history_command = importlib.import_module("lambda.history_command")
+    return history_command.ConversationHistory()
+
+
+def test_exchanges_of_one_second_are_not_skipped_between_pages(history):
+    # two exchanges in distinct seconds, then seven sharing one second
+    items = [{"request_id": f"req-{i}", "timestamp": 1760000000 + i} for i in (8, 9)]
+    items += [{"request_id": f"req-{i}", "timestamp": 1760000000} for i in range(7)]
+    history.conversations_table = Table(items)
+    listed = []
+    before = None
+    while True:
+        page, before = history.page("conversation", before=before)
+        listed.extend(item["request_id"] for item in page)
+        if before is None:
+            break
+    assert sorted(listed) == sorted(item["request_id"] for item in items)
+    assert len(listed) == len(items)
@@ -0,0 +1,95 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import jwt
+
+from engines.ideogram_auth import IdeogramAuth, IdeogramAuthProvider, token_expiry
+
+
+class TokenStore:
+    """Stand-in for the token files in s3 and the Google token endpoint."""
+
+    def __init__(self, expires_in: float):
+        self.lock = threading.Lock()
+        self.loads = 0
+        self.renewals = 0
+        self.saved = self.__auth(0, expires_in)
+
+    def load(self) -> IdeogramAuth:
+        with self.lock:
+            self.loads += 1
+            return self.saved
+
+    def renew(self, current: IdeogramAuth) -> IdeogramAuth:
+        time.sleep(0.05)
+        with self.lock:
+            self.renewals += 1
+            self.saved = self.__auth(self.renewals, 3600)
+            return self.saved
+
+    def __auth(self, version: int, expires_in: float) -> IdeogramAuth:
+        return IdeogramAuth(
+            access_token=f"token-{version}",
+            refresh_token="refresh",
+            user_id="user",
+            cookies={"session_cookie": f"cookie-{version}"},
+            expires_at=time.time() + expires_in,
+        )
+
+
+class Lease:
+    """Stand-in for the lease row in 'bot-state', shared by the containers."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        return self.lock.acquire(blocking=False)
+
+    def release(self) -> None:
+        self.lock.release()
+
+    def wait(self) -> None:
+        with self.lock:
+            pass
+
+
+def test_burst_renews_expired_tokens_once_across_containers():
+    store = TokenStore(expires_in=-1)
+    lease = Lease()
+    containers = [IdeogramAuthProvider(store.load, store.renew, lease) for _ in range(3)]
+    with ThreadPoolExecutor(max_workers=12) as pool:
+        results = list(pool.map(lambda i: containers[i % 3].get(), range(12)))
+    assert store.renewals == 1
+    assert {auth.access_token for auth in results} == {"token-1"}
+    loads = store.loads
+    for container in containers:
+        container.get()
+    assert store.loads == loads
+
+
+def test_tokens_close_to_expiry_are_renewed_in_background():
+    store = TokenStore(expires_in=60)
+    provider = IdeogramAuthProvider(store.load, store.renew, Lease(), refresh_ahead=300)
+    provider.current = store.load()
+    assert provider.get().access_token == "token-0"
+    assert provider.get().access_token == "token-0"
+    provider.background.join()
+    assert store.renewals == 1
+    assert provider.get().access_token == "token-1"
+
+
+def test_rejected_tokens_are_renewed_before_expiry():
+    store = TokenStore(expires_in=3600)
+    provider = IdeogramAuthProvider(store.load, store.renew, Lease())
+    rejected = provider.get()
+    assert provider.refresh(stale=rejected, rejected=True).access_token == "token-1"
+    assert store.renewals == 1
+
+
+def test_token_expiry_reads_exp_claim():
+    token = jwt.encode({"exp": 1700000000}, "s" * 32, algorithm="HS256")
+    assert token_expiry(token) == 1700000000
+    assert token_expiry("not a token") == 0
+    assert token_expiry(None) == 0
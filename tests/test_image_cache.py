@@ -0,0 +1,19 @@
+from engines.image_cache import image_cache_key, parse_prompt
+
+params = {"aspect_ratio": "1:1", "model_version": "V_1_5"}
+
+
+def test_prompts_differing_in_case_and_spacing_share_the_key():
+    assert image_cache_key("Cute  kitty\nplays", params) == image_cache_key(
+        "cute kitty plays", params
+    )
+
+
+def test_model_parameters_are_part_of_the_key():
+    other = {**params, "aspect_ratio": "16:9"}
+    assert image_cache_key("cute kitty", params) != image_cache_key("cute kitty", other)
+
+
+def test_fresh_flag_is_removed_from_the_prompt():
+    assert parse_prompt("cute --fresh kitty") == ("cute kitty", True)
+    assert parse_prompt("cute kitty") == ("cute kitty", False)
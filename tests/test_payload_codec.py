@@ -0,0 +1,60 @@
+import base64
+import importlib
+import io
+import random
+import string
+import zlib
+from unittest.mock import MagicMock, patch
+
+import pytest
+from botocore.response import StreamingBody
+
+from engines.common_utils import encode_message
+
+utils = importlib.import_module("lambda.utils")
+
+
+def random_text(size: int) -> str:
+    rnd = random.Random(size)
+    words = ["".join(rnd.choices(string.ascii_lowercase, k=rnd.randint(2, 9))) for _ in range(500)]
+    text = []
+    while sum(map(len, text)) < size:
+        text.append(rnd.choice(words))
+    return " ".join(text)[:size]
+
+
+@pytest.mark.parametrize(
+    "size,tag", [(10, "n:"), (2 * 1024, "z:"), (64 * 1024, "zs:")]
+)
+def test_roundtrip_picks_codec_by_size(size, tag):
+    text = random_text(size)
+    encoded = encode_message(text)
+    assert encoded.startswith(tag)
+    assert utils.decode_message(encoded) == text
+
+
+def test_decodes_legacy_payload():
+    text = "Привет, *world*"
+    legacy = base64.b64encode(zlib.compress(text.encode("utf-8"))).decode("ascii")
+    assert utils.decode_message(legacy) == text
+
+
+@pytest.mark.parametrize("size", [2 * 1024 * 1024])
+def test_large_payload_goes_through_s3(size):
+    storage = {}
+
+    def put_object(Bucket, Key, Body):
+        storage[(Bucket, Key)] = Body
+
+    def get_object(Bucket, Key):
+        body = storage[(Bucket, Key)]
+        return {"Body": StreamingBody(io.BytesIO(body), len(body))}
+
+    s3 = MagicMock(put_object=put_object, get_object=get_object)
+    # random letters do not compress below the s3 threshold
+    text = "".join(random.Random(1).choices(string.ascii_letters, k=size))
+    with patch.dict("engines.aws_clients._clients", {"s3": s3}):
+        encoded = encode_message(text, bucket_name="bucket")
+        assert encoded.startswith("s3:zs:bucket/results/")
+        assert len(encoded) < 200
+        assert utils.decode_message(encoded) == text
@@ -0,0 +1,55 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import engines.race as race_module
+from engines.race import RaceLost, race_for
+
+
+class Table:
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, Item, ConditionExpression):
+        key = (Item["state_id"], Item["kind"])
+        if key in self.items:
+            raise ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "PutItem")
+        self.items[key] = Item
+
+    def get_item(self, Key, ConsistentRead):
+        item = self.items.get((Key["state_id"], Key["kind"]))
+        return {"Item": item} if item else {}
+
+
+@pytest.fixture(autouse=True)
+def state_table(monkeypatch):
+    state_table = Table()
+    monkeypatch.setattr(race_module, "table", lambda name: state_table)
+    monkeypatch.setattr(race_module, "check_interval", 0)
+    return state_table
+
+
+def payload(engines: list, race: bool = True) -> dict:
+    return {"update_id": 42, "timestamp": 1760000000.0, "config": {"engines": engines, "race": race}}
+
+
+def test_only_several_engines_race():
+    assert race_for(payload(["gemini"]), "gemini") is None
+    assert race_for(payload(["gemini", "claude"], race=False), "gemini") is None
+    assert race_for(payload(["gemini", "claude"]), "gemini") is not None
+
+
+def test_first_claim_wins():
+    gemini = race_for(payload(["gemini", "claude"]), "gemini")
+    claude = race_for(payload(["gemini", "claude"]), "claude")
+    assert gemini.claim()
+    assert not claude.claim()
+    assert claude.lost() and not gemini.lost()
+
+
+def test_losing_engine_stops_generating():
+    gemini = race_for(payload(["gemini", "claude"]), "gemini")
+    claude = race_for(payload(["gemini", "claude"]), "claude")
+    claude.check()
+    gemini.claim()
+    with pytest.raises(RaceLost):
+        claude.check()
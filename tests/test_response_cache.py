@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+
+import pytest
+
+import engines.response_cache as response_cache
+from engines.bot_state import state_key
+from engines.response_cache import ResponseCache, response_cache_key
+
+
+class Table:
+    def __init__(self):
+        self.items = {}
+
+    def get_item(self, Key, **kwargs):
+        item = self.items.get((Key["state_id"], Key["kind"]))
+        return {"Item": item} if item else {}
+
+    def put_item(self, Item):
+        self.items[(Item["state_id"], Item["kind"])] = Item
+
+
+class Lease:
+    """Another container is answering the prompt and stores it once waited for."""
+
+    answer = None
+
+    def __init__(self, name, duration):
+        self.key = name.removeprefix("response_")
+
+    def acquire(self):
+        return self.answer is None
+
+    def wait(self):
+        _table.put_item(
+            Item={**state_key("response", self.key), "exp": time.time() + 60, **self.answer}
+        )
+
+    def release(self):
+        pass
+
+
+_table = Table()
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    _table.items.clear()
+    Lease.answer = None
+    monkeypatch.setattr(response_cache, "table", lambda name: _table)
+    monkeypatch.setattr(response_cache, "Lease", Lease)
+    monkeypatch.setattr(response_cache, "_responses", OrderedDict())
+    return ResponseCache(engine="gemini", model="gemini-2.5-pro", style="creative")
+
+
+def test_prompts_differing_in_case_and_spacing_share_the_key():
+    assert response_cache_key("What is  DNS?\n", "gemini", "m", None) == response_cache_key(
+        "what is dns?", "gemini", "m", None
+    )
+    assert response_cache_key("what is dns?", "gemini", "m", "precise") != response_cache_key(
+        "what is dns?", "gemini", "m", "creative"
+    )
+
+
+def test_repeated_prompt_is_answered_once(cache):
+    calls = []
+    assert cache.answer("What is DNS?", lambda: calls.append(1) or "Domain Name System") == "Domain Name System"
+    assert cache.answer("what is dns?", lambda: calls.append(1) or "other") == "Domain Name System"
+    assert len(calls) == 1
+
+
+def test_new_container_reads_the_shared_row(cache, monkeypatch):
+    cache.answer("What is DNS?", lambda: "Domain Name System")
+    monkeypatch.setattr(response_cache, "_responses", OrderedDict())
+    assert cache.answer("What is DNS?", lambda: "other") == "Domain Name System"
+
+
+def test_concurrent_prompt_waits_for_the_first_answer(cache):
+    Lease.answer = {"response": "Domain Name System", "latency_ms": 4200}
+    assert cache.answer("What is DNS?", lambda: pytest.fail("answered twice")) == "Domain Name System"
+
+
+def test_expired_answer_is_generated_again(cache, monkeypatch):
+    cache.answer("What is DNS?", lambda: "old")
+    monkeypatch.setattr(response_cache, "_responses", OrderedDict())
+    for item in _table.items.values():
+        item["exp"] = time.time() - 1
+    assert cache.answer("What is DNS?", lambda: "new") == "new"
@@ -0,0 +1,163 @@
+import json
+import threading
+import time
+import uuid
+
+from engines.sqs_batch import process_records
+
+
+class LocalQueue:
+    """SQS stand-in: redelivers messages reported as failed, dead-letters after max receives."""
+
+    def __init__(self, max_receive_count: int = 2) -> None:
+        self.max_receive_count = max_receive_count
+        self.messages = []
+        self.dlq = []
+
+    def send(self, payload: dict) -> None:
+        self.messages.append(
+            {"messageId": str(uuid.uuid4()), "body": json.dumps(payload), "receives": 0}
+        )
+
+    def poll(self, handler, batch_size: int) -> int:
+        """Delivers all visible messages to `handler` in batches, returns number of batches."""
+        batches = 0
+        while self.messages:
+            batch, self.messages = self.messages[:batch_size], self.messages[batch_size:]
+            for message in batch:
+                message["receives"] += 1
+            response = handler({"Records": batch}, None)
+            failed = {f["itemIdentifier"] for f in response["batchItemFailures"]}
+            for message in batch:
+                if message["messageId"] not in failed:
+                    continue
+                if message["receives"] >= self.max_receive_count:
+                    self.dlq.append(message)
+                else:
+                    self.messages.append(message)
+            batches += 1
+        return batches
+
+
+def test_partial_batch_failures_are_isolated():
+    queue = LocalQueue()
+    for i in range(10):
+        queue.send({"n": i})
+    processed = []
+
+    def handle(payload, message_id):
+        if payload["n"] == 3:
+            raise Exception("upstream error")
+        processed.append(payload["n"])
+
+    queue.poll(lambda event, _: process_records(event["Records"], handle), batch_size=5)
+
+    assert sorted(processed) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    assert [json.loads(m["body"])["n"] for m in queue.dlq] == [3]
+    assert queue.dlq[0]["receives"] == 2
+
+
+def test_load_is_processed_concurrently_within_bound():
+    queue = LocalQueue()
+    messages, latency, workers = 200, 0.02, 4
+    for i in range(messages):
+        queue.send({"n": i})
+    lock = threading.Lock()
+    state = {"active": 0, "peak": 0, "done": 0}
+
+    def handle(payload, message_id):
+        with lock:
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+        time.sleep(latency)
+        with lock:
+            state["active"] -= 1
+            state["done"] += 1
+
+    start = time.perf_counter()
+    batches = queue.poll(
+        lambda event, _: process_records(event["Records"], handle, max_workers=workers),
+        batch_size=10,
+    )
+    elapsed = time.perf_counter() - start
+
+    assert (batches, state["done"]) == (messages // 10, messages)
+    assert state["peak"] == workers
+    # batches of 10 on 4 workers take 3 rounds each instead of 10
+    assert elapsed < messages // 10 * 3 * latency * 2
+    assert not queue.dlq
+
+
+def test_messages_of_a_user_are_handled_in_order_with_their_own_ids():
+    queue = LocalQueue()
+    for i in range(6):
+        queue.send({"user_id": 1, "chat_id": 1, "n": i})
+    queue.send({"user_id": 2, "chat_id": 2, "n": 6})
+    lock = threading.Lock()
+    state = {"active": 0, "peak": 0}
+    handled = []
+
+    def handle(payload, message_id):
+        with lock:
+            state["active"] += payload["user_id"] == 1
+            state["peak"] = max(state["peak"], state["active"])
+        time.sleep(0.01)
+        with lock:
+            state["active"] -= payload["user_id"] == 1
+            handled.append((payload["n"], message_id))
+
+    queue.poll(lambda event, _: process_records(event["Records"], handle), batch_size=10)
+
+    assert [n for n, _ in handled if n < 6] == list(range(6))
+    assert state["peak"] == 1
+    assert len({message_id for _, message_id in handled}) == 7
+
+
+def test_later_messages_of_a_user_are_retried_with_the_failed_one():
+    queue = LocalQueue()
+    for i in range(3):
+        queue.send({"user_id": 1, "chat_id": 1, "n": i})
+    queue.send({"user_id": 2, "chat_id": 2, "n": 3})
+    handled = []
+    failing = {1}
+
+    def handle(payload, message_id):
+        if payload["n"] in failing:
+            failing.clear()
+            raise Exception("upstream error")
+        handled.append(payload["n"])
+
+    queue.poll(lambda event, _: process_records(event["Records"], handle), batch_size=10)
+
+    assert [n for n in handled if n != 3] == [0, 1, 2]
+    assert 3 in handled and not queue.dlq
+
+
+class LambdaContext:
+    def __init__(self, remaining_ms: int) -> None:
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self) -> int:
+        return self.remaining_ms
+
+
+def test_records_are_not_started_when_lambda_time_runs_out():
+    queue = LocalQueue()
+    for i in range(3):
+        queue.send({"user_id": 1, "chat_id": 1, "n": i})
+    for i in range(3, 5):
+        queue.send({"user_id": 2, "chat_id": 2, "n": i})
+    context = LambdaContext(remaining_ms=300_000)
+    processed = []
+
+    def handle(payload, message_id):
+        processed.append(payload["n"])
+        # the first answer of the user takes most of the invocation
+        if payload["n"] == 0:
+            context.remaining_ms = 20_000
+
+    records = queue.messages
+    response = process_records(records, handle, max_workers=1, context=context, time_margin=30)
+    failed = {f["itemIdentifier"] for f in response["batchItemFailures"]}
+    assert processed == [0]
+    assert failed == {record["messageId"] for record in records[1:]}
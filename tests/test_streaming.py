@@ -0,0 +1,67 @@
+import importlib
+import json
+from unittest.mock import MagicMock
+
+from engines.streaming import ResultStream
+
+utils = importlib.import_module("lambda.utils")
+
+
+def decode(message: dict) -> str:
+    return utils.decode_message(message["response"])
+
+
+def published(sns: MagicMock) -> list:
+    return [json.loads(call.kwargs["Message"]) for call in sns.publish.call_args_list]
+
+
+def test_stream_publishes_placeholder_and_final():
+    sns = MagicMock()
+    stream = ResultStream(
+        sns=sns, topic_arn="arn", payload={"chat_id": 1}, engine="gemini", interval=60
+    )
+    stream.start()
+    for delta in ["Hello", ", ", "world"]:
+        stream.append(delta)
+    stream.close("Hello, world!")
+
+    messages = published(sns)
+    assert [m["stream"]["seq"] for m in messages] == [0, 1]
+    assert decode(messages[0]) == ""
+    assert messages[-1]["stream"]["final"]
+    assert decode(messages[-1]) == "Hello, world!"
+    assert messages[-1]["stream"]["ttft_ms"] is not None
+
+
+def test_stream_flushes_cumulative_text():
+    sns = MagicMock()
+    stream = ResultStream(
+        sns=sns,
+        topic_arn="arn",
+        payload={"chat_id": 1},
+        engine="gemini",
+        formatter=str.upper,
+        interval=0,
+    )
+    stream.start()
+    stream.append("ab")
+    stream.append("cd")
+    stream.flush()
+
+    messages = published(sns)
+    assert [decode(m) for m in messages] == ["", "AB", "ABCD"]
+    assert not any(m["stream"]["final"] for m in messages)
+
+
+def test_failed_stream_replaces_the_placeholder_with_an_error():
+    sns = MagicMock()
+    stream = ResultStream(
+        sns=sns, topic_arn="arn", payload={"chat_id": 1}, engine="gemini", interval=60
+    )
+    stream.start()
+    stream.append("Hel")
+    stream.fail()
+
+    messages = published(sns)
+    assert messages[-1]["stream"]["final"]
+    assert decode(messages[-1]).startswith("Error:")
@@ -0,0 +1,20 @@
+from engines.translation_memory import sentence_hash, split_sentences
+
+
+def test_split_sentences_joins_back_to_text():
+    text = "  Hello there! How are you?\n\nSee the list:\n1. First item. 2. Second…  Thanks.\n"
+    parts = split_sentences(text)
+    assert "".join(parts) == text
+    assert [p.strip() for p in parts[0::2] if p.strip()] == [
+        "Hello there!",
+        "How are you?",
+        "See the list:",
+        "1. First item.",
+        "2. Second…",
+        "Thanks.",
+    ]
+
+
+def test_sentence_hash_ignores_whitespace_differences():
+    assert sentence_hash("Best regards,  John") == sentence_hash(" Best regards, John\t")
+    assert sentence_hash("Best regards, John") != sentence_hash("Best regards, Jane")
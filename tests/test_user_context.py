@@ -0,0 +1,261 @@
+import importlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Any
+from unittest.mock import patch
+
+import pytest
+from botocore.exceptions import ClientError
+
+import engines.user_context as user_context
+from engines.claude_credentials import Credentials
+from engines.user_context import UserContext
+
+
+class Table:
+    """In-memory stand-in for a DynamoDB table keyed by its full primary key."""
+
+    def __init__(self, key: tuple):
+        self.key = key
+        self.items = {}
+        self.reads = 0
+
+    def get_item(self, Key: dict, **kwargs) -> dict:
+        self.reads += 1
+        item = self.items.get(tuple(sorted(Key.items())))
+        return {"Item": item} if item else {}
+
+    def put_item(self, Item: dict, **condition) -> None:
+        if condition and not self.satisfies(self.stored(Item), condition):
+            raise ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "PutItem")
+        self.items[self.__key(Item)] = dict(Item)
+
+    def stored(self, item: dict) -> Any:
+        return self.items.get(self.__key(item))
+
+    def __key(self, item: dict) -> tuple:
+        return tuple(sorted((k, item[k]) for k in self.key))
+
+    @staticmethod
+    def satisfies(item: Any, condition: dict) -> bool:
+        """The conversation conditions of engines/user_context.py."""
+        values = condition["ExpressionAttributeValues"]
+        if ":conversation_id" in values:
+            return bool(item) and item["conversation_id"] == values[":conversation_id"]
+        return not item or item["conversation_id"] is None
+
+    def delete_item(self, Key: dict) -> None:
+        self.items.pop(tuple(sorted(Key.items())), None)
+
+
+class Client:
+    def __init__(self, resource: "Resource"):
+        self.resource = resource
+        self.transactions = 0
+        self.failing = False
+
+    def transact_write_items(self, TransactItems: list) -> None:
+        if self.failing:
+            raise Exception("TransactionCanceledException")
+        puts = [action["Put"] for action in TransactItems]
+        failed = [
+            "ConditionExpression" in put
+            and not Table.satisfies(self.resource.tables[put["TableName"]].stored(put["Item"]), put)
+            for put in puts
+        ]
+        if any(failed):
+            raise ClientError(
+                {
+                    "Error": {"Code": "TransactionCanceledException"},
+                    "CancellationReasons": [
+                        {"Code": "ConditionalCheckFailed" if f else "None"} for f in failed
+                    ],
+                },
+                "TransactWriteItems",
+            )
+        self.transactions += 1
+        for put in puts:
+            self.resource.tables[put["TableName"]].put_item(Item=put["Item"])
+
+
+class Resource:
+    def __init__(self):
+        self.tables = {
+            "user-context": Table(("user_id", "engine")),
+            "user-conversations": Table(("conversation_id", "request_id")),
+        }
+        self.client = Client(self)
+        for table in self.tables.values():
+            table.meta = SimpleNamespace(client=self.client)
+
+    def Table(self, name: str) -> Table:
+        return self.tables[name]
+
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+    resource = Resource()
+    monkeypatch.setattr(user_context, "table", resource.Table)
+    monkeypatch.setattr(user_context, "_contexts", user_context.OrderedDict())
+    return resource
+
+
+class Response:
+    def __init__(self, lines: tuple = (), body: Any = None):
+        self.ok = True
+        self.status_code = 200
+        self.lines = lines
+        self.body = body
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+    def json(self) -> Any:
+        return self.body
+
+    def close(self) -> None:
+        pass
+
+
+class ClaudeStandIn:
+    """claude.ai stand-in for the session pool of engines/claude.py, records the requests."""
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method: str, url: str, **kwargs) -> Response:
+        self.requests.append(url)
+        if url.endswith("/completion"):
+            return Response(
+                lines=(
+                    b'data: {"type": "completion", "completion": "a"}',
+                    b'data: {"type": "message_stop"}',
+                )
+            )
+        if url.endswith("/title"):
+            return Response(body={"title": "title"})
+        return Response()
+
+    @contextmanager
+    def session(self):
+        yield self
+
+    def creations(self) -> list:
+        return [url for url in self.requests if url.endswith("/chat_conversations")]
+
+    def titles(self) -> list:
+        return [url for url in self.requests if url.endswith("/title")]
+
+    def conversations(self) -> list:
+        return [url.split("/")[-2] for url in self.requests if url.endswith("/completion")]
+
+
+@pytest.fixture
+def claude(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-central-1")
+    with (
+        patch("engines.common_utils.read_ssm_param", return_value="stand-in"),
+        patch("engines.common_utils.read_json_from_s3", return_value=[]),
+    ):
+        claude = importlib.import_module("engines.claude")
+    upstream = ClaudeStandIn()
+    monkeypatch.setattr(claude, "sessions", upstream)
+    monkeypatch.setattr(
+        claude,
+        "credentials",
+        SimpleNamespace(get=lambda: Credentials(cookies={}, organization_id="org", expires_at=0)),
+    )
+    monkeypatch.setattr(claude, "title_pool", ThreadPoolExecutor(max_workers=1))
+    return SimpleNamespace(module=claude, upstream=upstream)
+
+
+def turn(claude: SimpleNamespace, request_id: str) -> UserContext:
+    """One message answered by engines/claude.py and saved like its process_payload does."""
+    context = UserContext(
+        user_id="42_42", engine_id="claude", request_id=request_id, username="user"
+    )
+    claude.module.ask(context=context, text="q")
+    context.save_conversation(conversation={"request": "q", "response": "a"})
+    # the title is requested in the background
+    claude.module.title_pool.submit(lambda: None).result()
+    return context
+
+
+def test_second_turn_reuses_the_conversation(dynamodb, claude):
+    first = turn(claude, "1")
+    second = turn(claude, "2")
+    assert len(claude.upstream.creations()) == 1
+    assert len(claude.upstream.titles()) == 1
+    assert claude.upstream.conversations() == [first.conversation_id] * 2
+    assert second.conversation_id == first.conversation_id
+    # the context saved on the first turn is served from the container cache
+    assert dynamodb.Table("user-context").reads == 1
+
+
+def test_new_container_reads_the_persisted_conversation(dynamodb, claude, monkeypatch):
+    first = turn(claude, "1")
+    monkeypatch.setattr(user_context, "_contexts", user_context.OrderedDict())
+    second = turn(claude, "2")
+    assert len(claude.upstream.creations()) == 1
+    assert len(claude.upstream.titles()) == 1
+    assert second.conversation_id == first.conversation_id
+    assert dynamodb.Table("user-context").reads == 2
+
+
+def test_reset_starts_a_new_conversation(dynamodb, claude):
+    first = turn(claude, "1")
+    first.reset_conversation()
+    second = turn(claude, "2")
+    assert second.conversation_id != first.conversation_id
+    assert len(claude.upstream.creations()) == 2
+    assert len(claude.upstream.titles()) == 2
+
+
+def test_reset_in_another_container_is_not_undone(dynamodb, claude, monkeypatch):
+    containers = [user_context.OrderedDict(), user_context.OrderedDict()]
+    monkeypatch.setattr(user_context, "_contexts", containers[0])
+    first = turn(claude, "1")
+    monkeypatch.setattr(user_context, "_contexts", containers[1])
+    turn(claude, "2")
+    monkeypatch.setattr(user_context, "_contexts", containers[0])
+    reset = UserContext(user_id="42_42", engine_id="claude", request_id="3", username="user")
+    reset.reset_conversation()
+    # the second container still caches the reset conversation
+    monkeypatch.setattr(user_context, "_contexts", containers[1])
+    stale = turn(claude, "4")
+    assert stale.conversation_id == first.conversation_id
+    assert dynamodb.Table("user-context").items == {}
+    # the exchange is kept in the history of the old conversation
+    assert len(dynamodb.Table("user-conversations").items) == 3
+    fresh = turn(claude, "5")
+    assert fresh.conversation_id != first.conversation_id
+    assert len(claude.upstream.creations()) == 2
+
+
+def test_context_and_exchange_are_written_in_one_transaction(dynamodb, claude):
+    turn(claude, "1")
+    assert dynamodb.client.transactions == 1
+    assert len(dynamodb.Table("user-conversations").items) == 1
+
+
+def test_failed_write_is_queued_for_retry(dynamodb, claude, monkeypatch):
+    queued = []
+    monkeypatch.setattr(user_context, "_enqueue_items", queued.extend)
+    dynamodb.client.failing = True
+    turn(claude, "1")
+    assert [item[0] for item in queued] == ["user-context", "user-conversations"]
+    # the queue handler replays the same transaction
+    dynamodb.client.failing = False
+    user_context.write_items(json.loads(json.dumps(queued)))
+    assert len(dynamodb.Table("user-conversations").items) == 1
+
+
+def test_exchange_keeps_a_short_preview_for_history(dynamodb, claude):
+    assert user_context._preview({"request": "short  question\n"}) == "short question"
+    preview = user_context._preview({"request": "word " * 40})
+    assert len(preview) == user_context.preview_length and preview.endswith("…")
+    turn(claude, "1")
+    (item,) = dynamodb.Table("user-conversations").items.values()
+    assert item["preview"] == "q"